@@ -18,17 +18,16 @@ Index of document:
 from __future__ import annotations
 
 import math
-import copy
 import time
 import logging
-import matplotlib.pyplot as plt
-from scipy.stats import multivariate_normal as mvn
+import os
+import hashlib
+import json
+import contextlib
 import numpy as np
-import matplotlib.pylab
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.patches import Ellipse
 
-from odorsampling import layers, config, utils
+from odorsampling import layers, config, utils, engine, results
+from odorsampling.results import SaturationResults, SaturationCache
 
 # Used for asserts
 from numbers import Real
@@ -36,13 +35,21 @@ from numbers import Real
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Union, Optional, Any, Iterable
+    from typing import Union, Optional, Any, Iterable, Sequence, IO
     from numbers import Number
     from odorsampling import cells
 
 logger = logging.getLogger(__name__)
 utils.default_log_setup(logger)
 
+# matplotlib and scipy are slow to import, so they are only loaded once used
+plt = utils.lazy_import("matplotlib.pyplot")
+pylab = utils.lazy_import("matplotlib.pylab")
+PdfPages = utils.lazy_import("matplotlib.backends.backend_pdf", "PdfPages")
+Ellipse = utils.lazy_import("matplotlib.patches", "Ellipse")
+mvn = utils.lazy_import("scipy.stats", "multivariate_normal")
+sparse = utils.lazy_import("scipy.sparse")
+
 
 # SD_NUMBER = 1.5
 # SD_NUMBER = params.RECEPTOR_ELLIPSE_STANDARD_DEVIATION
@@ -53,7 +60,7 @@ utils.default_log_setup(logger)
 # TODO: Move to params.py
 ###Global Variables when c!=1 (multiple conn between rec and glom)
 # glom_penetrance = .68  # primary glom:rec connection weight if c != 1
-s_weights = [0.12,0.08,0.03,0.03,0.02,0.02,0.01,0.01] # The remaining glom:rec connection weights if c != 1
+# s_weights = [0.12,0.08,0.03,0.03,0.02,0.02,0.01,0.01] # The remaining glom:rec connection weights if c != 1
 # numRow = 6 # num of rows of glom
 # numCol = 5 # num of cols of glom  (numRow*numCol = total number of Glom)
 # constant_attachments = True
@@ -232,7 +239,7 @@ class Ligand:
         self.aff = 0.0
         self.eff = 0.0
         self.occ = 0.0
-        # Used in sumOfSquaresVectorized
+        # Optional affs and effs of every receptor, see appendToAffs
         self._affs: list[float] = []
         self._effs: list[float] = []
         self._odors2 = []
@@ -437,6 +444,153 @@ class Odorscene:
         return f"ID: {self.id}\nOdors: \n{n_.join(map(str, self._odors))}"
 
 
+class OdorsceneBatch:
+    """Array-backed collection of S odorscenes, used instead of lists of Odorscene/Ligand
+    objects where many odorscenes are evaluated at once. Odorscenes with fewer ligands than
+    the largest one are padded, and padded entries are excluded by `mask`.
+
+    Attributes
+    ----------
+    _locs : np.ndarray
+        (S, Lmax, Q) ligand locations
+    _conc : np.ndarray
+        (S, Lmax) ligand concentrations in molar (0 for padding)
+    _counts : np.ndarray
+        (S,) number of ligands in each odorscene
+    _ids : np.ndarray
+        (S,) odorscene ids
+    _dns : np.ndarray or None
+        Optional (S, D, Q) displacements; each odorscene is also evaluated moved by each of its D dns
+    """
+
+    @property
+    def locs(self) -> np.ndarray:
+        """Returns the (S, Lmax, Q) locations."""
+        return self._locs
+
+    @property
+    def conc(self) -> np.ndarray:
+        """Returns the (S, Lmax) concentrations."""
+        return self._conc
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Returns the (S,) ligand counts."""
+        return self._counts
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Returns the (S,) odorscene ids."""
+        return self._ids
+
+    @property
+    def dns(self) -> Optional[np.ndarray]:
+        """Returns the (S, D, Q) displacements, or None."""
+        return self._dns
+
+    @dns.setter
+    def dns(self, value: Optional[np.ndarray]) -> None:
+        """Sets dns equal to value.
+        Precondition: value is None or has shape (S, D, Q)"""
+        if value is not None:
+            value = np.asarray(value, dtype=np.float64)
+            assert value.ndim == 3 and value.shape[0] == len(self) and value.shape[2] == self.dim, \
+                "dns must have shape (# of odorscenes, # of directions, dim)"
+        self._dns = value
+
+    @property
+    def mask(self) -> np.ndarray:
+        """Returns the (S, Lmax) boolean array that is False for padding."""
+        return np.arange(self._locs.shape[1]) < self._counts[:, np.newaxis]
+
+    @property
+    def dim(self) -> int:
+        """Returns the dim (Q) of the odorscenes."""
+        return self._locs.shape[2]
+
+    @property
+    def displacedLocs(self) -> np.ndarray:
+        """Returns the (S, D, Lmax, Q) locations of every odorscene moved by each of its dns.
+        Precondition: dns is not None"""
+        assert self._dns is not None, "batch has no displacements"
+        return self._locs[:, np.newaxis] + self._dns[:, :, np.newaxis, :]
+
+    def __init__(self, locs, conc, counts=None, ids=None, dns=None):
+        """Initializes the batch from (S, Lmax, Q) locs and (S, Lmax) conc.
+        If counts is None, every odorscene has Lmax ligands. If ids is None, ids are 0..S-1."""
+        self._locs = np.asarray(locs, dtype=np.float64)
+        self._conc = np.asarray(conc, dtype=np.float64)
+        assert self._locs.ndim == 3, "locs must have shape (# of odorscenes, # of ligands, dim)"
+        assert self._conc.shape == self._locs.shape[:2], "conc and locs shapes are not consistent"
+        if counts is None:
+            counts = np.full(len(self._locs), self._locs.shape[1])
+        self._counts = np.asarray(counts, dtype=np.int64)
+        assert self._counts.shape == (len(self._locs),), "counts must have one entry per odorscene"
+        assert np.all(self._counts <= self._locs.shape[1]), "counts can't be more than the # of ligands"
+        self._ids = np.arange(len(self._locs)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.dns = dns
+
+    def __len__(self):
+        return len(self._locs)
+
+    @classmethod
+    def create(cls, amt: list[int], conc: float, qspace: QSpace, ids=None, r=None, rep: Optional[int] = None):
+        """Returns a batch of len(amt) odorscenes, where odorscene i has amt[i] ligands of
+        concentration conc uniformly distributed in qspace.
+        If r is given, each odorscene also gets rep (default config.ANGLES_REP) dns of amplitude r
+        from dPsiBarCalcDns, drawn right after its ligands.
+        Locations are drawn in the same order as calling createLoc for every ligand."""
+        dim = len(qspace.size)
+        low, high = np.array(qspace.size, dtype=np.float64).T
+        rep = config.ANGLES_REP if rep is None else rep
+        batch = cls(np.zeros((len(amt), max(amt), dim)), np.zeros((len(amt), max(amt))), amt, ids,
+                    None if r is None else np.zeros((len(amt), rep, dim)))
+        for i, n in enumerate(amt):
+            batch.locs[i, :n] = utils.RNG.uniform(low, high, size=(n, dim))
+            batch.conc[i, :n] = conc
+            if r is not None:
+                batch.dns[i] = dPsiBarCalcDns(batch, r, rep)
+        return batch
+
+    @classmethod
+    def fromOdorscenes(cls, odorscenes: Iterable[Odorscene], dns=None):
+        """Returns a batch holding the ligand locations and concentrations of odorscenes.
+        Precondition: all odorscenes have the same dim"""
+        odorscenes = list(odorscenes)
+        dim = odorscenes[0].dim
+        assert all(odorscene.dim == dim for odorscene in odorscenes), "Odorscenes aren't all the same dim."
+        counts = [len(odorscene.odors) for odorscene in odorscenes]
+        locs = np.zeros((len(odorscenes), max(counts), dim))
+        conc = np.zeros(locs.shape[:2])
+        for i, odorscene in enumerate(odorscenes):
+            locs[i, :counts[i]] = [odor.loc for odor in odorscene.odors]
+            conc[i, :counts[i]] = [odor.conc for odor in odorscene.odors]
+        return cls(locs, conc, counts, [odorscene.id for odorscene in odorscenes], dns)
+
+    def toOdorscenes(self, displaced=True) -> list[Odorscene]:
+        """Returns the batch as a list of Odorscenes. Ligand ids are their index in the odorscene.
+        If the batch has dns and displaced is True, each ligand gets its displaced copies attached
+        with appendToOdors2."""
+        odorscenes = []
+        for i, n in enumerate(self._counts):
+            odors = []
+            for j in range(n):
+                odor = Ligand(j, self._locs[i, j], self._conc[i, j])
+                if self._dns is not None and displaced:
+                    for dn in self._dns[i]:
+                        odor.appendToOdors2(Ligand(j, self._locs[i, j] + dn, self._conc[i, j]))
+                odors.append(odor)
+            odorscenes.append(Odorscene(self._ids[i], odors))
+        return odorscenes
+
+    def __getitem__(self, key) -> OdorsceneBatch:
+        """Returns the odorscenes selected by key (an int, slice or index array) as a new batch."""
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key+1 if key != -1 else None)
+        return OdorsceneBatch(self._locs[key], self._conc[key], self._counts[key], self._ids[key],
+                              None if self._dns is None else self._dns[key])
+
+
 class Receptor:
     """Represents an odor receptor with center (x,y,z...) and radius of 
     sensitivity r.
@@ -468,8 +622,12 @@ class Receptor:
         aff values of all odors for this receptor
     _effs : np.ndarray
         eff values of all odors for this receptor
+    _changes : int
+        Incremented whenever the mean or SDs of this receptor are set (0 until then). Used to
+        invalidate the CompiledEpithelium instances built from it.
 
     """
+    _changes = 0
     
 #Getters and Setters
     @property
@@ -494,6 +652,7 @@ class Receptor:
         Precondtion: value is an list"""
         self._mean = tuple(value)
         self._mean_sd_change = True
+        self._changes += 1
     
     @property
     def sdA(self) -> tuple:
@@ -506,6 +665,7 @@ class Receptor:
         Precondition: Value is a List with dim Q"""
         self._sdA = tuple(value)
         self._mean_sd_change = True
+        self._changes += 1
 
     @property
     def sdE(self) -> tuple:
@@ -518,6 +678,7 @@ class Receptor:
         Precondition: Value is a List with dim Q"""
         self._sdE = tuple(value)
         self._mean_sd_change = True
+        self._changes += 1
     
     @staticmethod
     def _update_cov_scale(getter):
@@ -723,6 +884,10 @@ class Epithelium:
     """Represents a list of receptors.
     Instance Attributes:
     _recs : list[Receptor]
+    _compiled : CompiledEpithelium or None
+        Cached array form of the receptors, see `compiled`
+    _connectomes : dict[tuple, Connectome]
+        Glom:rec connections of the receptors for each c and config settings, see `connectome`
     """
     
     @property
@@ -736,6 +901,25 @@ class Epithelium:
         Precondition: Value is a List"""
         # assert isinstance(value, Sequence), f"Value is not a Sequence! {type(value)}"
         self._recs = tuple(value)
+        self._compiled = None
+        self._connectomes = {}
+
+    @property
+    def compiled(self) -> CompiledEpithelium:
+        """Returns the receptors as a CompiledEpithelium. It is built on first use and rebuilt
+        after the mean or SDs of a receptor are changed."""
+        if self._compiled is None or not self._compiled.valid:
+            self._compiled = CompiledEpithelium(self)
+        return self._compiled
+    
+    def connectome(self, c: int) -> Connectome:
+        """Returns the Connectome of the receptors with c recs per glom. It is built on first use
+        and kept until the receptors are replaced. The config settings it is built from are part of
+        the key (see _connectomeKey), so changing them gives another one."""
+        key = _connectomeKey(c)
+        if key not in self._connectomes:
+            self._connectomes[key] = Connectome(len(self.recs), c)
+        return self._connectomes[key]
     
     def __init__(self, recs):
         """Initializes a epithelium."""
@@ -791,14 +975,241 @@ class Epithelium:
         n_ = '\n'
         return f"Epithelium contains the following receptors: \n{n_.join(map(str, self.recs))}"
 
+class CompiledEpithelium:
+    """Array form of an Epithelium, used by the activation engines instead of reading
+    every Receptor's attributes. Built with `Epithelium.compiled` or `CompiledEpithelium.load`.
+
+    Attributes
+    ----------
+    mean, sdA, sdE : np.ndarray
+        (R, Q) receptor means and affinity/efficacy standard deviations
+    invVarA, invVarE : np.ndarray
+        (R, Q) 1/sdA^^2 and 1/sdE^^2
+    logNormA, logNormE : np.ndarray
+        (R,) log of the gaussian normalizers, ie. log(rec.scale) and log(rec.effScale)
+    ids : np.ndarray
+        (R,) receptor ids
+    """
+
+    @property
+    def valid(self) -> bool:
+        """Returns False if one of its receptors has been changed since this was built."""
+        return self._changes == [rec._changes for rec in self._recs]
+
+    @property
+    def scale(self) -> np.ndarray:
+        """Returns the (R,) affinity scales (peak of each affinity gaussian)."""
+        return np.exp(self.logNormA)
+
+    @property
+    def effScale(self) -> np.ndarray:
+        """Returns the (R,) efficacy scales (peak of each efficacy gaussian)."""
+        return np.exp(self.logNormE)
+
+    def __init__(self, epithelium: Epithelium):
+        """Builds the arrays from the receptors of epithelium."""
+        recs = epithelium.recs
+        self._recs = recs
+        self._changes = [rec._changes for rec in recs]
+        self.ids = np.array([rec.id for rec in recs])
+        self.mean = np.array([rec.mean for rec in recs], dtype=np.float64)
+        self.sdA = np.array([rec.sdA for rec in recs], dtype=np.float64)
+        self.sdE = np.array([rec.sdE for rec in recs], dtype=np.float64)
+        assert self.mean.shape == self.sdA.shape == self.sdE.shape, "Receptors aren't all the same dim."
+        self.invVarA = 1.0 / np.square(self.sdA)
+        self.invVarE = 1.0 / np.square(self.sdE)
+        # log of the multivariate normal pdf at the mean, for a diagonal covariance
+        logTwoPi = self.mean.shape[1] * math.log(2*math.pi)
+        self.logNormA = -0.5 * (logTwoPi - np.log(self.invVarA).sum(axis=1))
+        self.logNormE = -0.5 * (logTwoPi - np.log(self.invVarE).sum(axis=1))
+
+    def __len__(self):
+        return len(self.mean)
+
+    @classmethod
+    def load(cls, name: str) -> CompiledEpithelium:
+        """Returns the compiled form of the epithelium stored in the CSV file with the given name."""
+        return Epithelium.load(name).compiled
+
+    def affinityEfficacy(self, locs, fixed=False, **kdaKwargs) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (..., R, L) affinity (kDa) and efficacy of every receptor for
+        every location in the (..., L, Q) locs. See engine.affinity_efficacy."""
+        return engine.affinity_efficacy(self.mean, self.sdA, self.sdE, locs, fixed,
+                                        (self.invVarA, self.invVarE), **kdaKwargs)
+
+    def activation(self, locs, conc, fixed=False, mask=None, out=None) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (..., R) activation and total occupancy of every receptor for every
+        odorscene in the (..., L, Q) locs, with (..., L) conc (see engine.occupancy).
+        If config.SPARSE_CUTOFF_SD is set, each odorscene is evaluated with engine.sparse_occupancy."""
+        if config.SPARSE_CUTOFF_SD is None:
+            aff, eff = self.affinityEfficacy(locs, fixed)
+            _, activ, totOcc = engine.occupancy(aff, eff, conc, mask, out)
+            return activ, totOcc
+        
+        locs = np.asarray(locs, dtype=np.float64)
+        batchShape = locs.shape[:-2]
+        conc = np.broadcast_to(conc, locs.shape[:-1]).reshape(-1, locs.shape[-2])
+        mask = None if mask is None else np.broadcast_to(mask, locs.shape[:-1]).reshape(conc.shape)
+        activ = np.empty(batchShape + (len(self),)) if out is None else out
+        totOcc = np.empty(batchShape + (len(self),))
+        for i, sceneLocs in enumerate(locs.reshape(-1, *locs.shape[-2:])):
+            keep = slice(None) if mask is None else mask[i]
+            #Each row is written in place, so out doesn't have to be contiguous
+            index = np.unravel_index(i, batchShape)
+            activ[index], totOcc[index] = engine.sparse_occupancy(
+                self.mean, self.sdA, self.sdE, sceneLocs[keep], conc[i][keep], config.SPARSE_CUTOFF_SD,
+                fixed, (self.invVarA, self.invVarE))
+        return activ, totOcc
+
+    def adjacentCounts(self, locs) -> np.ndarray:
+        """Returns the (..., R) number of locations within 2 average affinity SDs of each receptor."""
+        return engine.adjacent_counts(self.mean, self.sdA, locs)
+
+def _compiled(epithelium: Union[Epithelium, CompiledEpithelium]) -> CompiledEpithelium:
+    """Returns epithelium as a CompiledEpithelium."""
+    return epithelium if isinstance(epithelium, CompiledEpithelium) else epithelium.compiled
+
 # TODO: delete this class
 class Text:
-    """Holding experimental text to later store in text file"""
+    """Holding experimental text to later store in text file
+    
+    Rows are collected with write (rec rows) and writeGlom (glom rows) and only joined
+    when _st or _st2 is read, so building the text takes linear time.
+
+    Attributes
+    ----------
+    _name : str
+        Layout of the rec rows, either "exp1" (one row per odorscene) or "exp2" (one row per rec)
+    _tail : str
+        Last few characters written with write, used to number the glom rows
+    """
     
     def __init__(self, st, name):
-        self._st = st
         self._name = name
-        self._st2 = ""
+        self._rows: list[str] = []
+        self._rows2: list[str] = []
+        self._tail = ""
+        self.write(st)
+
+    @property
+    def _st(self) -> str:
+        self._rows = ["".join(self._rows)]
+        return self._rows[0]
+    @_st.setter
+    def _st(self, value: str):
+        self._rows = []
+        self._tail = ""
+        self.write(value)
+
+    @property
+    def _st2(self) -> str:
+        self._rows2 = ["".join(self._rows2)]
+        return self._rows2[0]
+    @_st2.setter
+    def _st2(self, value: str):
+        self._rows2 = [value]
+
+    def write(self, st: str):
+        """Adds st to the rec rows"""
+        self._rows.append(st)
+        self._tail = (self._tail + st)[-4:]
+
+    def writeGlom(self, st: str):
+        """Adds st to the glom rows"""
+        self._rows2.append(st)
+
+    def save(self, name: str, name2: Optional[str] = None):
+        """Stores the rec rows in name and, if given, the glom rows in name2"""
+        with open(name, "w") as f:
+            f.write(self._st)
+        if name2 is not None:
+            with open(name2, "w") as f:
+                f.write(self._st2)
+
+class TextStream(Text):
+    """Text that writes its rows to files as they are made instead of holding all of them.
+    At most config.TEXT_CHUNK_SIZE characters are held before they are written.
+    Can be used anywhere a Text is, and as a context manager that saves the files on exit.
+
+    Attributes
+    ----------
+    _files : list[IO[str]]
+        Open rec (and glom) files
+    _held : list[int]
+        Number of characters held for each file
+    """
+
+    def __init__(self, st, name, fileName: str, fileName2: Optional[str] = None, offsets: Optional[list[int]] = None):
+        """If offsets (from tell) is given, the files are cut back to those sizes and continued instead of
+        being started over. st is then already in the file and isn't written again."""
+        fileNames = [fileName] + ([] if fileName2 is None else [fileName2])
+        self._held = [0, 0]
+        if offsets is None:
+            self._files = [open(fileName, "w") for fileName in fileNames]
+            super().__init__(st, name)
+        else:
+            for fileName, offset in zip(fileNames, offsets):
+                os.truncate(fileName, offset)
+            self._files = [open(fileName, "a") for fileName in fileNames]
+            super().__init__("", name)
+            with open(fileNames[0], "rb") as f:
+                f.seek(max(0, offsets[0] - 4))
+                self._tail = f.read().decode()
+
+    @property
+    def _st(self) -> str:
+        raise AttributeError("TextStream rows are written to disk, read them from the file instead")
+    @_st.setter
+    def _st(self, value: str):
+        raise AttributeError("TextStream rows can only be added with write")
+
+    @property
+    def _st2(self) -> str:
+        raise AttributeError("TextStream rows are written to disk, read them from the file instead")
+    @_st2.setter
+    def _st2(self, value: str):
+        raise AttributeError("TextStream rows can only be added with writeGlom")
+
+    def write(self, st: str):
+        super().write(st)
+        self._held[0] += len(st)
+        if self._held[0] >= config.TEXT_CHUNK_SIZE:
+            self.flush()
+
+    def writeGlom(self, st: str):
+        assert len(self._files) == 2, "TextStream was not given a file for glom rows"
+        super().writeGlom(st)
+        self._held[1] += len(st)
+        if self._held[1] >= config.TEXT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes all held rows to disk"""
+        for f, rows in zip(self._files, (self._rows, self._rows2)):
+            f.write("".join(rows))
+            f.flush()
+            rows.clear()
+        self._held = [0, 0]
+
+    def tell(self) -> list[int]:
+        """Writes all held rows and returns the sizes of the files, to continue them from with offsets"""
+        self.flush()
+        return [os.fstat(f.fileno()).st_size for f in self._files]
+
+    def save(self, name: Optional[str] = None, name2: Optional[str] = None):
+        """Writes the remaining rows and closes the files. The names are already known, so they are only checked."""
+        assert name is None or name == self._files[0].name, "TextStream was opened with a different file name"
+        assert name2 is None or name2 == self._files[-1].name, "TextStream was opened with a different file name"
+        if not self._files[0].closed:
+            self.flush()
+            for f in self._files:
+                f.close()
+
+    def __enter__(self) -> TextStream:
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
 
 ######Functions for objects
 
@@ -859,47 +1270,22 @@ def activateGL_QSpace(epith: Epithelium, odorscene: Odorscene, gl: layers.GlomLa
     logger.info("Activating GL QSpace.")
     gl.clear_activations()
     
-    #Loop through each receptor and eventually calculate activation level
-    for rec in epith.recs:
-        #Set everything to 0
-        activ = 0.0
-        odors: list[Ligand] = []
-        df = 0
-        
-        effScale = float(mvn.pdf(rec.mean, rec.mean, rec.covE))
-        
-        for odor in odorscene.odors:
-            #First odorscene
-            aff = mvn.pdf(odor.loc, rec.mean, rec.covA)
-            aff = aff / rec.scale #Scales it from 0 to 1
-            #Now convert gaussian aff to kda
-            
-            aff = 10**((aff * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY) ##config.PEAK_AFFINITY etc. are global variables
-            #print("aff is " + str(aff))
-            odor.aff = float(aff)
-            
-            if fixed:
-                odor.eff = 1.0
-            else:
-                eff = mvn.pdf(odor.loc, rec.mean, rec.covE)
-                eff = float(eff) / effScale #Scales it from 0 to 1
-                odor.eff = eff
-                #print("eff is " + str(eff))
-            odors.append(odor)
-            # TODO: Move all private attribute handling to the class responsible (Ligand) or just create Ligand._aff getter
-            df += odor.conc/odor._aff
-        
-        i = 1
-        for odor in odors:
-            odor.occ = 1/(1+((odor._aff/odor.conc)*(1+df-odor.conc/odor._aff))**config.HILL_COEFF) #m=1
-            activ += odor.eff * odor.occ
-            
-            #print("Occ is: " + str(odor._occ))
-            #print(str(i) + " activation due to odorscene 1: " + str(activ_1))
-            i += 1
-        #print("activ level for rec " + str(activ))
-        rec.activ = activ
-        gl[rec.id].activ = activ
+    #Affinity and efficacy of every receptor for every ligand, shape (R, L)
+    locs = np.array([odor.loc for odor in odorscene.odors])
+    conc = np.array([odor.conc for odor in odorscene.odors])
+    aff, eff = epith.compiled.affinityEfficacy(locs, fixed)
+    
+    occ, activ, _ = engine.occupancy(aff, eff, conc)
+
+    for rec, recActiv in zip(epith.recs, activ):
+        rec.activ = float(recActiv)
+        gl[rec.id].activ = rec.activ
+    
+    #Ligands keep the temporary values for the last receptor
+    for odor, odorAff, odorEff, odorOcc in zip(odorscene.odors, aff[-1], eff[-1], occ[-1]):
+        odor.aff = odorAff
+        odor.eff = odorEff
+        odor.occ = odorOcc
         
     if c != 1:
         glomRecConnNew(epith.recs, gl, c)
@@ -953,125 +1339,54 @@ def sequentialOdorscenes(n: int, amt: int, dim: int, change: int, qspace: QSpace
 ## Maximum dpsi value = # of receptors in epithelium (if the first odorscene
 ## always activates the receptor = 1.0 and the other activates = 0.0)
 
-def sumOfSquares(epithelium: Epithelium, odorscene: Odorscene, dn: list[int], fixed=False, c=1, gl: layers.GlomLayer = None): 
+def sumOfSquares(epithelium: Epithelium, odorscene: Odorscene, dn: list[int], fixed=False, c=1, gl: layers.GlomLayer = None,
+                 activ: Optional[np.ndarray] = None, connectome: Optional[Connectome] = None): 
     """Calculates differentiation between epithelium activation of odorscene before
     and after dn using sum of squares. Returns dpsi of the epithelium.
     If fixed=true, then efficacy will be fixed at 1 (only agonists)
     If c!=1, then use function to activate glom with 1:c ratio of Glom:Rec
+    activ = optional (2, # of recs) buffer that receives the activations before and after dn,
+    so repeated calls (eg. over many directions) can reuse it
+    connectome = optional glom:rec connections to use if c!=1 (see _dPsiFromActivations)
     Precondtion: dn=list in correct dim"""
     assert odorscene.dim== len(dn), "dimension not consistent with dn"
     logger.debug("Performing sumOfSquares.")
     gl = layers.GlomLayer() if gl is None else gl
-    dPsi = 0
-    recs2 = copy.deepcopy(epithelium.recs)
     gl.clear_activations() #Sets gl activations and recConn back to 0.0
     
-    counter = 0 #for storing info in rec2
-    for rec in epithelium.recs:
-        
-        #Set everything to 0
-        activ_1 = 0.0
-        activ_2 = 0.0
-        totOcc = 0.0
-        odors: list[Ligand] = []
-        odors2: list[Ligand] = []
-        rec._activ = 0.0
-        rec._occ = 0.0
-        rec._odoAmt = 0.0
-        df = 0
-        df2 = 0
-        dphi = 0
-        effScale = float(mvn.pdf(rec.mean, rec.mean, rec.covE)  ) 
-        
-        for odor in odorscene.odors:
-            #First odorscene
-            aff = mvn.pdf(odor.loc, rec.mean, rec.covA)
-            aff = aff / rec.scale #Scales it from 0 to 1
-            #Now convert gaussian aff to kda
-            aff = 10**((aff * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY) ##config.PEAK_AFFINITY etc. are global variables
-            
-            #print("aff is " + str(aff))
-            odor.aff = float(aff)
-            if fixed:
-                odor.eff = 1.0
-            else:
-                eff = mvn.pdf(odor.loc, rec.mean, rec.covE)
-                eff = float(eff) / effScale #Scales it from 0 to 1
-                odor.eff = eff
-            odors.append(odor)
-            df += odor.conc/odor._aff
-                
-            
-            #Second Odorscene
-            newLoc = []  #Calculating new location
-            index = 0
-            while index < len(dn):
-                newLoc.append(odor.loc[index] + dn[index])
-                index += 1
-            newOdor = Ligand(odor.id, newLoc, odor.conc)
-            
-            aff2 = mvn.pdf(newLoc, rec.mean, rec.covA)
-            aff2 = aff2/rec.scale #Scales it from 0 to 1
-            aff2 = 10**((aff2 * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY)
-            #print("aff2 is " + str(aff2))
-            newOdor.aff = float(aff2)
-            if fixed:
-                newOdor.eff = 1.0
-            else:
-                eff2 = mvn.pdf(newLoc, rec.mean, rec.covE)
-                eff2 = float(eff2) / effScale #Scales it from 0 to 1
-                newOdor.eff = eff2
-            odors2.append(newOdor)
-            df2 += newOdor.conc/newOdor._aff
-                
-        i = 1
-        for odor in odors:
-            odor.occ = 1/(1+((odor.aff/odor.conc)*(1+df-odor.conc/odor.aff))**config.HILL_COEFF) #m=1
-            activ_1 += odor.eff*odor._occ
-            rec._occ += odor.occ #Solely for printing individual receptor activations in experiments
-            rec._odoAmt += adjOdors(rec, odor)
-            #print(str(i) + " activation due to odorscene 1: " + str(activ_1))
-            i += 1
-        i = 1
-        
-        rec.activ = activ_1 #Solely for printing individual receptor activations in experiments
-        
-        for odor2 in odors2:
-            odor2.occ = (1/(1+((odor2.aff/odor2.conc)*(1+df2-odor2.conc/odor2.aff))**config.HILL_COEFF)) #m=1
-            activ_2 += odor2.eff*odor2.occ
-            i += 1
-        
-        recs2[counter].activ = activ_2
-        
-        #print("activ_1 is " + str(activ_1))
-        #print("activ_2 is " + str(activ_2))
-        dPhi = activ_1-activ_2 #########(Maximum value will be 1 or -1 = make sure this is true)
-        dPsi += dPhi**2
-        
-        
-        counter += 1
-    
-    #print("rec dPsi is: " + str(math.sqrt(dPsi))
+    #Stack the odorscene and the odorscene moved by dn into a (2, L, Q) batch
+    locs = np.array([odor.loc for odor in odorscene.odors])
+    conc = np.array([odor.conc for odor in odorscene.odors])
+    compiled = epithelium.compiled
+    activ, totOcc = compiled.activation(np.stack((locs, locs + np.asarray(dn))), conc, fixed, out=activ)
+    odoAmt = compiled.adjacentCounts(locs)
+    
+    return float(_dPsiFromActivations(epithelium, activ, totOcc[0], odoAmt, c, gl, connectome)[0])
+
+def _dPsiFromActivations(epithelium: Epithelium, activ: np.ndarray, totOcc: np.ndarray, odoAmt: np.ndarray,
+                         c: int, gl: layers.GlomLayer, connectome: Optional[Connectome] = None) -> np.ndarray:
+    """Stores the activations of the first odorscene (activ[0]) on the receptors, then returns
+    the dPsi between activ[0] and each of activ[1:]. If c!=1, dPsi is between the glom activations
+    given by connectome (or the one config.CONNECTOME_POLICY gives, see policyConnectome) instead,
+    and gl is left activated by the first odorscene. gl's rec_conn_map is not filled in.
+    Neither the receptors nor gl are copied."""
+    for counter, rec in enumerate(epithelium.recs):
+        #Solely for printing individual receptor activations in experiments
+        rec.activ = float(activ[0, counter])
+        rec.setOcc(float(totOcc[counter]))
+        rec.setOdoAmt(float(odoAmt[counter]))
     
     if c != 1:
-        
-        gl2 = copy.deepcopy(gl)
-        
-        conn = glomRecConnNew(epithelium.recs, gl, c, [])
-        glomRecConnNew(recs2, gl2, c, conn)
-
-        count = 0
-        dPsi = 0
-        while count < len(gl):
-            dPhi = (gl[count].activ - gl2[count].activ)
-            # print("gl 1 activ is " + str(gl[count].activ))
-            # print("gl 2 activ is " + str(gl2[count].activ))
-            dPsi += dPhi**2
-            count += 1
-        #print("dPsi is " + str(math.sqrt(dPsi)))
-        return math.sqrt(dPsi)
-    else:
-        return math.sqrt(dPsi)
+        connectome = policyConnectome(epithelium, c) if connectome is None else connectome
+        assert len(gl) == len(connectome), "# of recs != # of glom"
+        for glom, glomActiv in zip(gl, connectome.activate(activ[0])):
+            glom.activ = glomActiv
+        glomActiv = np.array([glom.activ for glom in gl])
+        #The other odorscenes are activated with a single product
+        glomActiv2 = connectome.activate(activ[1:]).round(6)
+        return np.sqrt(((glomActiv - glomActiv2)**2).sum(axis=1))
+    
+    return np.sqrt(((activ[0] - activ[1:])**2).sum(axis=1)) #########(Maximum dPhi value will be 1 or -1)
 
 
 
@@ -1083,12 +1398,16 @@ def sumOfSquares(epithelium: Epithelium, odorscene: Odorscene, dn: list[int], fi
 ## Maximum dpsi value = # of receptors in epithelium (if the first odorscene
 ## always activates the receptor = 1.0 and the other activates = 0.0)
 
-def sumOfSquaresVectorized(epithelium: Epithelium, odorscene: Odorscene, dn, repIndex: int, fixed=False, c=1, gl: layers.GlomLayer=None): 
+def sumOfSquaresVectorized(epithelium: Epithelium, odorscene: Odorscene, dn, repIndex: int, fixed=False, c=1, gl: layers.GlomLayer=None,
+                           activ: Optional[np.ndarray] = None, connectome: Optional[Connectome] = None): 
     
     """Calculates differentiation between epithelium activation of odorscene before
     and after dn using sum of squares. Returns dpsi of the epithelium.
     If fixed=true, then efficacy will be fixed at 1 (only agonists)
     If c!=1, then use function to activate glom with 1:c ratio of Glom:Rec
+    activ = optional (2, # of recs) buffer that receives the activations of both odorscenes
+    connectome = optional glom:rec connections to use if c!=1 (see _dPsiFromActivations)
+    The odorscene after dn is made of the displaced copies odor.getOdors2()[repIndex].
     Precondtion: dn=list in correct dim"""
     
     logger.debug("Performing sumOfSquaresVecotrized.")
@@ -1096,97 +1415,17 @@ def sumOfSquaresVectorized(epithelium: Epithelium, odorscene: Odorscene, dn, rep
     #assert odorscene.dim== len(dn), "dimension not consistent with dn"
     gl = layers.GlomLayer() if gl is None else gl
 
-    dPsi = 0
-    recs2 = copy.deepcopy(epithelium.recs)
     gl.clear_activations() #Sets gl activations and recConn back to 0.0
     
+    #Both odorscenes are evaluated as one (2, R, L) batch
+    odors = odorscene.odors
+    odors2 = [odor.getOdors2()[repIndex] for odor in odors]
+    locs = [[odor.loc for odor in odors], [odor2.loc for odor2 in odors2]]
+    conc = np.array([[odor.conc for odor in odors], [odor2.conc for odor2 in odors2]])
+    activ, totOcc = epithelium.compiled.activation(locs, conc, fixed, out=activ)
+    odoAmt = epithelium.compiled.adjacentCounts([odor.loc for odor in odors])
     
-    #print("before loop levl 1:" + str(time.time()))
-    counter = 0 #for storing info in rec2
-    for rec in epithelium.recs:
-        
-        #Set everything to 0
-        activ_1 = 0.0
-        activ_2 = 0.0
-        odors: list[Ligand] = []
-        odors2: list[Ligand] = []
-        rec._activ = 0.0
-        rec._occ = 0.0
-        rec._odoAmt = 0.0
-        df = 0
-        df2 = 0
-        
-        '''
-        affs = rec.affs
-        effs = rec.effs
-        '''
-        oi = 0
-        for odor in odorscene.odors:
-            # print(counter)
-            # print(len(odor._affs), len(odor._effs))
-            odor.aff = odor._affs[counter]
-            odor.eff = odor._effs[counter]
-            
-            newOdors = odor.getOdors2()
-            odor2 = newOdors[repIndex]
-            
-            odor2.aff = odor2._affs[counter]
-            odor2.eff = odor2._effs[counter]
-                
-            #df += prepareOdor(odor, rec, fixed, odors, effScale) 
-            odors.append(odor)
-            df += odor.conc/odor._aff
-            #print("time elapsed prepareOdor:"+ str((time.time() - startTime)))
-            
-            #Second Odorscene
-
-            odors2.append(odor2)
-            df2 += odor2.conc/odor2._aff
-            
-            #df2 += prepareOdor(newOdor, rec, fixed, odors2, effScale) 
-                
-            oi+=1
-            
-        #i = 1
-        for odor in odors:
-        # for odor in odorscene.odors:    
-            #startTime = time.time()
-            odor.occ = 1/(1+((odor.aff/odor.conc)*(1+df-odor.conc/odor.aff))**config.HILL_COEFF) # m=1
-            # print("time elapsed odor setOcc:"+ str((time.time() - startTime)))
-            activ_1 += odor.eff * odor.occ
-            rec._occ += odor.occ #Solely for printing individual receptor activations in experiments
-            #startTime = time.time()
-            rec._odoAmt += adjOdors(rec, odor)
-            #print("time elapsed adjOdors:"+ str((time.time() - startTime)))
-            #print(str(i) + " activation due to odorscene 1: " + str(activ_1))
-            #i += 1
-        #i = 1
-        
-        rec.activ = activ_1 #Solely for printing individual receptor activations in experiments
-        
-        for odor2 in odors2:
-            odor2.occ = 1/(1+((odor2.aff/odor2.conc)*(1+df2-odor2.conc/odor2.aff))**config.HILL_COEFF) # m=1
-            activ_2 += odor2.eff * odor2.occ
-        
-        recs2[counter].activ = activ_2
-        
-        dPhi = activ_1-activ_2 #########(Maximum value will be 1 or -1 = make sure this is true)
-        dPsi += dPhi**2
-        
-        counter += 1
-    
-    if c != 1:
-        gl2 = copy.deepcopy(gl)
-
-        conn = glomRecConnNew(epithelium.recs, gl, c, [])
-        glomRecConnNew(recs2, gl2, c, conn)
-
-        #count = 0
-        dPsi = 0
-        for count, glItem in enumerate(gl):
-            dPhi = glItem.activ-gl2[count].activ
-            dPsi += dPhi**2
-    return math.sqrt(dPsi)
+    return float(_dPsiFromActivations(epithelium, activ, totOcc[0], odoAmt, c, gl, connectome)[0])
 
 # TODO: double check effScale type, and perhaps decouple odor preparation from addition to odors collection
 def prepareOdor(odor: Ligand, rec: Receptor, fixed: bool, odors: list[Ligand], effScale: int): 
@@ -1240,67 +1479,11 @@ def sumOfSquares2(epithelium: Epithelium, odorscene1: Odorscene, odorscene2: Odo
     #assert len(odorscene1.odors) == len(odorscene2.odors), "two odorscenes don't have the same number of ligands to compare"
     config.PEAK_AFFINITY = -8     # literally 10e-8, not influenced by minimum_affinity value
     minimum_affinity = 2   # asymptotic affinity exponent, negligible
-    dPsi = 0
-    for rec in epithelium.recs:
-        #Set everything to 0
-        activ_1 = 0.0
-        activ_2 = 0.0
-        odors: list[Ligand] = []
-        odors2: list[Ligand] = []
-        df = 0
-        df2 = 0
-        dphi = 0
-        effScale = float(mvn.pdf(rec.mean, rec.mean, rec.covE)  ) 
-        
-        i = 0
-        while i < len(odorscene1.odors):
-            #First odorscene
-            odor = odorscene1.odors[i]
-            aff = mvn.pdf(odor.loc, rec.mean, rec.covA)
-            aff = aff / rec.scale #Scales it from 0 to 1
-            #if aff > 1e-128:   #Need so don't divide by 0 when calc df
-            #Now convert gaussian aff to kda
-            aff = 10**((aff * (config.PEAK_AFFINITY - minimum_affinity)) + minimum_affinity)
-            odor.aff = float(aff)
-            if fixed:
-                odor.eff = 1.0
-            else:
-                eff = mvn.pdf(odor.loc, rec.mean, rec.covE)
-                eff = float(eff) / effScale #Scales it from 0 to 1
-                odor.eff = eff
-            odors.append(odor)
-            df += odor.conc/odor.aff
-              
-            odor2 = odorscene2.odors[i]
-            aff2 = mvn.pdf(odor2.loc, rec.mean, rec.covA)
-            aff2 = aff2 / rec.scale #Scales it from 0 to 1
-            #if aff2 > 1e-128:   #Need so don't divide by 0 when calc df
-            #Now convert gaussian aff to kda
-            aff2 = 10**((aff2 * (config.PEAK_AFFINITY - minimum_affinity)) + minimum_affinity)
-            odor2.aff = float(aff2)
-            if fixed:
-                odor2.eff = 1.0
-            else:
-                eff2 = mvn.pdf(odor2.loc, rec.mean, rec.covE)
-                eff2 = float(eff2) / effScale #Scales it from 0 to 1
-                odor2.eff = eff2
-            odors2.append(odor2)
-            df2 += odor2.conc/odor2.aff
-            i += 1
-            
-        i = 0
-        while i < len(odors):
-            odor = odors[i]
-            odor.occ = 1/(1+((odor.aff/odor.conc)*(1+df-odor.conc/odor.aff))**config.HILL_COEFF) # m=1
-            activ_1 += odor.eff * odor.occ
-                
-            odor2 = odors2[i]
-            odor2.occ = 1/(1+((odor2.aff/odor2.conc)*(1+df2-(odor2.conc/odor2.aff)))**config.HILL_COEFF) # m=1
-            activ_2 += odor2.eff * odor2.occ                
-            i+=1
-                
-        dPhi = activ_1-activ_2 #########(Maximum value will be 1 or -1 = make sure this is true)
-        dPsi += dPhi**2
+    locs = np.array([[odor.loc for odor in odorscene1.odors], [odor2.loc for odor2 in odorscene2.odors]])
+    conc = np.array([[odor.conc for odor in odorscene1.odors], [odor2.conc for odor2 in odorscene2.odors]])
+    aff, eff = epithelium.compiled.affinityEfficacy(locs, fixed, minimum=minimum_affinity)
+    _, activ, _ = engine.occupancy(aff, eff, conc)
+    dPsi = ((activ[0] - activ[1])**2).sum() #########(Maximum dPhi value will be 1 or -1)
     return math.sqrt(dPsi)
 
 
@@ -1341,6 +1524,7 @@ def dPsiBarCalcAnglesOrig(epithelium: Epithelium, odorscene: Odorscene, r, fixed
     amtOfDir = 0
     totalDpsi = 0
     dim = odorscene.dim
+    activ = np.empty((2, len(epithelium.recs))) #Reused by every direction
     while amtOfDir < rep:
         #Create randomized list of angles
         angles = []
@@ -1362,7 +1546,7 @@ def dPsiBarCalcAnglesOrig(epithelium: Epithelium, odorscene: Odorscene, r, fixed
                     dn[i] *= math.sin(angles[j])
                     j+=1
                 dn[i] *= math.cos(angles[i])
-        totalDpsi += sumOfSquares(epithelium, odorscene, dn, fixed, c, gl)
+        totalDpsi += sumOfSquares(epithelium, odorscene, dn, fixed, c, gl, activ)
         amtOfDir += 1
 
     if text != None:
@@ -1371,53 +1555,69 @@ def dPsiBarCalcAnglesOrig(epithelium: Epithelium, odorscene: Odorscene, r, fixed
 
 
 # HERE
-def dPsiBarCalcAngles(epithelium: Epithelium, odorscene: Odorscene, r, fixed=False, text=None, c=1, gl: layers.GlomLayer = None):
+def dPsiBarCalcAngles(epithelium: Epithelium, odorscene: Odorscene, r, fixed=False, text=None, c=1, gl: layers.GlomLayer = None,
+                      connectome: Optional[Connectome] = None):
     """Calculates dPsiBar = the average dPsi value of an odorscene that
     changes location by the same amplitude r but "rep" different directions based on
     randomized angles."""
     gl = layers.GlomLayer() if gl is None else gl
-    #print("start of dPsiBarCalcAngles")
-    gl = layers.GlomLayer() if gl is None else gl
-    
-    #rep = 10.0
-    rep = config.ANGLES_REP
-    amtOfDir = 0
-    totalDpsi = 0
     
-    while amtOfDir < rep: 
-        dn = []
-        totalDpsi += sumOfSquaresVectorized(epithelium, odorscene, dn, amtOfDir, fixed, c, gl)
-        
-        amtOfDir += 1
+    dPsiBar, _ = dPsiBarCalcAnglesBatch(epithelium, odorscene, fixed, c, gl, connectome)
         
     if text != None:
         recToText(epithelium, gl, c, text)
-    return totalDpsi/rep
+    return dPsiBar
+
+def dPsiBarCalcAnglesBatch(epithelium: Epithelium, odorscene: Odorscene, fixed=False, c=1,
+                           gl: layers.GlomLayer = None, connectome: Optional[Connectome] = None) -> tuple[float, np.ndarray]:
+    """Calculates dPsiBar for all config.ANGLES_REP directions at once.
+    The odorscene and every displaced odorscene (odor.getOdors2()) are evaluated as one
+    (1 + directions, recs, ligands) batch, so the activation of the original odorscene is only calculated once.
+    If c!=1, the same glom:rec connections (connectome, see _dPsiFromActivations) are used for every direction.
+    Returns (dPsiBar, dPsi) where dPsi is the array of dPsi values of each direction."""
+    logger.debug("Performing dPsiBarCalcAnglesBatch.")
+    gl = layers.GlomLayer() if gl is None else gl
+    gl.clear_activations() #Sets gl activations and recConn back to 0.0
+    
+    activ, totOcc, odoAmt = _anglesActivations(epithelium, odorscene, fixed)
+    dPsi = _dPsiFromActivations(epithelium, activ, totOcc[0], odoAmt, c, gl, connectome)
+    return float(dPsi.mean()), dPsi
+
+def _anglesActivations(epithelium: Epithelium, odorscene: Odorscene, fixed=False
+                       ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the (1 + directions, recs) activations and total occupancies of the odorscene and of its
+    config.ANGLES_REP displaced odorscenes, and the (recs,) number of its ligands adjacent to each receptor.
+    See dPsiBarCalcAnglesBatch."""
+    rep = config.ANGLES_REP
+    odors = odorscene.odors
+    scenes = [odors] + [[odor.getOdors2()[amtOfDir] for odor in odors] for amtOfDir in range(rep)]
+    locs = [[odor.loc for odor in scene] for scene in scenes]
+    conc = np.array([[odor.conc for odor in scene] for scene in scenes])
+    activ, totOcc = epithelium.compiled.activation(locs, conc, fixed)
+    return activ, totOcc, epithelium.compiled.adjacentCounts([odor.loc for odor in odors])
+
+def dPsiOdorsceneBatch(epithelium: Union[Epithelium, CompiledEpithelium], batch: OdorsceneBatch, fixed=False) -> np.ndarray:
+    """Returns the (S, D) dPsi of every odorscene in batch against each of its D displacements
+    (batch.dns), evaluating all odorscenes and directions in one call. Uses a 1:1 Glom:Rec ratio.
+    If fixed=true, then efficacy will be fixed at 1 (only agonists)
+    Precondition: batch.dns is not None"""
+    locs = np.concatenate((batch.locs[:, np.newaxis], batch.displacedLocs), axis=1)
+    activ, _ = _compiled(epithelium).activation(locs, batch.conc[:, np.newaxis], fixed, batch.mask[:, np.newaxis])
+    return np.sqrt(((activ[:, :1] - activ[:, 1:])**2).sum(axis=2))
 
 # TODO: Rewrite all of this. (conversions, string handling, etc)
 def recToText(epithelium: Epithelium, gl: list[cells.Glom], c: int, text: Text):
     """Stores rec activ and rec occ from epi into a text obj"""
     if c != 1:
-        num = convStrToNum(text._st[-4:])
+        num = convStrToNum(text._tail)
     if text._name == "exp1":
-        for rec in epithelium.recs:
-            text._st += f",{rec._activ}"
-        for rec in epithelium.recs:
-            text._st += f",{rec._occ}"
-        for rec in epithelium.recs:
-            text._st += f",{rec._odoAmt}"
-        text._st += '\n'
+        text.write("".join([f",{rec._activ}" for rec in epithelium.recs] + [f",{rec._occ}" for rec in epithelium.recs]
+                           + [f",{rec._odoAmt}" for rec in epithelium.recs]) + '\n')
     elif text._name == "exp2":
-        n = 0
-        for rec in epithelium.recs:
-            text._st += f"Rec{n},{rec._activ},{rec._occ},{rec._odoAmt}\n"
-            n += 1
-        text._st += '\n' #extra space
+        text.write("".join([f"Rec{n},{rec._activ},{rec._occ},{rec._odoAmt}\n" for n, rec in enumerate(epithelium.recs)])
+                   + '\n') #extra space
     if c!= 1:
-        text._st2 += "glom_numOdo=" + str(num)
-        for glom in gl:
-            text._st2 += "," + str(glom._activation)
-        text._st2 += '\n'
+        text.writeGlom("glom_numOdo=" + str(num) + "".join(["," + str(glom._activation) for glom in gl]) + '\n')
         
 def convStrToNum(s: str):
     """Given string s with either 3, 2 or 1 num at the end, converts that num to a int"""
@@ -1431,14 +1631,20 @@ def convStrToNum(s: str):
     return num
 
 
-def colorMapSumOfSquares(epithelium: Epithelium, odorscenes: list[Odorscene], r, qspace: QSpace):
-    """Creates a colorMap with Q-Space as the x and y axis and dPsi_bar as the
-    color for each ligand. dPsi_bar = avg differentiation that occurs in each
-    point in Q-Space given many small changes in the odor at that loc.
-    Preconditions: Odorscenes is a list of odorscenes containing one ligand. All the ligands
-    fill up Qspace. dim = 2d
-    WARNING: only works in 2D"""
+def colorMapDPsiBars(epithelium: Epithelium, odorscenes: list[Odorscene], r, qspace: QSpace) -> list[list[float]]:
+    """Returns the graph of colorMapSumOfSquares: a grid of config.PIXEL_PER_Q_UNIT pixels per
+    Q-Space unit holding the dPsi_bar of each odorscene's ligand at its location.
+    If config.COLOR_MAP_RASTER, the dPsi_bars come from dPsiBarRaster, in 10 directions shared by every pixel,
+    and each odorscene's pixel gets the value at the pixel's corner.
+    Preconditions: Odorscenes is a list of odorscenes containing one ligand. dim = 2d"""
     assert odorscenes[0].dim==2, "dimension must be 2D!"
+    if config.COLOR_MAP_RASTER:
+        raster = dPsiBarRaster(epithelium, qspace, odorscenes[0].odors[0].conc, dPsiBarCalcDns(odorscenes[0], r, 10))
+        graph = np.zeros_like(raster)
+        for odorscene in odorscenes:
+            x, y = (int(config.PIXEL_PER_Q_UNIT*loc) for loc in odorscene.odors[0].loc)
+            graph[y, x] = raster[y, x]
+        return graph.tolist()
     ##Create graph of all 0's
     graph: list[list[int]] = []
     maxX = qspace.size[0][1]
@@ -1463,6 +1669,53 @@ def colorMapSumOfSquares(epithelium: Epithelium, odorscenes: list[Odorscene], r,
 
         graph[int(config.PIXEL_PER_Q_UNIT*(odorscene.odors[0].loc[1]))][int(config.PIXEL_PER_Q_UNIT*(odorscene.odors[0].loc[0]))] = dPsiBar
     
+    return graph
+
+def dPsiBarRaster(epithelium: Union[Epithelium, CompiledEpithelium], qspace: QSpace, conc: float,
+                  dns: list[list[float]]) -> np.ndarray:
+    """Returns the (y pixels X x pixels) dPsiBar of a single ligand with concentration conc at the corner of
+    every pixel of the 2D qspace, with config.PIXEL_PER_Q_UNIT pixels per Q-Space unit. The dPsi of each pixel
+    is averaged over the displacements in dns, like dPsiBarCalcAnglesOrig (efficacy fixed at 1, c=1).
+    The receptor activations are calculated once, on a raster that reaches past the qspace by the length of
+    the displacements. The activations after a displacement are a bilinear blend of four shifted views of
+    that raster, which is exact when the displacement is a whole number of pixels.
+    Precondition: qspace is 2D"""
+    assert len(qspace.size) == 2, "dimension must be 2D!"
+    ppq = config.PIXEL_PER_Q_UNIT
+    cols, rows = (math.ceil(high * ppq) for _, high in qspace.size)
+    shifts = np.asarray(dns, dtype=np.float64) * ppq
+    margin = int(np.ceil(np.abs(shifts).max(initial=0))) + 1
+    
+    #(y, x, recs) activations of a ligand at every pixel corner, margin included
+    ys, xs = np.meshgrid(np.arange(-margin, rows+margin), np.arange(-margin, cols+margin), indexing='ij')
+    locs = np.stack((xs, ys), axis=-1).reshape(-1, 1, 2) / ppq
+    activ, _ = _compiled(epithelium).activation(locs, [conc], True)
+    activ = activ.reshape(xs.shape + (-1,))
+    
+    def view(dy: int, dx: int) -> np.ndarray:
+        return activ[margin+dy:margin+dy+rows, margin+dx:margin+dx+cols]
+    
+    dPsiBar = np.zeros((rows, cols))
+    for dx, dy in shifts:
+        fx, fy = math.floor(dx), math.floor(dy)
+        tx, ty = dx - fx, dy - fy
+        moved = ((1-ty)*(1-tx)) * view(fy, fx) + ((1-ty)*tx) * view(fy, fx+1) \
+            + (ty*(1-tx)) * view(fy+1, fx) + (ty*tx) * view(fy+1, fx+1)
+        dPsiBar += np.sqrt(((view(0, 0) - moved)**2).sum(axis=-1))
+    return dPsiBar / len(shifts)
+
+def colorMapSumOfSquares(epithelium: Epithelium, odorscenes: list[Odorscene], r, qspace: QSpace,
+                         graph: Optional[list[list[float]]] = None):
+    """Creates a colorMap with Q-Space as the x and y axis and dPsi_bar as the
+    color for each ligand. dPsi_bar = avg differentiation that occurs in each
+    point in Q-Space given many small changes in the odor at that loc.
+    graph = precalculated result of colorMapDPsiBars, if already known
+    Preconditions: Odorscenes is a list of odorscenes containing one ligand. All the ligands
+    fill up Qspace. dim = 2d
+    WARNING: only works in 2D"""
+    if graph is None:
+        graph = colorMapDPsiBars(epithelium, odorscenes, r, qspace)
+
     # print("-----------------------------")
     # print(graph)
 
@@ -1606,7 +1859,7 @@ def colorMapSumOfSquares(epithelium: Epithelium, odorscenes: list[Odorscene], r,
         ax.set_xlim(qspace.size[0])
         ax.set_ylim(qspace.size[0])
 
-    im = matplotlib.pylab.imshow(graph, cmap=matplotlib.pylab.cm.YlOrRd, interpolation="nearest", vmin=0, vmax=1, origin="lower", extent=[0,4,0,4]) #Black = fully active
+    im = pylab.imshow(graph, cmap=pylab.cm.YlOrRd, interpolation="nearest", vmin=0, vmax=1, origin="lower", extent=[0,4,0,4]) #Black = fully active
 
     plt.title("Differentiation in QSpace")
     plt.xlabel("X")
@@ -1620,16 +1873,16 @@ def colorMapSumOfSquares(epithelium: Epithelium, odorscenes: list[Odorscene], r,
     #Not closing it will add odor locations to it
     plt.close()
 
-def dPsiBarCalcDns(odorscene: Odorscene, r, rep: int):
-    """Calculates dPsiBar = the average dPsi value of an odorscene that
-    changes location by the same amplitude r but "rep" different directions based on
-    randomized angles."""
+def dPsiBarCalcDns(odorscene: Union[Odorscene, OdorsceneBatch], r, rep: int) -> list[list[float]]:
+    """Returns "rep" displacements (dn) of amplitude r, each in a different direction
+    based on randomized angles. Only the dim of odorscene is used."""
 
     #print("start of dPsiBarCalcDns")
 
     
     amtOfDir = 0
     dim = odorscene.dim
+    dns = []
     
     while amtOfDir < rep:
         
@@ -1665,26 +1918,246 @@ def dPsiBarCalcDns(odorscene: Odorscene, r, rep: int):
                 
             #print("end of 2nd for:" + str(i) +":"+ str(time.time()))
         
-       
+        dns.append(dn)
         amtOfDir += 1
 
-    return dn
-
-@utils.verbose_if_debug
-def dPsiBarSaturation(epithelium: Epithelium, r, qspace: QSpace, pdfName: str, labelName: str,
-                      excelName: str, fixed=False, c=1, plotTitle="", close=False, purp='', graphIt=True):
-    """
-    Define x amount of odorscenes with one ligand per odorscene, then with two ligands...
-    then calculate dPsibar for each group of odorscene and graph to find saturation at certain
-    ligand number.
-    if fixed=true than efficacy=1
-    if close = True, then graph is closed after this round of data.
-    precondition: c = integer, fixed and close = Boolean
-    """
-    
-    startTime = time.time()
-    logger.debug("start of dPsiBarSaturation:" + str(startTime))
-
+    return dns
+
+def _saturationScenes(r, qspace: QSpace, xaxis: list[int], conc: float) -> OdorsceneBatch:
+    """Creates one repetition of dPsiBarSaturation's odorscenes, one with xaxis[k] ligands for each k.
+    Returns them as a batch whose dns are the config.ANGLES_REP displacements of each odorscene.
+    If config.NESTED_ODORSCENES, odorscene k is the first xaxis[k] ligands of one set of max(xaxis) ligands,
+    so each odorscene extends the one before it, and every odorscene is displaced in the same directions.
+    The batch's arrays are then read only views of that set."""
+    if config.NESTED_ODORSCENES:
+        assert all(a < b for a, b in zip(xaxis, xaxis[1:])), "xaxis must be increasing for nested odorscenes"
+        largest = OdorsceneBatch.create([xaxis[-1]], conc, qspace, r=r)
+        shape = (len(xaxis),) + largest.locs.shape[1:]
+        return OdorsceneBatch(np.broadcast_to(largest.locs, shape), np.broadcast_to(largest.conc, shape[:2]), xaxis,
+                              dns=np.broadcast_to(largest.dns, (len(xaxis),) + largest.dns.shape[1:]))
+    return OdorsceneBatch.create(xaxis, conc, qspace, r=r)
+
+def _saturationDPsiBars(epithelium: Epithelium, batch: OdorsceneBatch, fixed: bool, c: int, gl: layers.GlomLayer,
+                        text: Optional[Text]) -> tuple[list[float], tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """Returns the dPsiBar of each odorscene of batch (made by _saturationScenes) against its dns, storing rec
+    activations in text (if not None). Gives the same values as dPsiBarCalcAngles on each of batch.toOdorscenes().
+    Also returns the (odorscenes X recs) activ, occ and odoAmt of the recs and, if c!=1, the
+    (odorscenes X gloms) glom activations.
+    With config.NESTED_ODORSCENES (and no config.SPARSE_CUTOFF_SD), the activations of every odorscene
+    come from one pass over the largest one, see engine.prefix_occupancy.
+    If c!=1 and config.CONNECTOME_POLICY is "repetition", every odorscene uses the same glom:rec connections."""
+    connectome = Connectome(len(epithelium.recs), c) if c != 1 and config.CONNECTOME_POLICY == "repetition" else None
+    rep = config.ANGLES_REP
+    counts = batch.counts
+    if config.NESTED_ODORSCENES: #Every odorscene is the start of the last one
+        locs, conc, dns = batch.locs[-1, :counts[-1]], batch.conc[-1, :counts[-1]], batch.dns[-1]
+        bounds = [(0, j) for j in counts]
+    else: #The ligands of every odorscene, one odorscene after the other
+        locs, conc, dns = batch.locs[batch.mask], batch.conc[batch.mask], np.repeat(batch.dns, counts, axis=0)
+        stops = np.cumsum(counts)
+        bounds = list(zip(stops - counts, stops))
+    locs2 = locs[:, np.newaxis] + dns #(ligands X directions X Q)
+
+    #(recs X ligands) and (recs X ligands X rep) affinity and efficacy matrices, allocated once.
+    #In sparse mode only nearby pairs are evaluated, per odorscene
+    compiled = epithelium.compiled
+    if config.SPARSE_CUTOFF_SD is None:
+        affs, effs = compiled.affinityEfficacy(locs, fixed)
+        affs2, effs2 = compiled.affinityEfficacy(locs2.reshape(-1, locs2.shape[2]), fixed)
+        affs2 = affs2.reshape((len(compiled),) + locs2.shape[:2])
+        effs2 = effs2.reshape((len(compiled),) + locs2.shape[:2])
+        for index, rec in enumerate(epithelium.recs):
+            rec.affs = affs[index]
+            rec.effs = effs[index]
+        if config.NESTED_ODORSCENES:
+            return _nestedDPsiBars(epithelium, counts, locs, conc, affs, effs, affs2, effs2, c, gl, text, connectome)
+
+    dPsiBars = []
+    cells = np.empty((3, len(batch), len(epithelium.recs)))
+    glomActiv = np.empty((len(batch), len(gl))) if c != 1 else None
+    for k, (start, stop) in enumerate(bounds):
+        if text is not None:
+            text.write("Odorscene"+str(k+1))
+        #Each odorscene is evaluated with its displaced copies, as in dPsiBarCalcAnglesBatch
+        gl.clear_activations()
+        sceneConc = np.tile(conc[start:stop], (1 + rep, 1))
+        if config.SPARSE_CUTOFF_SD is None: #Columns of the ligands of the odorscene
+            aff = np.concatenate((affs[np.newaxis, :, start:stop], np.moveaxis(affs2[:, start:stop], -1, 0)))
+            eff = np.concatenate((effs[np.newaxis, :, start:stop], np.moveaxis(effs2[:, start:stop], -1, 0)))
+            _, activ, totOcc = engine.occupancy(aff, eff, sceneConc)
+        else:
+            sceneLocs = np.concatenate((locs[np.newaxis, start:stop], np.moveaxis(locs2[start:stop], 1, 0)))
+            activ, totOcc = compiled.activation(sceneLocs, sceneConc, fixed)
+        odoAmt = compiled.adjacentCounts(locs[start:stop])
+        dPsiBars.append(float(_dPsiFromActivations(epithelium, activ, totOcc[0], odoAmt, c, gl, connectome).mean()))
+        if text is not None:
+            recToText(epithelium, gl, c, text)
+        cells[:, k] = activ[0], totOcc[0], odoAmt
+        if c != 1:
+            glomActiv[k] = [glom._activation for glom in gl]
+    return dPsiBars, (cells[0], cells[1], cells[2], glomActiv)
+
+def _nestedDPsiBars(epithelium: Epithelium, counts: np.ndarray, locs: np.ndarray, conc: np.ndarray, affs: np.ndarray,
+                    effs: np.ndarray, affs2: np.ndarray, effs2: np.ndarray, c: int, gl: layers.GlomLayer,
+                    text: Optional[Text], connectome: Optional[Connectome] = None) -> tuple[list[float], tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """_saturationDPsiBars for nested odorscenes, where odorscene k is the first counts[k] ligands of locs,
+    with concentrations conc. affs and effs are (recs X ligands), affs2 and effs2 (recs X ligands X directions).
+    Gives the same values as calling dPsiBarCalcAngles on each odorscene."""
+    rep = config.ANGLES_REP
+    aff = np.concatenate((affs[np.newaxis], np.moveaxis(affs2[..., :rep], -1, 0)))
+    eff = np.concatenate((effs[np.newaxis], np.moveaxis(effs2[..., :rep], -1, 0)))
+    activ, totOcc = engine.prefix_occupancy(aff, eff, conc, counts)
+    #Each ligand is counted once, as a one ligand odorscene
+    odoAmt = np.cumsum(epithelium.compiled.adjacentCounts(locs[:, np.newaxis]), axis=0)[counts-1]
+
+    dPsiBars = []
+    cells = np.empty((3, len(counts), len(epithelium.recs)))
+    glomActiv = np.empty((len(counts), len(gl))) if c != 1 else None
+    for k in range(len(counts)):
+        if text is not None:
+            text.write("Odorscene"+str(k+1))
+        gl.clear_activations()
+        dPsiBars.append(float(_dPsiFromActivations(epithelium, activ[k], totOcc[k, 0], odoAmt[k], c, gl, connectome).mean()))
+        if text is not None:
+            recToText(epithelium, gl, c, text)
+        cells[:, k] = activ[k, 0], totOcc[k, 0], odoAmt[k]
+        if c != 1:
+            glomActiv[k] = [glom._activation for glom in gl]
+    return dPsiBars, (cells[0], cells[1], cells[2], glomActiv)
+
+def _dPsiBarSaturationRep(epithelium: Epithelium, r, qspace: QSpace, xaxis: list[int], conc: float, fixed: bool,
+                          c: int, seed: np.random.SeedSequence):
+    """Runs one repetition of dPsiBarSaturation with its own random stream, for use in worker processes.
+    Returns (dPsiBars, cell values, text rows, glom text rows, odorscene at config.ODORSCENE_INDEX without dns)"""
+    with utils.seeded(seed):
+        batch = _saturationScenes(r, qspace, xaxis, conc)
+        text = Text("", "exp1")
+        gl = layers.GlomLayer.create(len(epithelium.recs))
+        dPsiBars, cells = _saturationDPsiBars(epithelium, batch, fixed, c, gl, text)
+    return dPsiBars, cells, text._st, text._st2, batch[config.ODORSCENE_INDEX].toOdorscenes(False)[0]
+
+_SATURATION_CONFIG = (
+    'ODOR_CONCENTRATION', 'PEAK_AFFINITY', 'MIN_AFFINITY', 'HILL_COEFF', 'ODOR_REPETITIONS', 'ANGLES_REP',
+    'GLOM_PENETRANCE', 'S_WEIGHTS', 'NUM_ROW', 'NUM_COL', 'CONSTANT_ATTACHMENTS', 'SCALABLE_GLOMS',
+    'CONNECTOME_POLICY', 'SPARSE_CUTOFF_SD', 'NESTED_ODORSCENES',
+    'DIST_TYPE_GAUSS', 'DIST_TYPE_UNIF', 'MU', 'SIG', 'ODORSCENE_INDEX', 'ODORSCENE_REP_NUMBER',
+    'USE_MOCK_ODORS_EVEN_WHEN_RUNNING_CALCS', 'USE_MOCK_RECEPTORS_EVEN_WHEN_RUNNING_CALCS'
+)
+"""config settings that change the results of dPsiBarSaturation"""
+
+def _runKey(params: dict[str, Any], arrays: Iterable[np.ndarray] = ()) -> str:
+    """Returns a hash of params, arrays, the config settings in _SATURATION_CONFIG and the current state of utils.RNG"""
+    h = hashlib.sha256()
+    for array in arrays:
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(np.ascontiguousarray(array).tobytes())
+    params = {**params, "version": results.CACHE_VERSION, "config": {key: getattr(config, key) for key in _SATURATION_CONFIG},
+              "rng": utils.RNG.bit_generator.state}
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def saturationKey(epithelium: Union[Epithelium, CompiledEpithelium], r, qspace: QSpace, fixed=False, c=1,
+                  parallel=False) -> str:
+    """Returns a hash of everything that determines the results of runDPsiBarSaturation: the receptor arrays,
+    the arguments, the config settings in _SATURATION_CONFIG and the current state of utils.RNG.
+    If config.CONNECTOME_POLICY is "epithelium", the epithelium's connections (if built) are included too.
+    parallel = True if the repetitions are run with workers (they then draw from spawned seeds)."""
+    compiled = _compiled(epithelium)
+    arrays = (compiled.ids, compiled.mean, compiled.sdA, compiled.sdE)
+    if c != 1 and config.CONNECTOME_POLICY == "epithelium" and _connectomeKey(c) in getattr(epithelium, "_connectomes", {}):
+        arrays += (epithelium.connectome(c).weights.indices,)
+    return _runKey({"r": r, "qspace": qspace.size, "fixed": fixed, "c": c, "parallel": parallel}, arrays)
+
+def saturationCache() -> Optional[SaturationCache]:
+    """Returns the cache of config.SATURATION_CACHE_DIR, or None if it isn't set."""
+    if config.SATURATION_CACHE_DIR is None:
+        return None
+    return SaturationCache(str(config.SATURATION_CACHE_DIR), config.SATURATION_CACHE_SIZE)
+
+def _shownMeta(odorscene: Optional[Odorscene]) -> Optional[dict[str, Any]]:
+    """Returns the ids, locations and concentrations of the ligands of odorscene in a JSON friendly dict"""
+    if odorscene is None:
+        return None
+    return {"id": odorscene.id, "odors": [[odor.id, [float(x) for x in odor.loc], odor.conc] for odor in odorscene.odors]}
+
+def _shownOdorscene(shown: Optional[dict[str, Any]]) -> Optional[Odorscene]:
+    """Inverse of _shownMeta"""
+    if shown is None:
+        return None
+    return Odorscene(shown["id"], [Ligand(id_, loc, conc) for id_, loc, conc in shown["odors"]])
+
+def _savedSaturation(saved: SaturationResults, epithelium: Epithelium, qspace: QSpace, c: int, text: Optional[Text],
+                     drawEllipse: bool, storeName: Optional[str]):
+    """Returns the outputs of runDPsiBarSaturation from the results of an earlier run (a cache entry or a
+    finished checkpoint), writing its rows to text and leaving utils.RNG as that run left it."""
+    if text is not None:
+        for i in range(saved.repetitions):
+            rows, glomRows = saved.rows(i)
+            text.write(rows)
+            if c != 1:
+                text.writeGlom(glomRows)
+    xaxis = saved.xaxis.tolist()
+    odorscenesArray = [[None]*saved.repetitions for x in xaxis]
+    if config.ODORSCENE_REP_NUMBER < saved.repetitions:
+        odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER] = _shownOdorscene(saved.meta["shown"])
+    if drawEllipse:
+        drawEllipseGraph(qspace, epithelium, odorscenesArray, useMockData=False)
+    # Set after drawing, since the ellipse angles are random
+    utils.RNG.bit_generator.state = saved.meta["rngState"]
+    store = saved if storeName is None else saved.save(storeName + results.STORE_EXT)
+    return xaxis, saved.dpsi.tolist(), text, odorscenesArray, store
+
+def _saveCheckpoint(store: SaturationResults, completed: int, yaxis: list[float], odorscenesArray: list[list[Optional[Odorscene]]]):
+    """Writes the cell values of the first completed repetitions of store to disk, along with the yaxis sums
+    and the state of utils.RNG needed to continue from there"""
+    shown = None
+    if config.ODORSCENE_REP_NUMBER < completed:
+        shown = _shownMeta(odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER])
+    store.meta.update({"completed": completed, "yaxisSums": list(yaxis), "rngState": utils.RNG.bit_generator.state,
+                       "shown": shown})
+    store.flush()
+    logger.debug(f"Checkpointed {completed} repetitions in {store.path}")
+
+def runDPsiBarSaturation(epithelium: Epithelium, r, qspace: QSpace, fixed=False, c=1, workers: Optional[int] = None,
+                         drawEllipse=True, excelName: Optional[str] = None, storeName: Optional[str] = None,
+                         csv=True) -> tuple[list[int], list[float], Optional[Text], list[list[Optional[Odorscene]]],
+                                           Optional[SaturationResults]]:
+    """Calculates the data of dPsiBarSaturation without saving or graphing it.
+    Returns (xaxis, yaxis, text, odorscenesArray, store) where yaxis is the avg dPsiBar of each number of ligands
+    in xaxis, text holds the rec (and glom) activations and odorscenesArray[k][i] is the odorscene with
+    xaxis[k] ligands of repetition i. Only odorscenesArray[config.ODORSCENE_INDEX] is kept (without displaced
+    ligands), the others are None.
+    If drawEllipse = False, the receptor ellipse graph is left for the caller to draw.
+    If excelName is given, text is a TextStream that writes the rows to the excel docs of
+    saveDPsiBarSaturation as they are made, and saveDPsiBarSaturation only closes them.
+    store is the SaturationResults of the run. If storeName is given, it is stored in
+    storeName + results.STORE_EXT and the cell values are written there as they are made.
+    If csv = False, no text is kept (text is None).
+    If config.SATURATION_CACHE_DIR is set, results are reused from the cache when the key from saturationKey
+    matches, and utils.RNG is left in the state the run would have left it in. odorscenesArray then only holds
+    the odorscene at [config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER].
+    If config.CHECKPOINT_DIR is set, the completed repetitions, yaxis sums and utils.RNG state are saved there
+    at least every config.CHECKPOINT_INTERVAL seconds. If config.RESUME is also set, a run with the same
+    saturationKey continues from its checkpoint and gives the same outputs as if it had not been stopped.
+    If c!=1 and config.CONNECTOME_POLICY is "epithelium", the epithelium's connectome is built before anything else."""
+
+    if c != 1 and config.CONNECTOME_POLICY == "epithelium":
+        epithelium.connectome(c)
+    cache = saturationCache()
+    checkpointing = config.CHECKPOINT_DIR is not None
+    if cache is not None or checkpointing:
+        key = saturationKey(epithelium, r, qspace, fixed, c, workers is not None)
+    saved = None if cache is None else cache.get(key)
+    resumed = None
+    if checkpointing:
+        checkpointPath = os.path.join(str(config.CHECKPOINT_DIR), key + results.STORE_EXT)
+        if saved is None and config.RESUME and SaturationResults.is_store(checkpointPath):
+            resumed = SaturationResults.load(checkpointPath, writable=True)
+            if "completed" not in resumed.meta:
+                # Stopped before the first checkpoint, so there is nothing to resume
+                resumed = None
+            elif resumed.meta["completed"] == resumed.repetitions:
+                saved, resumed = resumed, None
     size = config.ODOR_REPETITIONS #amount of odorscenes we want to avg out
     #conc = 1e-5
     conc = config.ODOR_CONCENTRATION
@@ -1700,191 +2173,128 @@ def dPsiBarSaturation(epithelium: Epithelium, r, qspace: QSpace, pdfName: str, l
         st2 += "occ " + str(p) + ","
         st3 += "odoAmt " +str(p) + ","
         p += 1
-    text = Text(st + st2 +st3[:-1] + '\n', "exp1")
+    if not csv:
+        text = None
+    elif excelName is None:
+        text = Text(st + st2 +st3[:-1] + '\n', "exp1")
+    else:
+        text = TextStream(st + st2 +st3[:-1] + '\n', "exp1", excelName + ".csv", _glomActName(c, qspace) if c!=1 else None)
     
     #If c!=1, also hold info about glom activ
-    if c!=1:
+    if c!=1 and text is not None:
         string = "Glom,"
         string2 = ""
         p=0
         while p < len(gl):
             string2 += "activ " + str(p) + ","
             p += 1
-        text._st2 = string + string2 +'\n'
-    
+        text.writeGlom(string + string2 +'\n')
     
+    if saved is not None:
+        logger.info("Using the saved dPsiBarSaturation results in " + saved.path)
+        return _savedSaturation(saved, epithelium, qspace, c, text, drawEllipse, storeName)
     
     xaxis = [1,2,3,4,5,7,10,15,20,25,30,35,40,45,50,60,70,80,90,100,120,140,160,200,250,300,350,400] #If change here, change xAxis in expFromRnO
     yaxis = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
     
-    # TODO: Make this more clear
-    odorscenesArray: list[list[Odorscene]] = [[]*size for x in range(len(xaxis))]
-    pdfOdorLocsInput = []
-    affs = np.array([])
-    effs = np.array([])
-    
-
-    pdfOdorLocsInput2 = []
-    affs2 = np.array([])
-    effs2 = np.array([])
-
-    dns = []
-    rep = config.ANGLES_REP
-
-    ligandsArray =[]    
-    
-    for i in range(size):    
-        #k = 0
-        #while k < len(xaxis):
-            #j = xaxis[k]
-        for k, j in enumerate(xaxis):
-            n = 0
-            while n < j: 
-                odor = Ligand(n, createLoc(qspace), conc)
-                #ligandsArray.append(Ligand(i, createLoc(qspace), conc))
-                ligandsArray.append(odor)
-                pdfOdorLocsInput.append(odor.loc)
-                n+=1
-            #odorscenesArray[k].append(Odorscene(i, ligandsArray[k]))
-            odorscene = Odorscene(k, ligandsArray)
-            odorscenesArray[k].append(odorscene)
-            
-            #prepare pdf inputs for ordors2
-            dns = dPsiBarCalcDns(odorscene, r, rep)
-            
-            #Second odors
-            for oriOdor in odorscene.odors:
-                for i in range(rep):
-                    newLoc = []  #Calculating new location
-                    for index, dnItem in enumerate(dns):    
-                        newLoc.append(oriOdor.loc[index] + dnItem)
-                    newOdor = Ligand(oriOdor.id, newLoc, oriOdor.conc)
-                    pdfOdorLocsInput2.append(newOdor.loc)
-                    oriOdor.appendToOdors2(newOdor)
-            
-            ligandsArray =[]
-
-        #i += 1
-
-
-
-    #draw ellispse for all receptors
-    drawEllipseGraph(qspace, epithelium, odorscenesArray, useMockData=False)
-    
-    for rec in epithelium.recs:
-        affs_rec = mvn.pdf(pdfOdorLocsInput, rec.mean, rec.covA)
-        
-        affs_rec = affs_rec / rec.scale #Scales it from 0 to 1
-        #Now convert gaussian aff to kda
-        #startTime = time.time()
-        affs_rec = 10**((affs_rec * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY) ##config.PEAK_AFFINITY etc. are global variables
-        #print("time elapsed odor aff:"+ str((time.time() - startTime)))
-        #print("aff is " + str(aff))
-        
-        rec.affs = affs_rec
-        affs = np.append(affs,affs_rec)
+    meta = {"qspace": [list(size) for size in qspace.size], "numRecs": len(epithelium.recs), "c": c,
+            "fixed": fixed, "r": r, "conc": conc, "repetitions": size, "nested": config.NESTED_ODORSCENES}
+    done = 0
+    if resumed is not None:
+        store, done, yaxis = resumed, resumed.meta["completed"], list(resumed.meta["yaxisSums"])
+        logger.info(f"Resuming dPsiBarSaturation after {done} of {size} repetitions from {checkpointPath}")
+    else:
+        storePath = checkpointPath if checkpointing else None if storeName is None else storeName + results.STORE_EXT
+        store = SaturationResults.create(xaxis, size, len(epithelium.recs), len(gl) if c != 1 else 0, storePath, meta)
+    
+    #Rows of the repetitions done before resuming
+    for i in range(done):
+        if text is not None:
+            rows, glomRows = store.rows(i)
+            text.write(rows)
+            if c != 1:
+                text.writeGlom(glomRows)
+    lastCheckpoint = time.time()
+    
+    if workers is None:
+        #One batch of len(xaxis) odorscenes per repetition, with the displacements of each odorscene
+        batches = [_saturationScenes(r, qspace, xaxis, conc) for i in range(size)]
+        #Only the odorscenes drawn by drawEllipseGraph are made into Odorscene objects
+        odorscenesArray: list[list[Optional[Odorscene]]] = [[None]*size for x in range(len(xaxis))]
+        odorscenesArray[config.ODORSCENE_INDEX] = [batch[config.ODORSCENE_INDEX].toOdorscenes(False)[0] for batch in batches]
         
+        #draw ellispse for all receptors
+        if drawEllipse:
+            drawEllipseGraph(qspace, epithelium, odorscenesArray, useMockData=False)
+        if resumed is not None:
+            utils.RNG.bit_generator.state = resumed.meta["rngState"]
         
-        if not fixed:
-            effs_rec = mvn.pdf(pdfOdorLocsInput, rec.mean, rec.covE)
-            effs_rec = np.asarray(effs_rec,dtype=np.float64) / rec.effScale #Scales it from 0 to 1
-
-
-            effs = np.append(effs,effs_rec)
-            
-        else:
-            effs_rec = np.repeat(1.0, affs_rec.size)
-            effs = np.repeat(1.0, affs.size)
-        rec.effs = effs_rec
-
-
-
-        # now do odors2 calc
-        affs_rec2: Union[Number, np.ndarray] = mvn.pdf(pdfOdorLocsInput2, rec.mean, rec.covA)
-        
-        affs_rec2 = affs_rec2 / rec.scale #Scales it from 0 to 1
-        #Now convert gaussian aff to kda
-        #startTime = time.time()
-        affs_rec2 = 10**((affs_rec2 * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY) ##config.PEAK_AFFINITY etc. are global variables
-        affs2 = np.append(affs2,affs_rec2)
+        for i, batch in enumerate(batches[done:], done):
+            dPsiBars, cells = _saturationDPsiBars(epithelium, batch, fixed, c, gl, text)
+            for k, dPsiBar in enumerate(dPsiBars):
+                yaxis[k] += dPsiBar
+            store.record(i, *cells)
+            if checkpointing and i < size-1 and time.time() - lastCheckpoint >= config.CHECKPOINT_INTERVAL:
+                _saveCheckpoint(store, i+1, yaxis, odorscenesArray)
+                lastCheckpoint = time.time()
+    else:
+        seeds = utils.spawn_seeds(size)
+        jobs = [(epithelium, r, qspace, xaxis, conc, fixed, c, seed) for seed in seeds[done:]]
+        odorscenesArray = [[None]*size for x in range(len(xaxis))]
+        if resumed is not None and config.ODORSCENE_REP_NUMBER < done:
+            odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER] = _shownOdorscene(resumed.meta["shown"])
         
+        #Merge repetitions in order, as they finish
+        with utils.process_pool(workers) if workers != 1 else contextlib.nullcontext() as pool:
+            reps = map(_dPsiBarSaturationRep, *zip(*jobs)) if pool is None else pool.map(_dPsiBarSaturationRep, *zip(*jobs))
+            for i, (dPsiBars, cells, rows, glomRows, shown) in enumerate(reps, done):
+                for k, dPsiBar in enumerate(dPsiBars):
+                    yaxis[k] += dPsiBar
+                store.record(i, *cells)
+                if text is not None:
+                    text.write(rows)
+                    if c != 1:
+                        text.writeGlom(glomRows)
+                odorscenesArray[config.ODORSCENE_INDEX][i] = shown
+                if checkpointing and i < size-1 and time.time() - lastCheckpoint >= config.CHECKPOINT_INTERVAL:
+                    _saveCheckpoint(store, i+1, yaxis, odorscenesArray)
+                    lastCheckpoint = time.time()
         
-        if not fixed:
-            effs_rec2 = mvn.pdf(pdfOdorLocsInput2, rec.mean, rec.covE)
-            effs_rec2 = np.asarray(effs_rec2,dtype=np.float64) / rec.effScale #Scales it from 0 to 1
-
-
-            effs2 = np.append(effs2,effs_rec2)
-            
-        else:
-            effs_rec2 = np.repeat(1.0, affs_rec2.size)
-            effs2 = np.repeat(1.0, affs2.size)
-
-    locXaxis = []
-    locYaxis = []
-
-    vi = 0
-    vi2 = 0
-    for i in range(size):
-        for k, j in enumerate(xaxis):
-            #saveOdorscene(odorscenesArray[k][i], "Saved Odors" + str(qspace.size[0]) + purp)
-
-            for odor in odorscenesArray[k][i].odors: #odorscenesArray[k][i].odors
-                for li, loc in enumerate(odor.loc):
-                    if li == 0:
-                        locXaxis.append(loc)
-                    if li == 1:    
-                        locYaxis.append(loc)
-                """
-                for odor2 in odor.getOdors2():
-    
-                    for li, loc in enumerate(odor2.loc):
-                        if li == 0:
-                            locXaxis.append(loc)
-                        if li == 1:    
-                            locYaxis.append(loc)
-                """
-
-            #n = 0
-            #while n < j: 
-                #print("vi=" + str(vi))
-                #print("affs size," + str(affs[vi]))
-                #print("effs size," + str(effs[vi]))
-                for rec in epithelium.recs:
-                    
-                    odor.appendToAffs(float(affs[vi]))
-                    odor.appendToEffs(float(effs[vi]))
-                    vi+=1
-                    
-                    #now set resuts to ordor2
-                    for odor2 in odor.getOdors2():
-                        odor2.appendToAffs(float(affs2[vi2]))
-                        odor2.appendToEffs(float(effs2[vi2]))
-                        vi2+=1
-                '''
-                odor.setAff(float(affs[vi]))
-                odor.setEff(float(effs[vi]))
-                
-                vi+=1
-                '''
-            text._st += "Odorscene"+str(k+1)    
-            yaxis[k] += dPsiBarCalcAngles(epithelium, odorscenesArray[k][i], r, fixed, text, c, gl)
+        #draw ellispse for all receptors
+        if drawEllipse:
+            drawEllipseGraph(qspace, epithelium, odorscenesArray, useMockData=False)
 
+    yaxisSums = list(yaxis)
     count = 0
     while count < len(yaxis):
         yaxis[count] = yaxis[count]/float(size)
         count += 1
-    
+    store.dpsi[:] = yaxis
+    if checkpointing:
+        # Only marked as finished once dpsi is filled, with the RNG state after the ellipse graph like the cache
+        _saveCheckpoint(store, size, yaxisSums, odorscenesArray)
+        if storeName is not None:
+            store = store.save(storeName + results.STORE_EXT)
+    store.flush()
+    if cache is not None:
+        shown = odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER] \
+            if config.ODORSCENE_REP_NUMBER < size else None
+        cache.put(key, store, {"rngState": utils.RNG.bit_generator.state, "shown": _shownMeta(shown)})
+    return xaxis, yaxis, text, odorscenesArray, store
+    
+def _glomActName(c: int, qspace: QSpace) -> str:
+    """Name of the excel doc holding the glom activations of dPsiBarSaturation"""
+    # FIXME: This seems incorrect. (only edit was updating name of qspace.size attr)
+    return "Glom_act with c=" + str(c) + " with " + str(qspace.size[0]) + " qspace.csv"
+
+def saveDPsiBarSaturation(qspace: QSpace, xaxis: list[int], yaxis: list[float], text: Optional[Text], excelName: str,
+                          c=1, purp=''):
+    """Saves the rec activations, glom activations (if c!=1) and dPsiBar values from runDPsiBarSaturation
+    in excel docs. Nothing is saved if text is None."""
+    if text is None:
+        return
     #Saving Activated Epithelium data in excel
-    # print(text._st)
-    # input('Press enter to save data in excel')
-    with open(f"{excelName}.csv", "w") as f:
-        f.write(text._st)
-    
-    if c != 1:
-        # FIXME: This seems incorrect. (only edit was updating name of qspace.size attr)
-        with open("Glom_act with c=" + str(c) + " with " + str(qspace.size[0]) + " qspace.csv", "w") as f:
-            f.write(text._st2)
+    text.save(f"{excelName}.csv", _glomActName(c, qspace) if c != 1 else None)
     
     #Saving dPsi data in excel
     st = "Odorscenes, dPsiBar" + '\n'
@@ -1896,24 +2306,103 @@ def dPsiBarSaturation(epithelium: Epithelium, r, qspace: QSpace, pdfName: str, l
     with open(n + ".csv", "w") as f:
         f.write(st)
 
+def graphDPsiBarSaturation(xaxis: list[int], yaxis: list[float], pdfName: str, labelName: str, plotTitle="", close=False):
+    """Adds the dPsiBar curve from runDPsiBarSaturation to the current graph and saves it to pdfName.
+    if close = True, then graph is closed after this round of data."""
+    plt.plot(xaxis,yaxis, label=labelName)
+    plt.legend()
+    plt.title(plotTitle)
+    plt.xlabel("Number of Ligands")
+    plt.ylabel("dPsiBar")
+
+    #Set y_axis limit
+    axes = plt.gca()
+    axes.set_ylim([0,0.1]) #*****Change if using >30 recs
+
+    #plt.show()
+    with PdfPages(pdfName + '.pdf') as f:
+        f.savefig()
+    if close == True:
+        plt.close()
+
+@utils.verbose_if_debug
+def dPsiBarSaturation(epithelium: Epithelium, r, qspace: QSpace, pdfName: str, labelName: str,
+                      excelName: str, fixed=False, c=1, plotTitle="", close=False, purp='', graphIt=True,
+                      workers: Optional[int] = None, storeName: Optional[str] = None, csv=True) -> SaturationResults:
+    """
+    Define x amount of odorscenes with one ligand per odorscene, then with two ligands...
+    then calculate dPsibar for each group of odorscene and graph to find saturation at certain
+    ligand number.
+    if fixed=true than efficacy=1
+    if close = True, then graph is closed after this round of data.
+    If workers is given, the config.ODOR_REPETITIONS repetitions are spread over that many processes.
+    Each repetition then draws from its own np.random.SeedSequence child of utils.RNG, so results
+    are identical for any number of workers.
+    Returns the rec activ, occ, odoAmt, glom activations and dPsiBar values as a results.SaturationResults,
+    which the graph functions (eg. graphFromExcel) accept in place of the excel docs.
+    If storeName is given, they are also stored as typed arrays in the directory storeName + results.STORE_EXT.
+    If csv = False, the excel docs are not written; they can be made later with SaturationResults.to_csv.
+    precondition: c = integer, fixed and close = Boolean
+    """
+    
+    startTime = time.time()
+    logger.debug("start of dPsiBarSaturation:" + str(startTime))
+
+    xaxis, yaxis, text, odorscenesArray, store = runDPsiBarSaturation(epithelium, r, qspace, fixed, c, workers,
+                                                                      excelName=excelName if csv else None,
+                                                                      storeName=storeName, csv=csv)
+    saveDPsiBarSaturation(qspace, xaxis, yaxis, text, excelName, c, purp)
     if graphIt:
-        plt.plot(xaxis,yaxis, label=labelName)
-        plt.legend()
-        plt.title(plotTitle)
-        plt.xlabel("Number of Ligands")
-        plt.ylabel("dPsiBar")
-    
-        #Set y_axis limit
-        axes = plt.gca()
-        axes.set_ylim([0,0.1]) #*****Change if using >30 recs
-    
-        #plt.show()
-        with PdfPages(pdfName + '.pdf') as f:
-            f.savefig()
-        if close == True:
-            plt.close()
+        graphDPsiBarSaturation(xaxis, yaxis, pdfName, labelName, plotTitle, close)
 
     logger.debug("time elapsed each qspace:"+ str(time.time() - startTime))
+    return store
+
+def _dPsiBarSaturationJob(epithelium: Epithelium, r, qspace: QSpace, fixed: bool, c: int,
+                          seed: np.random.SeedSequence):
+    """Runs runDPsiBarSaturation with its own random stream, for use in worker processes.
+    The ellipse graph is left to the parent, so only the odorscene it shows is returned."""
+    with utils.seeded(seed):
+        xaxis, yaxis, text, odorscenesArray, store = runDPsiBarSaturation(epithelium, r, qspace, fixed, c, drawEllipse=False)
+    shown = odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER]
+    return xaxis, yaxis, text, shown, store
+
+def dPsiBarSaturations(epitheliums: list[Epithelium], r, qspaces: list[QSpace], pdfName: str, labelNames: list[str],
+                       excelNames: list[str], fixed=False, c=1, plotTitle="", purps: Optional[list[str]] = None,
+                       graphIt=True, workers: Optional[int] = None) -> list[SaturationResults]:
+    """
+    Runs dPsiBarSaturation for each (epithelium, qspace) pair, graphing all of them in pdfName.
+    Returns the SaturationResults of each pair.
+    purps[i], labelNames[i] and excelNames[i] are used for the ith pair. The graph is closed after the last pair.
+    If workers is given, the pairs are run at the same time in that many processes, each with its own
+    np.random.SeedSequence child of utils.RNG. The workers only calculate; the excel docs and graphs are
+    made here in order, so they never share a figure or a file and results are identical for any number
+    of workers.
+    """
+    assert len(epitheliums) == len(qspaces) == len(labelNames) == len(excelNames), "Need one of each per qspace"
+    purps = [''] * len(qspaces) if purps is None else purps
+    last = len(qspaces) - 1
+    
+    if workers is None:
+        return [dPsiBarSaturation(epitheliums[i], r, qspace, pdfName, labelNames[i], excelNames[i], fixed, c, plotTitle,
+                                  i == last, purps[i], graphIt) for i, qspace in enumerate(qspaces)]
+    
+    seeds = utils.spawn_seeds(len(qspaces))
+    jobs = [(epitheliums[i], r, qspace, fixed, c, seeds[i]) for i, qspace in enumerate(qspaces)]
+    if workers == 1:
+        runs = [_dPsiBarSaturationJob(*job) for job in jobs]
+    else:
+        with utils.process_pool(workers) as pool:
+            runs = list(pool.map(_dPsiBarSaturationJob, *zip(*jobs)))
+    
+    for i, (xaxis, yaxis, text, shown, store) in enumerate(runs):
+        odorscenesArray = [[None]*config.ODOR_REPETITIONS for x in xaxis]
+        odorscenesArray[config.ODORSCENE_INDEX][config.ODORSCENE_REP_NUMBER] = shown
+        drawEllipseGraph(qspaces[i], epitheliums[i], odorscenesArray, useMockData=False)
+        saveDPsiBarSaturation(qspaces[i], xaxis, yaxis, text, excelNames[i], c, purps[i])
+        if graphIt:
+            graphDPsiBarSaturation(xaxis, yaxis, pdfName, labelNames[i], plotTitle, i == last)
+    return [run[-1] for run in runs]
 
 def createLoc(qspace: QSpace):
     """Given a qspace, return a list of randomized numbers (len=dim) within the qspace"""
@@ -2313,8 +2802,16 @@ def drawEllipseGraph(qspace: QSpace, epithelium: Epithelium, odorscenesArray: li
     #Not closing it will add odor locations to it
     plt.close()
     
+def _loadResults(name: Union[str, SaturationResults]) -> Optional[SaturationResults]:
+    """Returns name if it is a SaturationResults, the loaded store if name is a store directory, else None"""
+    if isinstance(name, SaturationResults):
+        return name
+    if SaturationResults.is_store(name):
+        return SaturationResults.load(name)
+    return None
+
 @utils.verbose_if_debug
-def graphFromExcel(name: str, xaxis: list[int], numRecs: int, labelName: str, titleName: str, pdfName: str, toggle: str, rep=10.0, close=False):
+def graphFromExcel(name: Union[str, SaturationResults], xaxis: list[int], numRecs: int, labelName: str, titleName: str, pdfName: str, toggle: str, rep=10.0, close=False):
     """Given a CSV file from dpsiBarSaturation, create a graph of average receptor
     activation vs num of ligands.
     numRecs=the amount of receptors used in dpsiBarSaturation code(number
@@ -2322,31 +2819,36 @@ def graphFromExcel(name: str, xaxis: list[int], numRecs: int, labelName: str, ti
     **xaxis=list of numbers that correspond to the odoptes in each odorscene
     Ex: If odorscene with 1 ligand all the way to odorscene with 10 ligands:
         [1,2,3,4,5,6,7,8,9,10]
-    name is a string that represent an existing CSV file created from dpsiBarSaturation
+    name is a string that represent an existing CSV file created from dpsiBarSaturation,
+    a store directory created by dpsiBarSaturation, or the SaturationResults it returned
     rep = # of repetitions that occur in dpsiBarSaturation
-    toggle = "Act" or "Occ"
+    toggle = "Act" or "Occ", or "Glom" for the glom activations in a store
     close = True when calling graph for last time. Else, False"""
     length = len(xaxis)
     
-    text = open(name)
-    activ = []
-    for x in xaxis:
-        activ.append(0)
-    
-    i= 0
-    for line in text:
-        if i > 0 and i <= (length*rep): #excludes top line
-            #Add all the numbers after comma 1 before comma numRecs+1 and store it
-            activ[(i-1)%length] += _parseAndSum(line, numRecs, toggle)
-        i += 1
+    store = _loadResults(name)
+    if store is not None:
+        activ = store.average(toggle, numRecs, rep)[:length]
+    else:
+        text = open(name)
+        activ = []
+        for x in xaxis:
+            activ.append(0)
+    
+        i= 0
+        for line in text:
+            if i > 0 and i <= (length*rep): #excludes top line
+                #Add all the numbers after comma 1 before comma numRecs+1 and store it
+                activ[(i-1)%length] += _parseAndSum(line, numRecs, toggle)
+            i += 1
     
-    #Iterate through activ and divide everything by float(numRecs)*rep to get avg
-    ind = 0
-    while ind < length:
-        activ[ind] = activ[ind] / (float(numRecs)*rep)
-        ind += 1
+        #Iterate through activ and divide everything by float(numRecs)*rep to get avg
+        ind = 0
+        while ind < length:
+            activ[ind] = activ[ind] / (float(numRecs)*rep)
+            ind += 1
 
-    text.close()
+        text.close()
     
     # print(activ)
     
@@ -2356,8 +2858,10 @@ def graphFromExcel(name: str, xaxis: list[int], numRecs: int, labelName: str, ti
     plt.xlabel("Number of Ligands")
     
     yAxisName = "Avg Rec "
-    if "Glom_act with c=" in name:
+    if store is None and "Glom_act with c=" in name:
         yAxisName = "Avg Glom "
+    if toggle == "Glom":
+        yAxisName, toggle = "Avg Glom ", "Act"
     
     plt.ylabel(yAxisName + toggle + " Lvl")
     #Set y_axis limit
@@ -2371,30 +2875,35 @@ def graphFromExcel(name: str, xaxis: list[int], numRecs: int, labelName: str, ti
         plt.close()
 
 @utils.verbose_if_debug
-def dPsiGraphFromExcel(name: str, qspace: QSpace, titleName: str, pdfName: str, close=False):
+def dPsiGraphFromExcel(name: Union[str, SaturationResults], qspace: QSpace, titleName: str, pdfName: str, close=False):
     """Given an excel doc with dPsiBar data (generated in simulation)
     this function returns a valid graph
-    name = name of excel file *Don't forget .csv at end
+    name = name of excel file *Don't forget .csv at end, a store directory made by dPsiBarSaturation
+        or the SaturationResults it returned
     titleName = title of graph
     pdfName = name of PDF file
     close = Done adding data to graph"""
     
-    text = open(name)
-    xaxis = []
-    yaxis = []
     label = "(0," + str(qspace.size[0][1]) + ") qspace"
     if titleName[-3:] == "dim":
         label = str(len(qspace.size)) + "D"
     
-    i = 0
-    for line in text:
-        if i > 0:
-            comma = line.find(",")
-            xaxis.append(int(line[:comma]))
-            yaxis.append(float(line[comma+1:]))
-        i+=1
+    store = _loadResults(name)
+    if store is not None:
+        xaxis, yaxis = store.xaxis, store.dpsi
+    else:
+        text = open(name)
+        xaxis = []
+        yaxis = []
+        i = 0
+        for line in text:
+            if i > 0:
+                comma = line.find(",")
+                xaxis.append(int(line[:comma]))
+                yaxis.append(float(line[comma+1:]))
+            i+=1
 
-    text.close()
+        text.close()
     
     plt.plot(xaxis, yaxis, label=label)
     plt.legend()
@@ -2413,44 +2922,53 @@ def dPsiGraphFromExcel(name: str, qspace: QSpace, titleName: str, pdfName: str,
         plt.close()
 
 @utils.verbose_if_debug
-def dPsiOccActGraphFromExcel(nameDpsi: str, nameAO: str, xaxis: list[int], numRecs: int, labelName: str,
+def dPsiOccActGraphFromExcel(nameDpsi: Union[str, SaturationResults], nameAO: Union[str, SaturationResults], xaxis: list[int], numRecs: int, labelName: str,
                              titleName: str, pdfName: str, color="b", rep=200.0, close=False):
     """Given three excel docs (DpsiBar, Act, Occ) generated from the simulation,
     this function returns a dPsiBar vs Act and Occ graph with a given qspace
     preconditions:
     nameDpsi = valid excel doc name that holds dPsi info with .csv extension
     nameAO = valid excel doc name that holds Act and Occ info with .csv extension
-    xaxis = list of ints that resemble num of odorscenes (xaxis in normal dPsi vs Odorscenes graph)"""
-    assert nameDpsi[-3:] == "csv", "nameDpsi doesn't have .csv extension"
-    dPsi = []
-    activ = []
-    occ = []
+    xaxis = list of ints that resemble num of odorscenes (xaxis in normal dPsi vs Odorscenes graph)
+    Either name can instead be a store directory made by dPsiBarSaturation or the SaturationResults it returned"""
+    length = len(xaxis)
     
     ###extract dPsi info
-    with open(nameDpsi) as f:
-        dPsi = [float(line[line.find(",")+1:]) for i, line in enumerate(f.readlines()) if i>0]
+    storeDpsi = _loadResults(nameDpsi)
+    if storeDpsi is not None:
+        dPsi = storeDpsi.dpsi[:length]
+    else:
+        assert nameDpsi[-3:] == "csv", "nameDpsi doesn't have .csv extension"
+        with open(nameDpsi) as f:
+            dPsi = [float(line[line.find(",")+1:]) for i, line in enumerate(f.readlines()) if i>0]
     # print(dPsi)
     ###extract act and occ info
-    length = len(xaxis)
-    text = open(nameAO)
-    for x in xaxis:
-        activ.append(0)
-        occ.append(0)
-    i= 0
-    for line in text:
-        if i > 0 and i <= (length*rep): #excludes top line
-            #Add all the numbers after comma 1 before comma numRecs+1 and store it
-            activ[(i-1)%length] += _parseAndSum(line, numRecs, "Act")
-            occ[(i-1)%length] += _parseAndSum(line, numRecs, "Occ")
-        i += 1
+    store = _loadResults(nameAO)
+    if store is not None:
+        activ = store.average("Act", numRecs, rep)[:length]
+        occ = store.average("Occ", numRecs, rep)[:length]
+    else:
+        activ = []
+        occ = []
+        text = open(nameAO)
+        for x in xaxis:
+            activ.append(0)
+            occ.append(0)
+        i= 0
+        for line in text:
+            if i > 0 and i <= (length*rep): #excludes top line
+                #Add all the numbers after comma 1 before comma numRecs+1 and store it
+                activ[(i-1)%length] += _parseAndSum(line, numRecs, "Act")
+                occ[(i-1)%length] += _parseAndSum(line, numRecs, "Occ")
+            i += 1
 
-    #Iterate through and divide everything by float(numRecs)*rep to get avg
-    ind = 0
-    while ind < length:
-        activ[ind] = activ[ind] / (float(numRecs)*rep)
-        occ[ind] = occ[ind] / (float(numRecs)*rep)
-        ind += 1
-    text.close()
+        #Iterate through and divide everything by float(numRecs)*rep to get avg
+        ind = 0
+        while ind < length:
+            activ[ind] = activ[ind] / (float(numRecs)*rep)
+            occ[ind] = occ[ind] / (float(numRecs)*rep)
+            ind += 1
+        text.close()
     
     #Graph it
     plt.plot(occ, dPsi, '-.', color=color, label=labelName + ", occ")
@@ -2504,12 +3022,13 @@ def _parseAndSum(line: str, numCommas: int, toggle: str):
 
 
 def recDensityDpsiGraph(r, qspace: QSpace, odorscene: Odorscene, dim: int, name: str,
-                        labelName: str, excelName: str, sd=.5, fixed=False):
+                        labelName: str, excelName: str, sd=.5, fixed=False, placement="mixed"):
     """This function uses a qspace with different # of rec to create different
     receptor densities (receptors are all equally spaced within qspace). Odorscene
     will be adjusted to fit into qspace. Return graph of different dPsi_Bar values
     vs dist between receptors (opp of density).
-    r is distance ligands 'move' when calc dPsiBar."""
+    r is distance ligands 'move' when calc dPsiBar.
+    placement is how the receptors are spaced, see recLattice."""
     recDist: list[float] = []     #x_axis
     dPsiValues = []  #y_axis
     
@@ -2524,13 +3043,13 @@ def recDensityDpsiGraph(r, qspace: QSpace, odorscene: Odorscene, dim: int, name:
         i -= 1
 
     # print(receptors)
-    text = Text("Receptors, Activ_Lvl, Occ, Num_Odo" + '\n', "exp2")
+    text = TextStream("Receptors, Activ_Lvl, Occ, Num_Odo" + '\n', "exp2", excelName + ".csv")
     
     #Calculate values for graph for each qspace
     for i, n in enumerate(receptors):
-        text._st += str(n) + " recs" + '\n'
+        text.write(str(n) + " recs" + '\n')
         
-        epi, dist = recInQspace(n, dim, qspace, sd) #creating uniformly spread receptor field (epi) based on qspace
+        epi, dist = recInQspace(n, dim, qspace, sd, placement) #creating uniformly spread receptor field (epi) based on qspace
         logger.debug("Odorscene affs effs: %s", list(map(lambda lig: (lig._affs, lig._effs), odorscene.odors)))
         # logger.debug("Generating dPsiBar w/ values epi=%s\nodorscene=%s\nr=%s\nfixed=%s\ntext=%s", epi, odorscene, r, fixed, text)
         dPsibar = dPsiBarCalcAngles(epi, odorscene, r, fixed, text)
@@ -2538,9 +3057,7 @@ def recDensityDpsiGraph(r, qspace: QSpace, odorscene: Odorscene, dim: int, name:
         dPsiValues.append(dPsibar)
     
     #Store data in csv file
-    test = open(excelName + ".csv", "w")
-    test.write(text._st)
-    test.close
+    text.save()
     
     #Plot graph ###Figure out how to label graphs!!
     plt.plot(recDist,dPsiValues, label=labelName)
@@ -2552,112 +3069,104 @@ def recDensityDpsiGraph(r, qspace: QSpace, odorscene: Odorscene, dim: int, name:
     pp = PdfPages(name + '.pdf')
     pp.savefig()
 
-# TODO: Reimplement this
-def recInQspace(n: int, dimen: Real, qspace: QSpace, sd=.5):
+def _latticeRows(n: int, dim: int, length: float, low: int, high: int, spread: bool) -> np.ndarray:
+    """Returns the (n, dim) locations of recLattice's "mixed" placement, row by row: rows along the last
+    dimension hold low receptors (spaced length/low) and then high receptors (spaced length/high), and the
+    rows themselves are placed the same way in the other dimensions. The last row is partly filled, and is
+    spread evenly over length if spread, otherwise spaced length/high."""
+    if dim == 1:
+        step = length/n if spread or n in (low, high) else length/high
+        return (np.arange(n) * step)[:, np.newaxis]
+    if n <= low**(dim-1) * high:
+        #low**(dim-1) rows, as many of them holding high as needed to fit n
+        numRows = low**(dim-1)
+        numHigh = 0 if high == low else min(numRows, -(-(n - numRows*low) // (high-low)))
+        sizes = np.array([low]*(numRows-numHigh) + [high]*numHigh)
+    else:
+        sizes = np.full(-(-n // high), high)
+    ends = np.cumsum(sizes)
+    sizes = sizes[:np.searchsorted(ends, n)+1]
+    sizes[-1] -= sizes.sum() - n
+    starts = np.cumsum(sizes) - sizes
+    
+    steps = np.where(sizes == low, length/low, length/high)
+    steps[-1] = length/sizes[-1] if spread or sizes[-1] in (low, high) else length/high
+    row = np.repeat(np.arange(len(sizes)), sizes)
+    locs = np.empty((n, dim))
+    locs[:, :-1] = _latticeRows(len(sizes), dim-1, length, low, high, False)[row]
+    locs[:, -1] = (np.arange(n) - starts[row]) * steps[row]
+    return locs
+
+def recLattice(n: int, dim: int, length: float, placement="mixed") -> np.ndarray:
+    """Returns the (n, dim) locations of n receptors equally spaced in [0, length)^dim, in row order
+    (the last dimension changes fastest).
+    placement = "mixed": receptors are spaced dHigh = length/floor(n**(1/dim)) and, once that no longer
+    fits n, dLow = length/ceil(n**(1/dim)), row by row. The last, partly filled row is spread evenly over
+    length. This is the placement recInQspace has always used.
+    placement = "grid": every dimension is spaced dLow, so the receptors are the first n points of one
+    square lattice.
+    Precondition: n >= 1"""
+    assert n >= 1, "Need at least one receptor"
+    assert placement in ("mixed", "grid"), f"Unknown placement {placement!r}"
+    low = int(round(n**(1/dim)))
+    low = low - 1 if low**dim > n else low #floor without rounding errors (eg. 64**(1/3) < 4)
+    high = low if low**dim == n else low + 1
+    if placement == "mixed":
+        return _latticeRows(n, dim, float(length), low, high, True)
+    index = np.array(np.unravel_index(np.arange(n), [high]*dim), dtype=np.float64).T
+    return index * (length/high)
+
+def recInQspace(n: int, dimen: Real, qspace: QSpace, sd=.5, placement="mixed"):
     """Given n number of receptors and qspace, returns an epithelium with
     receptors at equally incremented distances from one another and the
-    distance between them.
-    Precondition: qspace must be a square that has origin at 0"""
-    
-    dimen = float(dimen)
-    n = float(n)
-    length = float(qspace.size[0][1])
-    chgDim = dimen
-    numInRow = math.floor(n**(1/dimen))
-    safe = numInRow**dimen
-    resetChgDim = (numInRow**(dimen-1)) + 1
-    dHigh = length / math.floor(n**(1/dimen))
-    dLow = length / math.ceil(n**(1/dimen))
-    switch = safe + 1
-    dimen = int(dimen)
-    
-    coord: list[list[int]] = []
-    i = 0
-    while i < n+1:
-        j = 0
-        coord.append([])
-        while j < dimen+1:
-            coord[i].append(0)
-            j += 1
-        i += 1
-    
-    repeat = True
-    while repeat:
-        r = 2
-        repeat = False
-        d = dimen
-        while r <= n:
-            k = 1
-            while k <= dimen:
-                coord[r][k] = copy.deepcopy(coord[r-1][k])
-                k += 1
-            if (r > switch and d>=chgDim):
-                coord[r][d] += dLow
-            else:
-                coord[r][d] += dHigh
-            while coord[r][d] >= length:
-                coord[r][d] = 0
-                d -= 1
-                if d == 0:
-                    repeat = True
-                    switch -= numInRow
-                    resetChgDim -= 1
-                    if resetChgDim == 0:
-                        chgDim -= 1
-                        resetChgDim = (numInRow**(chgDim - 1.0)) + 1
-                    break
-                if (r > switch and d>=chgDim):
-                    coord[r][d] += dLow
-                else:
-                    coord[r][d] += dHigh
-                if (coord[r][d] < length):
-                    d = dimen
-            if repeat:
-                break
-            r+=1
-    n = int(n)
-    numLastRow = 0
-    last = coord[n][dimen-1]
-    while last == coord[n-numLastRow][dimen-1]:
-        numLastRow += 1
-    newD = length/float(numLastRow)
-    count = n - numLastRow + 2
-    while count <= n:
-        coord[count][dimen] = coord[count-1][dimen] + newD
-        count += 1
-    
-    avgDist = 0
-    i = 2
-    while i <= n:
-        a = dimen
-        while coord[i][a] == 0:
-            a -= 1
-        avgDist += coord[i][a] - coord[i-1][a]
-        i += 1
-    
-    avgDist = float(avgDist) / (float(n)-1)
-    
-    recs = []
-    i = 1
-    while i <= n:
-        pos = 1
-        loc = []
-        aff = []
-        while pos <= dimen:
-            loc.append(coord[i][pos])
-            aff.append(sd)
-            pos += 1
-        recs.append(Receptor(i, loc, aff, aff))
-        i += 1
+    distance between them (the average step between consecutive receptors, along the
+    last dimension that the later receptor isn't at 0 in).
+    See recLattice for placement.
+    Precondition: qspace must be a square that has origin at 0 and n >= 2"""
+    assert n >= 2, "Need at least two receptors to have a distance between them"
+    dim = int(dimen)
+    locs = recLattice(int(n), dim, float(qspace.size[0][1]), placement)
+    
+    steps = locs[1:] - locs[:-1]
+    last = dim - 1 - np.argmax((locs[1:] != 0)[:, ::-1], axis=1)
+    avgDist = float(steps[np.arange(len(steps)), last].sum()) / (n-1)
+    
+    recs = [Receptor(i, loc, [sd]*dim, [sd]*dim) for i, loc in enumerate(locs.tolist(), 1)]
     return Epithelium(recs), avgDist
 
-def recDensityDpsiGraphRandomized(r, qspace: QSpace, odorscene: Odorscene, dim: int, name: str, fixed=False):
+def _densityRepeat(odorscene: Odorscene, dim: int, qspace: QSpace, fixed: bool, receptorNum: list[int],
+                   seed: Optional[np.random.SeedSequence] = None) -> tuple[list[float], str]:
+    """Runs one repeat of recDensityDpsiGraphRandomized with nested=True: draws one epithelium with
+    max(receptorNum) receptors and returns the dPsiBar of its first n receptors for each n in receptorNum,
+    along with their csv rows. dPsi**2 is a sum over the receptors, so each n only takes a prefix sum
+    of the receptors' dPhi**2. If seed is given, the receptors are drawn from it instead of utils.RNG."""
+    with utils.seeded(seed) if seed is not None else contextlib.nullcontext():
+        epi = Epithelium.create(max(receptorNum), dim, qspace, scale=(.5,1.5))
+    activ, totOcc, odoAmt = _anglesActivations(epi, odorscene, fixed)
+    dPsi2 = np.cumsum((activ[0] - activ[1:])**2, axis=1)
+    dPsiBars = np.sqrt(dPsi2[:, np.array(receptorNum)-1]).mean(axis=0)
+    
+    #Same rows as recToText, for the first n receptors
+    rows = [f"Rec{n},{a},{o},{m}\n" for n, (a, o, m) in enumerate(zip(activ[0].tolist(), totOcc[0].tolist(),
+                                                                      odoAmt.tolist()))]
+    text = "".join("Rec # " + str(n) + "\n" + "".join(rows[:n]) + "\n" for n in receptorNum)
+    return dPsiBars.tolist(), text + "Repeat again" + "\n"
+
+def recDensityDpsiGraphRandomized(r, qspace: QSpace, odorscene: Odorscene, dim: int, name: str, fixed=False,
+                                  nested=False, workers: Optional[int] = None):
     """Returns graph of dPsi vs # of receptors in a given qspace. Values
     are averaged multiple times to get accurate results. qspace is constant
     while number of receptors varies.
     r is distance ligands 'move' when calc dPsiBar.
     This is different from recDensityDpsiGraph since it doesn't equally allign
-    receptors in qspace. Just randomly distributes it and calculated multiple times to get an average."""
+    receptors in qspace. Just randomly distributes it and calculated multiple times to get an average.
+    If nested = True, each repeat draws one epithelium with the largest # of receptors and every smaller
+    # of receptors uses its first receptors (see _densityRepeat), so a repeat costs one dPsiBar calculation.
+    workers = number of processes to run the repeats in when nested, each with its own random stream.
+    If config.CHECKPOINT_DIR is set, the dPsi sums, csv size and utils.RNG state are saved there at least every
+    config.CHECKPOINT_INTERVAL seconds, and with config.RESUME a stopped run continues where it was saved.
+    Precondition: the ligands of odorscene have config.ANGLES_REP odors2"""
+    assert nested or workers is None, "Only nested repeats can be run in workers"
     #Create xAxis
     receptorNum = []
     i = 2
@@ -2681,19 +3190,55 @@ def recDensityDpsiGraphRandomized(r, qspace: QSpace, odorscene: Odorscene, dim:
         i+=1
     # print(receptorNum)
 
-    repeats = 0
-    text = Text("Receptors, Activ_Lvl, Occ, Num_Odo" + '\n', "exp2")
-    while repeats < 10:
-        num=0
-        while num < len(receptorNum):
-            text._st += "Rec # " + str(receptorNum[num]) + "\n"
+    #Each (repeat, # of receptors) pair is one step, so a checkpoint can be continued from any of them.
+    #Nested repeats do every # of receptors at once, so they are one step each
+    steps = list(range(10)) if nested else [(repeat, num) for repeat in range(10) for num in range(len(receptorNum))]
+    done = 0
+    offsets = None
+    checkpointName = None
+    if config.CHECKPOINT_DIR is not None:
+        key = _runKey({"run": "recDensityDpsiGraphRandomized", "r": r, "qspace": qspace.size, "dim": dim,
+                       "name": name, "fixed": fixed, "odors": [[list(odor.loc), odor.conc] for odor in odorscene.odors],
+                       "nested": nested, "parallel": workers is not None})
+        checkpointName = os.path.join(str(config.CHECKPOINT_DIR), key + ".json")
+    #Drawn before resuming, so a resumed run gets the same seeds
+    seeds = utils.spawn_seeds(len(steps)) if workers is not None else [None]*len(steps)
+    if checkpointName is not None:
+        if config.RESUME and os.path.isfile(checkpointName):
+            with open(checkpointName) as f:
+                saved = json.load(f)
+            done, dPsi, offsets = saved["done"], saved["dPsi"], saved["offsets"]
+            utils.RNG.bit_generator.state = saved["rngState"]
+            logger.info(f"Resuming recDensityDpsiGraphRandomized after {done} of {len(steps)} steps from {checkpointName}")
+        os.makedirs(str(config.CHECKPOINT_DIR), exist_ok=True)
+    
+    text = TextStream("Receptors, Activ_Lvl, Occ, Num_Odo" + '\n', "exp2", name + ".csv", offsets=offsets)
+    lastCheckpoint = time.time()
+    def checkpoint(step: int):
+        nonlocal lastCheckpoint
+        if checkpointName is not None and (step == len(steps)-1
+                                           or time.time() - lastCheckpoint >= config.CHECKPOINT_INTERVAL):
+            utils.save_json(checkpointName, {"done": step+1, "dPsi": dPsi, "offsets": text.tell(),
+                                             "rngState": utils.RNG.bit_generator.state})
+            lastCheckpoint = time.time()
+    
+    if nested and done < len(steps):
+        jobs = [(odorscene, dim, qspace, fixed, receptorNum, seed) for seed in seeds[done:]]
+        with utils.process_pool(workers) if workers not in (None, 1) else contextlib.nullcontext() as pool:
+            outputs = map(_densityRepeat, *zip(*jobs)) if pool is None else pool.map(_densityRepeat, *zip(*jobs))
+            for step, (dPsiBars, rows) in enumerate(outputs, done):
+                text.write(rows)
+                for num, dPsiBar in enumerate(dPsiBars):
+                    dPsi[num] += dPsiBar
+                checkpoint(step)
+    elif not nested:
+        for step, (repeats, num) in enumerate(steps[done:], done):
+            text.write("Rec # " + str(receptorNum[num]) + "\n")
             epi = Epithelium.create(receptorNum[num], dim, qspace, scale=(.5,1.5))
             dPsi[num] += dPsiBarCalcAngles(epi, odorscene, r, fixed, text)
-            num+=1
-        #     print(num)
-        # print(repeats)
-        text._st += "Repeat again" + "\n"
-        repeats += 1
+            if num == len(receptorNum)-1:
+                text.write("Repeat again" + "\n")
+            checkpoint(step)
     #Average the dPsi calculations
     i = 0
     while i < len(dPsi):
@@ -2701,9 +3246,7 @@ def recDensityDpsiGraphRandomized(r, qspace: QSpace, odorscene: Odorscene, dim:
         i += 1
     
     #Store data in csv file
-    test = open(name + ".csv", "w")
-    test.write(text._st)
-    test.close
+    text.save()
     
 
     plt.plot(receptorNum,dPsi)
@@ -2712,98 +3255,256 @@ def recDensityDpsiGraphRandomized(r, qspace: QSpace, odorscene: Odorscene, dim:
     plt.ylabel("dPsiBar")
     plt.show()
 
-def glomRecConnNew(recs: list[Receptor], gl: list[cells.Glom], c=9, conn: list[list[int]] = []) -> list[list[int]]:
+def glomRecConnNew(recs: list[Receptor], gl: list[cells.Glom], c=9, conn: Optional[list[list[int]]] = None) -> list[list[int]]:
     """New function that deploys gl into olfactory bulb space (config.NUM_ROW X config.NUM_COL)
     and connects to primary and secondary recs with given weights.
     c = num of recs connected to each glom
     conn = Used for random assignment to ensure dPsi is calculated using odors with identical connections
+    (None or [] draws new ones)
     The following variables are global variables:
     config.GLOM_PENETRANCE = primary weight
-    # FIXME: Why is s_weights global?
-    s_weights = a list of floats for the remaining weights. If empty, the rest of
-    the weights are (1-p_weight)/(c-1)
-    Preconditons: # of recs in epi == config.NUM_ROW*config.NUM_COL == len(gl)
-                  if constant=True then c must be 9"""
+    config.S_WEIGHTS = a list of floats for the remaining weights. If there are fewer than c-1, the rest of
+    the weights are (1-p_weight)/(c-1) (see secondaryWeights)
+    The connections come from glomConnWeights, each glom's rec_conn_map is replaced by its row of it.
+    With config.SCALABLE_GLOMS, gl can have any size and c any value (see glomConnWeights).
+    Preconditons: # of recs in epi == config.NUM_ROW*config.NUM_COL == len(gl) (unless config.SCALABLE_GLOMS)
+                  if constant=True then c must be 9 (unless config.SCALABLE_GLOMS)"""
     assert len(gl) == len(recs), "# of recs != # of glom"
-    assert len(gl) == config.NUM_ROW*config.NUM_COL, "Glomeruli don't fit in space. Change config.NUM_ROW and config.NUM_COL global variables on top of RnO.py"
-    assert len(s_weights) == 0 or c-1, "weights is an incorrect length"
+    numRow, numCol = glomGridShape(len(gl))
+    assert len(gl) == numRow*numCol, "Glomeruli don't fit in space. Change config.NUM_ROW and config.NUM_COL global variables on top of RnO.py"
 
-    #Deploy each glom into space and add primary receptor
-    i = 0
-    for row in range(config.NUM_ROW):
-        for col in range(config.NUM_COL):
-            gl[i].loc = (row,col)
-            gl[i].rec_conn_map[recs[i]] = config.GLOM_PENETRANCE
-            i += 1
+    connectome = Connectome(len(recs), c, conn)
+    connectome.attach(gl, recs)
+    return connectome.conn
     
-    if not s_weights:
-        w = float(1-config.GLOM_PENETRANCE)/float(c-1)
-        for i in range(c):
-            s_weights.append(w)
-
-    ####Loop through glom and attach remaining recs
-    conn = attachSecondaryRecs(gl, recs, c, conn)
-
+class Connectome:
+    """The glom:rec connections of a glom layer (see glomConnWeights), built once and applied to any
+    number of rec activation arrays, without filling the gloms' rec_conn_map or copying layers.
+    Instance Attributes:
+    c : int
+        Number of recs per glom
+    weights : sparse.csr_matrix
+        (gloms X recs) connection weights
+    conn : list[list[int]]
+        Random connections, see glomRecConnNew (empty with config.CONSTANT_ATTACHMENTS)
+    """
 
-    #Activate each glom given rec connections
-    i = 0
-    for glom in gl:
-        activ = 0.0
-        for rec in glom._recConn.keys():
-            activ += float(rec.activ)*float(glom._recConn[rec]) #rec Activ * weight of conn
-        glom.activ = min(activ, 1.0)
-        #print("ACTIV IS:" + str(min(activ, 1.0)))
-    
-    return conn
+    def __init__(self, numRecs: int, c=9, conn: Optional[list[list[int]]] = None):
+        """Connects numRecs gloms to numRecs recs. If conn is empty (or None), random connections are drawn into it."""
+        self.c = c
+        self.weights, self.conn = glomConnWeights(numRecs, c, conn)
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    def activate(self, activ) -> np.ndarray:
+        """Returns the glom activations of the rec activations in activ, see glomActivations."""
+        return glomActivations(self.weights, activ)
+
+    def attach(self, gl: list[cells.Glom], recs: list[Receptor]) -> None:
+        """Deploys gl into olfactory bulb space, fills each glom's rec_conn_map with its recs
+        and activates it given their activations (see glomRecConnNew)."""
+        assert len(gl) == len(self), "# of recs != # of glom"
+        numCol = glomGridShape(len(gl))[1]
+        for g, glom in enumerate(gl):
+            glom.loc = divmod(g, numCol)
+        _setRecConnMaps(gl, recs, self.weights)
+        for glom, activ in zip(gl, self.activate([rec.activ for rec in recs])):
+            glom.activ = activ
+
+def _connectomeKey(c: int) -> tuple:
+    """Returns c and the config settings a Connectome's connections depend on (see glomConnWeights)."""
+    return (c, config.CONSTANT_ATTACHMENTS, config.SCALABLE_GLOMS, config.GLOM_PENETRANCE,
+            tuple(config.S_WEIGHTS), config.NUM_ROW, config.NUM_COL)
+
+def policyConnectome(epithelium: Epithelium, c: int) -> Connectome:
+    """Returns the Connectome a dPsi calculation uses when it isn't given one, by config.CONNECTOME_POLICY:
+    "epithelium" = the epithelium's own (see Epithelium.connectome), otherwise a new one. With "repetition",
+    the saturation runs give each repetition's dPsi calculations one Connectome."""
+    assert config.CONNECTOME_POLICY in ("call", "repetition", "epithelium"), "Unknown config.CONNECTOME_POLICY"
+    if config.CONNECTOME_POLICY == "epithelium":
+        return epithelium.connectome(c)
+    return Connectome(len(epithelium.recs), c)
+
+def glomConnWeights(numRecs: int, c=9, conn: Optional[list[list[int]]] = None) -> tuple[sparse.csr_matrix, list[list[int]]]:
+    """Returns the (numRecs X numRecs) CSR matrix of glom:rec connection weights, and conn.
+    Glom i sits at (i // numCol, i % numCol) of the glomGridShape grid and is connected to rec i with
+    config.GLOM_PENETRANCE. If config.CONSTANT_ATTACHMENTS, the recs of the other gloms surrounding it
+    on the tourus follow (in glom order) with secondaryWeights(c, 8), otherwise c-1 recs chosen at random
+    follow with secondaryWeights(c). If conn isn't empty, the random recs are taken from it (it needs c-1
+    recs for each glom), otherwise they are appended to it (a new list if conn is None).
+    With config.SCALABLE_GLOMS the recs come from glomConvergence instead, with secondaryWeights(c).
+    Its constant attachments need a grid with room for c nearest gloms, a prime number of gloms
+    only fits a 1 X numRecs grid.
+    Each row keeps the order the connections are made in, so products with the matrix add them up
+    the same way a loop over rec_conn_map does.
+    With constant attachments the matrix only depends on the grid and the weights, so it is built
+    once and shared between calls (it must not be modified)."""
+    numRow, numCol = glomGridShape(numRecs)
+    assert numRecs == numRow*numCol, "Glomeruli don't fit in space. Change config.NUM_ROW and config.NUM_COL"
+
+    conn = [] if conn is None else conn
+
+    if config.SCALABLE_GLOMS:
+        weights = secondaryWeights(c)
+        if config.CONSTANT_ATTACHMENTS:
+            key = ("scalable", numRow, numCol, c, config.GLOM_PENETRANCE, tuple(weights))
+            if key not in _constantConnWeights:
+                _constantConnWeights[key] = _connWeightsCSR(glomConvergence(numRow, numCol, c), numRecs, weights)
+            return _constantConnWeights[key], conn
+        if conn == []:
+            conn.extend(glomConvergence(numRow, numCol, c)[:, 1:].tolist())
+        assert len(conn) == numRecs and all(len(recs) >= c-1 for recs in conn), "conn doesn't have c-1 recs for each glom"
+        rows = np.hstack((np.arange(numRecs)[:, None], np.array([recs[:c-1] for recs in conn], dtype=np.int64).reshape(numRecs, c-1)))
+        return _connWeightsCSR(rows, numRecs, weights), conn
+
+    if config.CONSTANT_ATTACHMENTS:
+        weights = secondaryWeights(c, 8)
+        key = (numRecs, numRow, numCol, config.GLOM_PENETRANCE, tuple(weights))
+        if key not in _constantConnWeights:
+            neighbors = np.sort(torusNeighbors(numRow, numCol), axis=1)
+            if numRow >= 3 and numCol >= 3:
+                rows = np.hstack((np.arange(numRecs)[:, None], neighbors))
+            else: #Neighbors repeat (or are the glom itself) on narrow grids
+                rows = [[g] + sorted(set(neighbors[g].tolist()) - {g}) for g in range(numRecs)]
+            _constantConnWeights[key] = _connWeightsCSR(rows, numRecs, weights)
+        return _constantConnWeights[key], conn
+
+    weights = secondaryWeights(c)
+    ints = range(0,numRecs)
+    if conn == []: #No prior connection restrictions
+        for g in range(numRecs):
+            connections = []
+            while len(connections) < c-1:
+                #Choose random rec until find one that isn't connected yet
+                index = utils.RNG.choice(ints)
+                while index == g or index in connections:
+                    index = utils.RNG.choice(ints)
+                connections.append(int(index))
+            conn.append(connections)
+
+    return _connWeightsCSR([[g] + list(conn[g][:c-1]) for g in range(numRecs)], numRecs, weights), conn
+    
+_constantConnWeights: dict[tuple, sparse.csr_matrix] = {}
+"""glomConnWeights's constant attachment matrices, by grid and weights."""
+
+def _connWeightsCSR(rows: list[list[int]] | np.ndarray, numRecs: int, weights: Sequence[float]) -> sparse.csr_matrix:
+    """Returns the CSR matrix where row g connects glom g to the recs in rows[g], the first
+    with config.GLOM_PENETRANCE and the rest with weights (indices are left in the given order).
+    rows can also be a 2d array, when every glom has the same number of recs."""
+    if isinstance(rows, np.ndarray):
+        assert rows.shape[1] - 1 <= len(weights), "Not enough weights for the secondary recs"
+        indptr = np.arange(0, rows.size + 1, rows.shape[1])
+        indices = rows.astype(np.int32).ravel()
+        data = np.tile([config.GLOM_PENETRANCE] + list(weights[:rows.shape[1]-1]), len(rows)).astype(float)
+    else:
+        assert max(map(len, rows), default=1) - 1 <= len(weights), "Not enough weights for the secondary recs"
+        indptr = np.cumsum([0] + [len(row) for row in rows])
+        indices = np.fromiter((rec for row in rows for rec in row), dtype=np.int32, count=indptr[-1])
+        data = np.array([w for row in rows for w in [config.GLOM_PENETRANCE] + list(weights[:len(row)-1])], dtype=float)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), numRecs))
+
+def glomGridShape(numGloms: int) -> tuple[int, int]:
+    """Returns the (rows, cols) grid numGloms gloms are deployed on: config.NUM_ROW X config.NUM_COL,
+    unless config.SCALABLE_GLOMS is set and numGloms don't fit it, then the most square grid that fits them
+    (1 X numGloms if numGloms is prime, see glomConnWeights)."""
+    if not config.SCALABLE_GLOMS or numGloms == config.NUM_ROW*config.NUM_COL:
+        return config.NUM_ROW, config.NUM_COL
+    numRow = max(row for row in range(1, math.isqrt(numGloms)+1) if numGloms % row == 0)
+    return numRow, numGloms // numRow
+
+def secondaryWeights(c: int, count: Optional[int] = None) -> list[float]:
+    """Returns the weights of the secondary recs of each glom, c-1 of them unless count is given
+    (constant attachments without config.SCALABLE_GLOMS always have the 8 surrounding gloms' recs):
+    the first ones of config.S_WEIGHTS, or (1-config.GLOM_PENETRANCE)/(c-1) each if there aren't enough."""
+    count = c-1 if count is None else count
+    if len(config.S_WEIGHTS) >= count:
+        return list(config.S_WEIGHTS[:count])
+    return [float(1-config.GLOM_PENETRANCE)/float(c-1)]*count
+
+def glomConvergence(numRow: int, numCol: int, c: int) -> np.ndarray:
+    """Returns the (numRow*numCol X c) array of the recs each glom of a numRow X numCol tourus is
+    connected to with config.SCALABLE_GLOMS, the glom's own rec first.
+    With config.CONSTANT_ATTACHMENTS the others are the recs of the c-1 nearest gloms (nearest first,
+    ties in row then column order), otherwise they are c-1 different recs drawn at random in bulk.
+    Both take time and memory proportional to numRow*numCol*c."""
+    numGloms = numRow*numCol
+    gloms = np.arange(numGloms)
+    assert 1 <= c <= numGloms, "c must be between 1 and the number of gloms"
+
+    if config.CONSTANT_ATTACHMENTS:
+        radius = 0
+        while (2*radius + 1)**2 < c:
+            radius += 1
+        assert 2*radius + 1 <= min(numRow, numCol), (f"{numGloms} gloms only fit a {numRow} X {numCol} grid, which is too narrow "
+                                                     f"for {c} constant attachments. Use random attachments or another # of gloms")
+        rowOffsets, colOffsets = np.mgrid[-radius:radius+1, -radius:radius+1].reshape(2, -1)
+        nearest = np.lexsort((colOffsets, rowOffsets, rowOffsets**2 + colOffsets**2))[:c]
+        rows, cols = np.divmod(gloms, numCol)
+        return (((rows[:, None] + rowOffsets[nearest]) % numRow)*numCol
+                + (cols[:, None] + colOffsets[nearest]) % numCol)
+
+    #Draw from the other gloms' recs, then redraw the gloms that got a rec twice
+    secondary = utils.RNG.integers(0, numGloms-1, (numGloms, c-1))
+    secondary += secondary >= gloms[:, None]
+    redraw = gloms
+    while len(redraw):
+        ordered = np.sort(secondary[redraw], axis=1)
+        redraw = redraw[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+        secondary[redraw] = utils.RNG.integers(0, numGloms-1, (len(redraw), c-1))
+        secondary[redraw] += secondary[redraw] >= redraw[:, None]
+    return np.hstack((gloms[:, None], secondary))
+
+def glomActivations(weights: sparse.csr_matrix, activ) -> np.ndarray:
+    """Returns min(weights @ activ, 1), the glom activations given the rec activations in activ.
+    activ is either one vector of rec activations, or one per row (eg. one row per odorscene),
+    in which case there's one row of glom activations per row (in C order, so sums over each row
+    add up like they do for a dense product)."""
+    activ = np.asarray(activ, dtype=float)
+    return np.ascontiguousarray(np.minimum(weights @ activ.T, 1.0).T)
+
+def _setRecConnMaps(gl: list[cells.Glom], recs: list[Receptor], weights: sparse.csr_matrix) -> None:
+    """Replaces each glom's rec_conn_map with its row of weights (kept for code reading the dicts)."""
+    for g, glom in enumerate(gl):
+        glom.rec_conn_map = {}
+        start, end = weights.indptr[g], weights.indptr[g+1]
+        for rec, weight in zip(weights.indices[start:end], weights.data[start:end]):
+            glom.rec_conn_map[recs[rec]] = float(weight)
+
+def glomConnMatrix(gl: list[cells.Glom], recs: list[Receptor]) -> np.ndarray:
+    """Returns the (len(gl) X len(recs)) matrix of connection weights stored in each glom's
+    rec_conn_map, so activations of recs can be passed to gl with a single product."""
+    index = {id(rec): i for i, rec in enumerate(recs)}
+    weights = np.zeros((len(gl), len(recs)))
+    for g, glom in enumerate(gl):
+        for rec, weight in glom.rec_conn_map.items():
+            weights[g, index[id(rec)]] += weight
+    return weights
 
 def attachSecondaryRecs(gl: list[cells.Glom], recs: list[Receptor], c: int, conn: list[list[int]]) -> list[list[int]]:
     """Given gl with primary rec attachments, this function attaches the remaining recs
     if constant=true, then attaches surrounding 8 recs, otherwise it's random assignment.
     If conn = [], randomly assign. If conn isn't empty, than use the given conn info to attach recs
+    (see glomConnWeights). Each glom's rec_conn_map is replaced by its primary and secondary recs.
     Returns conn"""
+    weights, conn = glomConnWeights(len(recs), c, conn)
+    _setRecConnMaps(gl, recs, weights)
+    return conn
 
-    if config.CONSTANT_ATTACHMENTS: #Loop through glom and find all surrounding gloms to add their recs as secondary
-        for glom in gl: 
-            locations = getLocations(glom.loc)
-            i = 0
-            for glom2 in gl:
-                if glom2.loc in locations:
-                    for rec in glom2._recConn.keys():
-                        # FIXME: Shouldn't access private vars outside of class
-                        if glom2._recConn[rec] == config.GLOM_PENETRANCE:
-                            glom._recConn[rec] = s_weights[i]
-                    i += 1
 
-    else: #Randomly assign secondary rec attachments
-        ints = range(0,len(recs))
-        
-        if conn == []: #No prior connection restrictions
-            for glom in gl:
-                connections = []
-                i = 0
-                while i < c-1:
-                    index = utils.RNG.choice(ints)
-                    rec = recs[index]
-                    # FIXME: Shouldn't access private vars outside of class
-                    while rec in glom._recConn.keys(): #Choose random rec until find one that isn't connected yet
-                        index = utils.RNG.choice(ints)
-                        rec = recs[index]
-                    glom._recConn[rec] = s_weights[i]
-                    connections.append(index)
-                    i += 1
-                conn.append(connections)
-
-        else: #need glom-rec conn to be identical to past conn
-            x = 0
-            for glom in gl:
-                i = 0
-                while i < c-1:
-                    glom._recConn[recs[conn[x][i]]] = s_weights[i]
-                    i += 1
-                x += 1
-
-    return conn
+def torusNeighbors(numRow: int, numCol: int) -> np.ndarray:
+    """Returns the (numRow*numCol X 8) array of the gloms surrounding each glom of a numRow X numCol
+    tourus, where glom i is at (i // numCol, i % numCol). The columns are in getLocations's order.
+    Tables are computed once per grid shape and shared (they are read only)."""
+    if (numRow, numCol) not in _torusNeighborTables:
+        rows, cols = np.divmod(np.arange(numRow*numCol), numCol)
+        offsets = np.array([(-1,-1),(0,-1),(1,-1),(-1,0),(1,0),(-1,1),(0,1),(1,1)])
+        table = ((rows[:, None] + offsets[:, 0]) % numRow)*numCol + (cols[:, None] + offsets[:, 1]) % numCol
+        table.setflags(write=False)
+        _torusNeighborTables[numRow, numCol] = table
+    return _torusNeighborTables[numRow, numCol]
 
+_torusNeighborTables: dict[tuple[int, int], np.ndarray] = {}
 
 def getLocations(location: tuple[float, float]):
     """Returns a list of 8 locations (2d list) that surround loc (modular
@@ -2817,5 +3518,3 @@ def getLocations(location: tuple[float, float]):
     return locations
     
     
-##############################To make everything more efficient - at the moment sum of squares calculates the same activ_1
-#over and over again when called by dPsi angles (it only calculates a new activ_2) - can make a lot more efficient
\ No newline at end of file
@@ -1,6 +1,6 @@
 
 __all__ = [
-    'cells', 'config', 'experiments', 'layers', 'RnO', 'smoothFuncs',
+    'cells', 'config', 'engine', 'experiments', 'layers', 'results', 'RnO', 'smoothFuncs',
     'testLayers', 'testRnO', 'utils'
 ]
 
@@ -15,4 +15,11 @@ def reload(rebuild_cache=True):
     for module_name in __all__:
         globals()[module_name] = import_module(f'.{module_name}', __package__)
 
-reload(rebuild_cache=False)
+def __getattr__(name):
+    """
+    Imports submodules on first access, so `import odorsampling` stays fast.
+    """
+    if name in __all__:
+        from importlib import import_module
+        return import_module(f'.{name}', __package__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
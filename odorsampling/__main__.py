@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import os
 import sys
+import subprocess
 from argparse import ArgumentParser
+from importlib import import_module
 from pprint import pprint
 import platform
 
 import yaml
-import matplotlib
 
-from . import config, experiments, testLayers, testRnO, utils
+# experiments (and with it numpy) and the test modules are imported once they're needed,
+# so `--help` and `--import-time` return quickly
+from . import config, utils
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from typing import Iterable, Mapping, Optional
+    from . import experiments
 
 
 # These may no longer be necessary. Will remove once I'm sure.
@@ -107,6 +112,32 @@ CMD_MAP: Mapping[str, tuple[list, dict]] = {
             'help': "Used to set the angle reps, scientific notation is allowed."
         },
     ),
+    'nested_odorscenes': (
+        ['-no', '--nested-odorscenes'],
+        {
+            'action': 'store_true',
+            'help': "Each odorscene of a saturation curve extends the one before it with more ligands, "
+                    "so the curve is computed incrementally."
+        },
+    ),
+    'connectome_policy': (
+        ['-cp', '--connectome-policy'],
+        {
+            'action': 'store',
+            'type': str,
+            'choices': ['call', 'repetition', 'epithelium'],
+            'help': "If c != 1, whether glom:rec connections are drawn for every dPsi calculation ('call'), once per "
+                    "repetition of a saturation curve ('repetition') or once per epithelium ('epithelium')."
+        },
+    ),
+    'scalable_gloms': (
+        ['-sg', '--scalable-gloms'],
+        {
+            'action': 'store_true',
+            'help': "Glomerular layers of any size are deployed on the most square grid that fits them (unless "
+                    "NUM_ROW X NUM_COL does) and connected to receptors with array operations, for any c."
+        },
+    ),
     'perform_experiment': (
         ['-pe', '--perform-experiment'],
         {
@@ -137,6 +168,54 @@ CMD_MAP: Mapping[str, tuple[list, dict]] = {
             'help': "Used to set the backend used by matplotlib for the graphs."
         },
     ),
+    'import_time': (
+        ['-it', '--import-time'],
+        {
+            'action': 'store',
+            'type': float,
+            'nargs': '?',
+            'const': config.IMPORT_TIME_BUDGET,
+            'metavar': 'BUDGET',
+            'help': "Measures how long importing the modules needed for a run takes in a fresh interpreter, reports it "
+                    "against BUDGET seconds (config.IMPORT_TIME_BUDGET by default) and exits. The exit status is 1 if "
+                    "it is over budget."
+        },
+    ),
+    'saturation_cache_dir': (
+        ['-scd', '--saturation-cache-dir'],
+        {
+            'action': 'store',
+            'type': str,
+            'metavar': 'DIR',
+            'help': "Caches dPsiBarSaturation results in DIR and reuses them when the epithelium, settings and "
+                    "random state are the same. See also config.SATURATION_CACHE_SIZE."
+        },
+    ),
+    'clear_cache': (
+        ['-cc', '--clear-cache'],
+        {
+            'action': 'store_true',
+            'help': "Removes every entry of the saturation cache (--saturation-cache-dir) and exits."
+        },
+    ),
+    'checkpoint_dir': (
+        ['-ckd', '--checkpoint-dir'],
+        {
+            'action': 'store',
+            'type': str,
+            'metavar': 'DIR',
+            'help': "Saves the progress of long runs (eg. dPsiBarSaturation) in DIR every config.CHECKPOINT_INTERVAL "
+                    "seconds, so they can be continued with --resume."
+        },
+    ),
+    'resume': (
+        ['-r', '--resume'],
+        {
+            'action': 'store_true',
+            'help': "Continues runs from their checkpoints in --checkpoint-dir. The same experiment file, arguments "
+                    "and seed must be used; the outputs are then the same as those of an uninterrupted run."
+        },
+    ),
     'random_seed': (
         ['-rs', '--random-seed'],
         {
@@ -173,14 +252,61 @@ def _special_init(namespace, name, init_factory, *args, **kwargs):
 #     if not getattr(namespace, name, None):
 #         setattr(namespace, name, init_factory())
 
-TESTS = {
-    'layers': [testLayers.test],
-    'RnO': [testRnO.test]
+TESTS: Mapping[str, list[str]] = {
+    'layers': ['testLayers.test'],
+    'RnO': ['testRnO.test']
 }
+"""
+Test functions of each test name, as 'module.function' in this package. Modules are imported when the test is run.
+"""
+
+IMPORT_TIME_MODULES = (f'{config.NAME}.__main__', f'{config.NAME}.experiments')
+"""
+Modules imported by every run, measured by `--import-time`.
+"""
+DEFERRED_MODULES = ('matplotlib', 'scipy')
+"""
+Slow to import modules that are only loaded once they are used.
+"""
+
+def import_times(modules: Iterable[str] = IMPORT_TIME_MODULES) -> dict[str, float]:
+    """
+    Imports `modules` in a fresh interpreter with `-X importtime` and returns the cumulative import time
+    (in seconds) of every module that was loaded, in import order.
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path)))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, env=env)
+    if proc.returncode:
+        raise RuntimeError(f"Unable to import {', '.join(modules)}:\n{proc.stderr}")
+    times: dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name[1:].rstrip()] = int(cumulative) / 1e6
+    return times
+
+def report_import_time(budget: float) -> bool:
+    """
+    Prints the time importing the modules needed for a run takes. Returns True if it is within `budget` seconds.
+    """
+    times = import_times()
+    # Top level imports aren't indented, so their cumulative times add up to the total
+    total = sum(t for name, t in times.items() if not name.startswith(' '))
+    print("Slowest imports (cumulative seconds):")
+    for name, t in sorted(times.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print(f"    {t:8.4f}  {name.strip()}")
+    loaded = [name for name in DEFERRED_MODULES if name in map(str.strip, times)]
+    print(f"Deferred until used: {', '.join(DEFERRED_MODULES)}. Imported anyway: {', '.join(loaded) or 'none'}.")
+    within = total <= budget
+    print(f"Total import time: {total:.4f}s, budget: {budget:.4f}s. {'Within' if within else 'OVER'} budget.")
+    return within
 
 
 def perform_experiments(experiments_to_run: Iterable[str], experiments_: Mapping[str, experiments.Experiment]):
     print(f"Performing experiments... {','.join(map(str, experiments_to_run))}")
+    from . import experiments
 
     experiments.test((experiments_[name] for name in experiments_to_run))
 
@@ -189,7 +315,9 @@ def perform_tests(test_names: Iterable[str]):
     for test in test_names:
         if test in TESTS:
             print(f"Performing test `{test}`.")
-            [subtest() for subtest in TESTS[test]]
+            for subtest in TESTS[test]:
+                module, func = subtest.rsplit('.', 1)
+                getattr(import_module(f'.{module}', __package__), func)()
 
 def main() -> None:
     parser = prep_parser()
@@ -201,13 +329,32 @@ def main() -> None:
     _special_init(known_args, 'perform_experiment', list)
     _special_init(known_args, 'run_tests', list)
 
+    if known_args.import_time is not None:
+        sys.exit(0 if report_import_time(known_args.import_time) else 1)
+
+    # Handled before the experiment YAML is loaded, so the cache can be cleared without one
+    if known_args.clear_cache:
+        from .results import SaturationCache
+        cache_dir = known_args.saturation_cache_dir or config.SATURATION_CACHE_DIR
+        if cache_dir is None:
+            print("No saturation cache directory is set.")
+            sys.exit(1)
+        cache = SaturationCache(str(cache_dir), config.SATURATION_CACHE_SIZE)
+        print(f"Removed {cache.invalidate()} entries from the saturation cache in '{cache.path}'.")
+        sys.exit(0)
+
     # Matplotlib backend
-    try:
-        matplotlib.use(known_args.mpl_backend)
-    except ModuleNotFoundError as e:
-        print(f"Unable to load matplotlib backend '{known_args.mpl_backend}'. Please ensure any required packages are installed to use this backend.")
-        print(e, file=sys.stderr)
-    print(f"Using {matplotlib.get_backend()} as the matplotlib backend.")
+    if 'matplotlib' in sys.modules:
+        import matplotlib
+        try:
+            matplotlib.use(known_args.mpl_backend)
+        except ModuleNotFoundError as e:
+            print(f"Unable to load matplotlib backend '{known_args.mpl_backend}'. Please ensure any required packages are installed to use this backend.")
+            print(e, file=sys.stderr)
+    else:
+        # matplotlib reads this once it is first imported
+        os.environ['MPLBACKEND'] = known_args.mpl_backend
+    print(f"Using {known_args.mpl_backend} as the matplotlib backend.")
 
     # YAML config
     yaml_config: dict = {
@@ -233,6 +380,8 @@ def main() -> None:
         if value is not None and not key.startswith('__'):
             setattr(config, key.upper(), value)
     
+    from . import experiments
+
     # Validate YAML functions
     try:
         experiments_ = experiments.validate_exp_map(yaml_config['experiments'], experiments.validate_func_map(yaml_config['functions']))
@@ -242,6 +391,9 @@ def main() -> None:
         print("Invalid function map in experiment YAML file.")
         print(e, file=sys.stderr)
         sys.exit(1)
+    if config.RESUME and config.CHECKPOINT_DIR is None:
+        print("--resume needs a checkpoint directory (--checkpoint-dir).")
+        sys.exit(1)
     utils.set_seed(config.RANDOM_SEED)
     
     print("Configuration:")
@@ -13,7 +13,7 @@ import builtins
 from abc import ABC
 # Used for asserts
 if builtins.__debug__:
-    from numbers import Rational, Integral
+    from numbers import Rational, Real, Integral
 
 from odorsampling import config, utils
 
@@ -114,19 +114,19 @@ class Cell(ABC):
         """
         Returns location of the glom.
 
-        As a property, any pair of Rational numbers can be assigned to loc, as it will be converted to a tuple[float, float].
+        As a property, any pair of Real numbers can be assigned to loc, as it will be converted to a tuple[float, float].
         Sets value to loc.
 
         Parameters
         ----------
         value
-            is a tuple of Rational numbers
+            is a tuple of Real numbers
         """
         return self._loc
 
     @loc.setter
-    def loc(self, value: tuple[Rational, Rational]) -> None:
-        assert len(value) == 2 and all(map(lambda x: isinstance(x, Rational), value)) and isinstance(value, tuple), "Not a pair of numbers!"
+    def loc(self, value: tuple[Real, Real]) -> None:
+        assert len(value) == 2 and all(map(lambda x: isinstance(x, Real), value)) and isinstance(value, tuple), "Not a pair of numbers!"
         self._loc = tuple(map(float, value))
     
     def __init__(self, id_: Optional[Integral], activ: Rational, loc: tuple[Rational, Rational]) -> None:
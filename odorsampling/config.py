@@ -44,6 +44,23 @@ S_WEIGHTS = [0.12,0.08,0.03,0.03,0.02,0.02,0.01,0.01] # The remaining glom:rec c
 NUM_ROW = 6 # num of rows of glom
 NUM_COL = 5 # num of cols of glom  (numRow*numCol = total number of Glom)
 CONSTANT_ATTACHMENTS = True
+CONNECTOME_POLICY = "call" # If c != 1, how long the glom:rec connections of dPsi calculations are kept (matters for
+                           # random attachments): "call" = new ones for every calculation, "repetition" = one set per
+                           # repetition of dPsiBarSaturation, "epithelium" = one set per epithelium
+SCALABLE_GLOMS = False # If True, glom layers of any size are deployed on NUM_ROW X NUM_COL (or the most square grid
+                       # that fits them) and connected to c recs with array operations (see RnO.glomConvergence)
+SPARSE_CUTOFF_SD = None # If set, receptor-ligand pairs more than this many SDs apart are not evaluated
+                        # and are treated as being at the MIN_AFFINITY asymptote (eg. 6 for large qspaces)
+NESTED_ODORSCENES = False # If True, each of dPsiBarSaturation's odorscenes adds ligands to the one before it
+                          # (the curve is computed incrementally, about an order of magnitude faster)
+TEXT_CHUNK_SIZE = 1 << 20 # Characters of rec/glom rows RnO.TextStream holds before writing them to disk
+IMPORT_TIME_BUDGET = 0.5 # Seconds importing the modules a run needs may take (see `--import-time`)
+SATURATION_CACHE_DIR = None # If set, dPsiBarSaturation results are cached in this directory and reused when
+                            # the epithelium, settings and random state are the same
+SATURATION_CACHE_SIZE = 1 << 30 # Bytes the saturation cache is kept under, least recently used runs are removed first
+CHECKPOINT_DIR = None # If set, long runs (eg. dPsiBarSaturation) save their progress in this directory
+CHECKPOINT_INTERVAL = 60 # Seconds between checkpoints
+RESUME = False # Continue runs from their checkpoints in CHECKPOINT_DIR instead of starting over
 
 # location distributions control params, eg., uniform, gaussian...1 and only 1 type needs to be true at any given time
 DIST_TYPE_GAUSS = False
@@ -120,6 +137,8 @@ MOCK_RECEPTOR_SDE2 = [0.760607106742, 0.65383818835]
 
 # HEAT MAP
 PIXEL_PER_Q_UNIT = 20
+COLOR_MAP_RASTER = False # If True, receptor activations are rasterized once and every pixel's dPsiBar comes from
+                         # shifted copies of the raster, in the same directions for every pixel (see RnO.colorMapDPsiBars)
 
 del logging
 del builtins
@@ -0,0 +1,307 @@
+"""
+    Vectorized kernels for receptor-ligand binding.
+    This includes:
+        - Gaussian tuning of every receptor to every ligand location
+        - Affinity (converted to kDa) and efficacy matrices for a set of receptors
+        - Competitive-binding occupancy and receptor activation
+        - A sparse variant that only evaluates receptor-ligand pairs within a cutoff
+
+    Everything here works on plain numpy arrays. Receptors are given as (R, Q) arrays
+    of means and standard deviations, ligand locations as (..., L, Q) arrays, and results
+    are returned with shape (..., R, L), so any number of odorscenes can be stacked on the
+    leading axes and evaluated in one call.
+"""
+
+from __future__ import annotations
+
+import logging
+
+import numpy as np
+
+from odorsampling import config, utils
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Optional
+    from numpy.typing import ArrayLike
+
+
+logger = logging.getLogger(__name__)
+utils.default_log_setup(logger)
+
+
+def gaussian_ratio(mean: ArrayLike, sd: Optional[ArrayLike], locs: ArrayLike, out: Optional[np.ndarray] = None,
+                   inv_var: Optional[ArrayLike] = None) -> np.ndarray:
+    """
+    Returns the diagonal gaussian of every receptor evaluated at every location, scaled so
+    that the value at the receptor's mean is 1.
+
+    This is equal to `mvn.pdf(loc, mean, sd**2) / mvn.pdf(mean, mean, sd**2)`, without the
+    per-pair scipy overhead.
+
+    Parameters
+    ----------
+    mean
+        (R, Q) receptor means.
+    sd
+        (R, Q) receptor standard deviations.
+    locs
+        (..., L, Q) ligand locations.
+    out
+        Optional (..., R, L) array to write the result into.
+    inv_var
+        Optional precomputed (R, Q) `1/sd**2`. If given, `sd` is not used.
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    if inv_var is None:
+        inv_var = 1.0 / np.square(np.asarray(sd, dtype=np.float64))
+    else:
+        inv_var = np.asarray(inv_var, dtype=np.float64)
+    locs = np.asarray(locs, dtype=np.float64)
+    shape = locs.shape[:-2] + (mean.shape[0], locs.shape[-2])
+    if out is None:
+        out = np.zeros(shape)
+    else:
+        assert out.shape == shape, f"out has shape {out.shape}, expected {shape}"
+        out.fill(0.0)
+
+    # Accumulate the squared mahalanobis distance one dimension at a time so only
+    # (..., R, L) temporaries are created.
+    for q in range(mean.shape[1]):
+        d = locs[..., np.newaxis, :, q] - mean[:, q, np.newaxis]
+        d *= d
+        d *= inv_var[:, q, np.newaxis]
+        out += d
+    out *= -0.5
+    np.exp(out, out=out)
+    return out
+
+def affinity_kda(ratio: np.ndarray, out: Optional[np.ndarray] = None, peak: Optional[float] = None,
+                 minimum: Optional[float] = None) -> np.ndarray:
+    """
+    Converts gaussian affinities scaled from 0 to 1 into kDa using config.PEAK_AFFINITY and
+    config.MIN_AFFINITY, unless `peak` or `minimum` are given.
+    """
+    peak = config.PEAK_AFFINITY if peak is None else peak
+    minimum = config.MIN_AFFINITY if minimum is None else minimum
+    out = np.multiply(ratio, peak - minimum, out=out)
+    out += minimum
+    np.power(10.0, out, out=out)
+    return out
+
+def affinity_efficacy(mean: ArrayLike, sdA: ArrayLike, sdE: ArrayLike, locs: ArrayLike, fixed: bool = False,
+                      inv_var: Optional[tuple[ArrayLike, ArrayLike]] = None, **kda_kwargs) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the affinity (kDa) and efficacy matrices of every receptor for every ligand.
+
+    Parameters
+    ----------
+    mean, sdA, sdE
+        (R, Q) receptor means and affinity/efficacy standard deviations.
+    locs
+        (..., L, Q) ligand locations.
+    fixed
+        If True, efficacy is fixed at 1 (only agonists).
+    inv_var
+        Optional precomputed `(1/sdA**2, 1/sdE**2)`.
+    kda_kwargs
+        `peak` and `minimum` overrides passed to `affinity_kda`.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        (aff, eff), each with shape (..., R, L).
+    """
+    inv_varA, inv_varE = (None, None) if inv_var is None else inv_var
+    aff = affinity_kda(gaussian_ratio(mean, sdA, locs, inv_var=inv_varA), **kda_kwargs)
+    if fixed:
+        eff = np.ones_like(aff)
+    else:
+        eff = gaussian_ratio(mean, sdE, locs, inv_var=inv_varE)
+    return aff, eff
+
+def occupancy(aff: ArrayLike, eff: ArrayLike, conc: ArrayLike, mask: Optional[ArrayLike] = None,
+              out: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solves competitive binding of every ligand to every receptor.
+
+    For each receptor, `df = sum(conc/aff)` over the ligands of its odorscene, and each
+    ligand's partial occupancy is `1/(1 + (aff/conc)*(1 + df - conc/aff))**config.HILL_COEFF`.
+
+    Parameters
+    ----------
+    aff
+        (..., R, L) affinities in kDa, eg) shape (batch, receptors, ligands).
+    eff
+        (..., R, L) efficacies [0..1]. Must broadcast against aff.
+    conc
+        (..., L) concentrations of the ligands of each odorscene.
+    mask
+        Optional (..., L) boolean array. Ligands that are False (padding) do not bind.
+    out
+        Optional (..., R) array to write the activations into.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        (occ, activ, totOcc): the (..., R, L) partial occupancies, and the (..., R)
+        activation and total occupancy of each receptor.
+    """
+    aff = np.asarray(aff, dtype=np.float64)
+    conc = np.asarray(conc, dtype=np.float64)[..., np.newaxis, :]
+    ratio = conc / aff
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)[..., np.newaxis, :]
+        ratio = np.where(mask, ratio, 0.0)
+    df = ratio.sum(axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        occ = (aff / conc) * (1 + df - ratio)
+        occ **= config.HILL_COEFF
+        occ += 1
+        np.reciprocal(occ, out=occ)
+    if mask is not None:
+        occ = np.where(mask, occ, 0.0)
+    activ = np.sum(np.asarray(eff) * occ, axis=-1, out=out)
+    return occ, activ, occ.sum(axis=-1)
+
+def prefix_occupancy(aff: ArrayLike, eff: ArrayLike, conc: ArrayLike, counts: ArrayLike
+                     ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the activation and total occupancy of every receptor for each of the nested
+    odorscenes made of the first `counts[k]` ligands, like `occupancy` on `[..., :counts[k]]`.
+
+    `df` of each odorscene is read off a running sum over the ligands, so each ligand's term is
+    only added once. With `config.HILL_COEFF == 1` the partial occupancy of a ligand reduces to
+    `(conc/aff)/(1 + df)`, so the activation is `sum(eff*conc/aff)/(1 + df)` and the whole
+    curve costs one pass over the largest odorscene instead of one pass per odorscene. Other
+    Hill coefficients evaluate each odorscene with `occupancy`.
+
+    Parameters
+    ----------
+    aff
+        (..., R, L) affinities in kDa of every ligand of the largest odorscene.
+    eff
+        (..., R, L) efficacies [0..1]. Must broadcast against aff.
+    conc
+        (..., L) concentrations of the ligands.
+    counts
+        (K,) increasing number of ligands in each odorscene, at most L.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        (activ, totOcc), each with shape (K, ..., R).
+    """
+    aff = np.asarray(aff, dtype=np.float64)
+    conc = np.asarray(conc, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.int64)
+    assert counts.ndim == 1 and np.all(np.diff(counts) > 0) and 0 < counts[0] and counts[-1] <= aff.shape[-1], \
+        "counts must be increasing numbers of ligands"
+    if config.HILL_COEFF != 1:
+        results = [occupancy(aff[..., :n], np.asarray(eff)[..., :n], conc[..., :n])[1:] for n in counts]
+        return np.stack([activ for activ, _ in results]), np.stack([totOcc for _, totOcc in results])
+
+    ratio = conc[..., np.newaxis, :] / aff
+    df = np.moveaxis(np.cumsum(ratio, axis=-1)[..., counts-1], -1, 0)
+    bound = np.moveaxis(np.cumsum(ratio * eff, axis=-1)[..., counts-1], -1, 0)
+    return bound / (1 + df), df / (1 + df)
+
+def adjacent_counts(mean: ArrayLike, sdA: ArrayLike, locs: ArrayLike, mask: Optional[ArrayLike] = None) -> np.ndarray:
+    """
+    Returns the (..., R) number of ligands within 2 average affinity SDs (euclidean) of
+    each receptor's mean.
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    locs = np.asarray(locs, dtype=np.float64)
+    radius = 2.0 * np.asarray(sdA, dtype=np.float64).mean(axis=1)
+    dist = np.zeros(locs.shape[:-2] + (mean.shape[0], locs.shape[-2]))
+    for q in range(mean.shape[1]):
+        d = locs[..., np.newaxis, :, q] - mean[:, q, np.newaxis]
+        dist += d*d
+    near = np.sqrt(dist) <= radius[:, np.newaxis]
+    if mask is not None:
+        near &= np.asarray(mask, dtype=bool)[..., np.newaxis, :]
+    return near.sum(axis=-1).astype(np.float64)
+
+def sparse_occupancy(mean: ArrayLike, sdA: ArrayLike, sdE: ArrayLike, locs: ArrayLike, conc: ArrayLike,
+                     cutoff: float, fixed: bool = False,
+                     inv_var: Optional[tuple[ArrayLike, ArrayLike]] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the activation and total occupancy of every receptor for a single odorscene, only
+    evaluating receptor-ligand pairs that are within `cutoff` standard deviations of each other.
+
+    The ligands are indexed with a k-d tree and each receptor queries the ball of radius
+    `cutoff * max(sdA, sdE)` around its mean, so the work done scales with the number of nearby
+    pairs instead of R*L. Every other pair is treated as being at the asymptote: affinity
+    `10**MIN_AFFINITY` and efficacy 0 (1 if `fixed`). Their contribution to `df`, occupancy and
+    activation is added analytically, grouped by concentration.
+
+    Parameters
+    ----------
+    mean, sdA, sdE
+        (R, Q) receptor means and affinity/efficacy standard deviations.
+    locs
+        (L, Q) ligand locations.
+    conc
+        (L,) ligand concentrations.
+    cutoff
+        Number of standard deviations past which a pair is considered negligible.
+    fixed
+        If True, efficacy is fixed at 1 (only agonists).
+    inv_var
+        Optional precomputed `(1/sdA**2, 1/sdE**2)`.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        (activ, totOcc), each with shape (R,).
+    """
+    from scipy.spatial import cKDTree
+
+    mean = np.asarray(mean, dtype=np.float64)
+    sdA = np.asarray(sdA, dtype=np.float64)
+    sdE = np.asarray(sdE, dtype=np.float64)
+    locs = np.asarray(locs, dtype=np.float64)
+    conc = np.asarray(conc, dtype=np.float64)
+    if inv_var is None:
+        inv_var = (1.0 / np.square(sdA), 1.0 / np.square(sdE))
+    inv_varA, inv_varE = (np.asarray(iv, dtype=np.float64) for iv in inv_var)
+    num_recs = mean.shape[0]
+
+    # Pairs (rows[i], cols[i]) that are close enough to be evaluated exactly
+    sd_max = sdA.max(axis=1) if fixed else np.maximum(sdA, sdE).max(axis=1)
+    near = cKDTree(locs).query_ball_point(mean, cutoff * sd_max)
+    counts = np.fromiter(map(len, near), dtype=np.int64, count=num_recs)
+    rows = np.repeat(np.arange(num_recs), counts)
+    cols = np.fromiter((j for lst in near for j in lst), dtype=np.int64, count=counts.sum())
+
+    d2 = np.square(locs[cols] - mean[rows])
+    aff = affinity_kda(np.exp(-0.5 * (d2 * inv_varA[rows]).sum(axis=1)))
+    eff = np.ones_like(aff) if fixed else np.exp(-0.5 * (d2 * inv_varE[rows]).sum(axis=1))
+
+    # Ligands are grouped by concentration so far pairs can be counted instead of evaluated
+    aff_far = 10.0 ** config.MIN_AFFINITY
+    eff_far = 1.0 if fixed else 0.0
+    levels, level_index = np.unique(conc, return_inverse=True)
+    far_counts = np.bincount(level_index, minlength=len(levels)) - np.stack(
+        [np.bincount(rows[level_index[cols] == u], minlength=num_recs) for u in range(len(levels))], axis=1)
+
+    ratio = conc[cols] / aff
+    df = np.bincount(rows, ratio, minlength=num_recs) + (far_counts * levels).sum(axis=1) / aff_far
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        occ = (aff / conc[cols]) * (1 + df[rows] - ratio)
+        occ **= config.HILL_COEFF
+        occ += 1
+        np.reciprocal(occ, out=occ)
+        occ_far = (aff_far / levels) * (1 + df[:, np.newaxis] - levels / aff_far)
+        occ_far **= config.HILL_COEFF
+        occ_far += 1
+        np.reciprocal(occ_far, out=occ_far)
+    occ_far = (far_counts * occ_far).sum(axis=1)
+
+    activ = np.bincount(rows, eff * occ, minlength=num_recs) + eff_far * occ_far
+    tot_occ = np.bincount(rows, occ, minlength=num_recs) + occ_far
+    return activ, tot_occ
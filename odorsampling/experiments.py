@@ -8,30 +8,33 @@
 from __future__ import annotations
 
 import time
-import multiprocessing
 import logging
 import math
 from dataclasses import dataclass, field
 from collections import ChainMap
 import inspect
 
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-from scipy.stats import multivariate_normal as mvn
+import numpy as np
 
-from odorsampling import config, layers, utils
+from odorsampling import config, layers, utils, engine
 from odorsampling.RnO import (
     QSpace, Epithelium, Ligand, Receptor, Odorscene,
-    dPsiBarSaturation, dPsiGraphFromExcel, graphFromExcel, dPsiOccActGraphFromExcel, activateGL_QSpace
+    dPsiBarSaturation, dPsiBarSaturations, dPsiGraphFromExcel, graphFromExcel, dPsiOccActGraphFromExcel, activateGL_QSpace
 )
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from typing import Callable, Mapping, Sequence, Iterable, Any
+    from typing import Callable, Mapping, Sequence, Iterable, Any, Optional
+    from odorsampling.results import SaturationResults
 
 logger = logging.Logger(__name__)
 utils.default_log_setup(logger)
 
+# matplotlib and scipy are slow to import, so they are only loaded once used
+plt = utils.lazy_import("matplotlib.pyplot")
+PdfPages = utils.lazy_import("matplotlib.backends.backend_pdf", "PdfPages")
+mvn = utils.lazy_import("scipy.stats", "multivariate_normal")
+
 
 # TODO: Factor this out
 def purpFunction(purpose, aff_sd: tuple[float,float]=(0.5, 1.5), eff_sd: tuple[float, float]=(0.05, 1.0), numRecs=30, c=1, dim=2):
@@ -82,8 +85,11 @@ def makeSimilar(numRecs, aff_sd: tuple[float, float], eff_sd: tuple[float, float
         
 
 @utils.verbose_if_debug
-def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard", rep=200.0):
-    """Given excel docs in correct directories, this creates a dpsiSaturation graph and act and occ graphs"""
+def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard", rep=200.0,
+                       results: Optional[Sequence[SaturationResults]] = None):
+    """Given excel docs in correct directories, this creates a dpsiSaturation graph and act and occ graphs
+    results = the SaturationResults of each qspace returned by dPsiBarSaturations. If given, they are
+    graphed instead of reading the excel docs."""
     
     purp = purpFunction(purpose, aff_sd, eff_sd, numRecs, c, dim)
     xaxis = [1,2,3,4,5,7,10,15,20,25,30,35,40,45,50,60,70,80,90,100,120,140,160,200,250,300,350,400] #xaxis for dPsi vs num of ligands
@@ -104,6 +110,8 @@ def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim
             j+=1
         qspaceList.append(QSpace(space))
         dPsiName.append("dPsi, qspace=" + str(qspaceList[i].size[0]) + purp + ".csv")
+        if results is not None:
+            dPsiName[i] = results[i]
 
         if i == (len(qspaces)-1):
             end = True
@@ -128,12 +136,14 @@ def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim
         end = False
         while k < len(qspaces):
             labelNames.append(str(qspaceList[k].size[0]) + " qspace")
-            excelName.append("LigandSat with " + str(qspaceList[k].size[0]) + " qspace" + purp)
+            excelName.append("LigandSat with " + str(qspaceList[k].size[0]) + " qspace" + purp + ".csv")
+            if results is not None:
+                excelName[k] = results[k]
             
             if k == (len(qspaces)-1):
                 end = True
 
-            graphFromExcel(excelName[k] + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
+            graphFromExcel(excelName[k], xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
             k += 1
             
     ###Extra dPsi vs occ and act graph
@@ -145,7 +155,7 @@ def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim
         pdfName = "DpsiBar vs Occ and Act" + purp
         if k == (len(qspaces)-1):
             end = True
-        dPsiOccActGraphFromExcel(dPsiName[k], excelName[k]+".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, colors[k%5], rep, end)
+        dPsiOccActGraphFromExcel(dPsiName[k], excelName[k], xaxis, numRecs, labelNames[k], titleName, pdfName, colors[k%5], rep, end)
         k += 1
             
 
@@ -159,12 +169,16 @@ def allGraphsFromExcel(aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim
         while k < len(qspaces):
             if k == (len(qspaces)-1):
                 end = True
-            name = "Glom_act with c=" + str(c) + " with " + str(qspaceList[k].size[0]) + " qspace"
-            graphFromExcel(name + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, "Act", rep, end)
+            if results is None:
+                name = "Glom_act with c=" + str(c) + " with " + str(qspaceList[k].size[0]) + " qspace"
+                graphFromExcel(name + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, "Act", rep, end)
+            else:
+                graphFromExcel(results[k], xaxis, numRecs, labelNames[k], titleName, pdfName, "Glom", rep, end)
             k += 1
 
 
-def psi_bar_saturation_dim(dims, fixed=False, aff_sd=[.5,1.5], eff_sd=[.05,1.0], numRecs=30, c=1, graph=False):
+def psi_bar_saturation_dim(dims, fixed=False, aff_sd=[.5,1.5], eff_sd=[.05,1.0], numRecs=30, c=1, graph=False,
+                           workers: Optional[int] = None):
     """Runs 4 simulations of differing dimensions determined by dims all with (0,4) qspace.
     Since each simulation has an added dimension, it wasn't possible
     to make the epithelium identical. Therefore, all means, aff and eff
@@ -174,6 +188,7 @@ def psi_bar_saturation_dim(dims, fixed=False, aff_sd=[.5,1.5], eff_sd=[.05,1.0],
     
     dims= list of ints that represent dimension.
     fixed = True if want eff=1
+    workers = number of processes to run the dimensions in at the same time (see dPsiBarSaturations)
     
     Can uncomment loadEpithelium lines if you have saved epi excel docs"""
     
@@ -181,8 +196,9 @@ def psi_bar_saturation_dim(dims, fixed=False, aff_sd=[.5,1.5], eff_sd=[.05,1.0],
     plotTitle = "Saturation of dPsiBar, varying dim"
     labels = []
     excels = []
-    end = False
-    index = 0
+    purps = []
+    qspaces = []
+    epiths = []
     for dim in dims:
 
         space = []
@@ -197,21 +213,21 @@ def psi_bar_saturation_dim(dims, fixed=False, aff_sd=[.5,1.5], eff_sd=[.05,1.0],
         
         labels.append(str(dim) + "D")
         excels.append("LigandSat with (0, 4) qspace, dim=" + str(dim))
-        
-        if index == (len(dims) - 1):
-            end = True
+        purps.append(', dim=' + str(dim))
+        qspaces.append(qspace)
+        epiths.append(epith)
 
-        dPsiBarSaturation(epith, .01, qspace, pdfName, labels[index], excels[index], fixed, c, plotTitle, end,  ', dim=' + str(dim), False)
-        index += 1
+    runs = dPsiBarSaturations(epiths, .01, qspaces, pdfName, labels, excels, fixed, c, plotTitle, purps, False, workers)
     
     if graph:
-        dimAllGraphsFromExcel(numRecs, dims)
+        dimAllGraphsFromExcel(numRecs, dims, config.ODOR_REPETITIONS, runs)
     
 
         
 
-def dimAllGraphsFromExcel(numRecs=30, dims=[2,3,4,5], rep=200.0):
-    """Same as function above, but adjusted slightly to account for different dimensions."""
+def dimAllGraphsFromExcel(numRecs=30, dims=[2,3,4,5], rep=200.0, results: Optional[Sequence[SaturationResults]] = None):
+    """Same as function above, but adjusted slightly to account for different dimensions.
+    results = the SaturationResults of each dimension returned by dPsiBarSaturations"""
     
     ####Creating dPsiSaturation graphs
     i = 0
@@ -229,6 +245,8 @@ def dimAllGraphsFromExcel(numRecs=30, dims=[2,3,4,5], rep=200.0):
         qspace = QSpace(space)
 
         dPsiName.append("dPsi, qspace=" + str(qspace.size[0]) + ", dim=" + str(dim) + ".csv")
+        if results is not None:
+            dPsiName[i] = results[i]
 
         if i == (len(dims)-1):
             end = True
@@ -259,9 +277,11 @@ def dimAllGraphsFromExcel(numRecs=30, dims=[2,3,4,5], rep=200.0):
                 end = True
 
             labelNames.append(str(dims[k]) + "D")
-            excelName.append("LigandSat with (0, 4) qspace, dim=" + str(dims[k]))
+            excelName.append("LigandSat with (0, 4) qspace, dim=" + str(dims[k]) + ".csv")
+            if results is not None:
+                excelName[-1] = results[k]
 
-            graphFromExcel(excelName[k] + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
+            graphFromExcel(excelName[k], xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
             k += 1
     
     ###Extra dPsi vs occ and act graph
@@ -273,13 +293,13 @@ def dimAllGraphsFromExcel(numRecs=30, dims=[2,3,4,5], rep=200.0):
         pdfName = "DpsiBar vs Occ and Act" + ", dim=" + str(dim)
         if k == (len(dims)-1):
             end = True
-        dPsiOccActGraphFromExcel(dPsiName[k], excelName[k]+".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, colors[k%5], rep, end)
+        dPsiOccActGraphFromExcel(dPsiName[k], excelName[k], xaxis, numRecs, labelNames[k], titleName, pdfName, colors[k%5], rep, end)
         k += 1
 
 
 @utils.verbose_if_debug
 def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd: tuple[float, float] = (0.05, 1.0), numRecs = 30,
-                       c = 1, dim = 2, qspaces=[4,10,30], purpose="standard", graph=False):
+                       c = 1, dim = 2, qspaces=[4,10,30], purpose="standard", graph=False, workers: Optional[int] = None):
     """Runs multiple graphs of given qspaces at one time
     Optional - run makeSimilar, to create epitheliums with equal eff and aff SD's (only rec means differ)
     Otherwise - make sure there are three saved epithelium files with correct names
@@ -288,7 +308,8 @@ def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd:
     
     fixed = True if want eff = 1
     c = convergence ratio of recs to glom
-    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim" or 'standard'"""
+    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim" or 'standard'
+    workers = number of processes to run the qspaces in at the same time (see dPsiBarSaturations)"""
     
     #Run this function if don't already have saved epithelium files to use
     makeSimilar(numRecs, aff_sd, eff_sd, purpose, qspaces, dim)
@@ -300,11 +321,11 @@ def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd:
     pdfName = "LigandSat with varying qspaces" + purp
     plotTitle = "Saturation of dPsiBar" + purp
     
-    i = 0
     labelNames = []
     excelNames = []
-    end = False
-    while i < len(qspaces):
+    qspaceList: list[QSpace] = []
+    epiths = []
+    for i in range(len(qspaces)):
         
         space = []
         j = 0
@@ -316,15 +337,12 @@ def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd:
 
         labelNames.append(str(qspace.size[0]) + " qspace")
         excelNames.append("LigandSat with " + str(qspace.size[0]) + " qspace" + purp)
-        
-        if i == (len(qspaces) - 1):
-            end = True
+        qspaceList.append(qspace)
+        epiths.append(epith)
 
-        #epi, dn, qspace, pdfName, labelName, excelName, fixed eff
-        dPsiBarSaturation(epith, .01, qspace, pdfName, labelNames[i], excelNames[i], fixed ,c, plotTitle, end, purp, True)
-        
-        i += 1
-        pass
+    #epis, dn, qspaces, pdfName, labelNames, excelNames, fixed eff
+    runs = dPsiBarSaturations(epiths, .01, qspaceList, pdfName, labelNames, excelNames, fixed, c, plotTitle,
+                              [purp]*len(qspaces), True, workers)
 
     #Creating Occ and Rec Act graphs
     ###################amt of rep in dPsiSaturation function and xAxis. MUST change if change in function
@@ -346,7 +364,7 @@ def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd:
         while k < len(qspaces):
             if k == (len(qspaces)-1):
                 end = True
-            graphFromExcel(excelNames[k] + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
+            graphFromExcel(runs[k], xaxis, numRecs, labelNames[k], titleName, pdfName, toggle, rep, end)
             k += 1
     
     if c!=1:
@@ -358,8 +376,7 @@ def psi_bar_saturation(fixed, aff_sd: tuple[float, float] = (0.5, 1.5), eff_sd:
         while k < len(qspaces):
             if k == (len(qspaces)-1):
                 end = True
-            name = "Glom_act with c=" + str(c) + " with " + str(qspace.size[0]) + " qspace"
-            graphFromExcel(name + ".csv", xaxis, numRecs, labelNames[k], titleName, pdfName, "Act", rep, end)
+            graphFromExcel(runs[k], xaxis, numRecs, labelNames[k], titleName, pdfName, "Glom", rep, end)
             k += 1
 
 def occ_vs_loc(affList=None):
@@ -385,29 +402,21 @@ def occ_vs_loc(affList=None):
     for aff in affList:
         recs.append(Receptor(1,[2],[aff],[1])) #Id, mean, sda, sde
  
+    #Each ligand is its own odorscene, so stack them as a (N, 1, 1) batch
+    location = [odor.loc for odor in odorscenes]
+    locs = np.array(location)[:, np.newaxis, :]
+    conc = np.array([[odor.conc] for odor in odorscenes])
+
     index = 0
     for rec in recs:
-        df = 0
-        location=[]
-        occupancy=[]
         labelName = "AffSD=" + str(rec.sdA)
         if max(affList) in rec.sdA:
             line = "-"
         else:
             line = "--"
-        for odor in odorscenes:
-            aff = mvn.pdf(odor.loc, rec.mean, rec.covA)
-            aff = aff / rec.scale #Scales it from 0 to 1
-                
-            #Now convert gaussian aff to kda
-            aff = 10**((aff * (config.PEAK_AFFINITY - config.MIN_AFFINITY)) + config.MIN_AFFINITY) ##peak_affinity etc. are global variables
-            
-            odor.aff = float(aff)
-            df = odor.conc/odor._aff
-    
-            location.append(odor.loc)
-            occ = ( (1) / (1 + ( (odor._aff/odor.conc) * (1 + df - (odor.conc / odor._aff ) ) ) **config.HILL_COEFF) ) # m aka HILL_COEFF = 1
-            occupancy.append(occ)
+        aff, eff = engine.affinity_efficacy([rec.mean], [rec.sdA], [rec.sdE], locs, True)
+        occ, _, _ = engine.occupancy(aff, eff, conc)
+        occupancy = occ[:, 0, 0]
 
         plt.plot(location,occupancy, line, label=labelName)
         plt.title("Occ vs Loc")
@@ -24,9 +24,6 @@ import math
 import re
 from collections import Counter
 
-import matplotlib.pyplot as plt
-import matplotlib.pylab
-from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 
 from odorsampling import config, cells, utils
@@ -44,6 +41,12 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 utils.default_log_setup(logger)
 
+# matplotlib and scipy are slow to import, so they are only loaded once used
+plt = utils.lazy_import("matplotlib.pyplot")
+pylab = utils.lazy_import("matplotlib.pylab")
+PdfPages = utils.lazy_import("matplotlib.backends.backend_pdf", "PdfPages")
+sparse = utils.lazy_import("scipy.sparse")
+
 ConnMap = list[tuple[int, int, float]]
 """
 Connections from Glom to Mitral cells, and their weights.
@@ -317,7 +320,7 @@ class GlomLayer(list[cells.Glom]):
 #####Graphing
     def graph_activation(self, n, m) -> None:
         graph = [[0,0,0],[0,0,0],[0,0,0],[0,0.5,0],[0.0,1.0,0.0],[0,0.4,0],[0,0,0.4],[0,0,1],[0,0,0.8]]
-        plt.imshow(graph, cmap=matplotlib.pylab.cm.YlOrRd, interpolation='nearest', origin='lower', extent=[0,3,0,3])
+        plt.imshow(graph, cmap=pylab.cm.YlOrRd, interpolation='nearest', origin='lower', extent=[0,3,0,3])
         plt.title("Glom Activation")
         plt.xlabel("X")
         plt.ylabel("Y")
@@ -331,8 +334,8 @@ class GlomLayer(list[cells.Glom]):
     #How do weights play in? Right now I just do activlvl*weight
     def activate_mcl(self, mcl: MitralLayer, sel, map_=None, noise=None, mean=0, sd=0) -> None:
         """Builds glom connections to mitral cells and calculates mitral activ lvl based on
-        connections and weights. Sel decides how to calculate the values, and noise
-        adds some variation.
+        connections and weights. Sel decides how to calculate the values (see mitral_activations),
+        and noise adds some variation.
         **If noise = "u" then mean is the the scale for uniform distribution of 0 to mean.
         Preconditions: Map holds valid connections for GL and MCL if not empty.
         Sel = "add", "avg" or "sat". Noise = None, u, g, or e."""
@@ -340,20 +343,18 @@ class GlomLayer(list[cells.Glom]):
         assert noise in [None, 'u', 'g', 'e'], "noise isn't a valid string"
         #Build MCL - GL connections
         if map_ is not None:
-            mcl, gl = apply_sample_map(gl, mcl, map_)
+            apply_sample_map(self, mcl, map_)
+            weights = sample_matrix(map_, len(mcl), len(self))
+        else:
+            weights = mcl.glom_matrix(len(self))
         #Add noise
         if noise is not None:
-            gl = gl.addNoise(noise, mean=0, sd=0)
+            self.addNoise(noise, mean=0, sd=0)
         #Activate Mitral cell activ lvls in MCL
-        if sel == 'add' or sel == 'avg':
-            for m in mcl:
-                activ = addActivationMCL(m, gl)
-                if sel == 'avg':
-                    activ = activ/(len(m.glom))
-                m._activation = activ   #Bypassing assertion that activ lvl < 1 TODO:<-- is this ok?
-            # MCL = normalize(MCL)
-        if sel == 'sat':
-            pass
+        activ = mitral_activations(weights, [glom.activ for glom in self], sel)
+        for m, m_activ in zip(mcl, activ.tolist()):
+            m._activation = m_activ   #Bypassing assertion that activ lvl < 1 TODO:<-- is this ok?
+        # MCL = normalize(MCL)
 
 class MitralLayer(list[cells.Mitral]):
     def __init__(self, cells: Iterable[cells.Mitral]):
@@ -366,6 +367,17 @@ class MitralLayer(list[cells.Mitral]):
             cells.reset_count(cells.Mitral)
         logger.debug("Creating mitral layer of %s cells.", n)
         return cls((cells.Mitral(i, 0.0, (0, 0), {}) for i in range(n)))
+
+    def glom_matrix(self, n_glom: int) -> sparse.csr_matrix:
+        """
+        Returns the (len(self) X n_glom) matrix of the weights in each mitral cell's glom dict,
+        in the dicts' order (see `sample_matrix`).
+        """
+        counts = [len(m.glom) for m in self]
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        indices = np.fromiter((g for m in self for g in m.glom), dtype=np.intp, count=indptr[-1])
+        data = np.fromiter((w for m in self for w in m.glom.values()), dtype=float, count=indptr[-1])
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(self), n_glom))
     
     def save(self, name: str):
         """Saves MCL as a file on the computer with .MCL as extention.
@@ -744,7 +756,7 @@ class MitralLayer(list[cells.Mitral]):
 
         fig, _ = plt.subplots()
 
-        im = plt.imshow(graph, cmap=matplotlib.pylab.cm.YlOrRd, interpolation='nearest', vmin=-0.15, vmax=1, origin='lower', extent=[0,4,0,4])
+        im = plt.imshow(graph, cmap=pylab.cm.YlOrRd, interpolation='nearest', vmin=-0.15, vmax=1, origin='lower', extent=[0,4,0,4])
         plt.title("Mitral Activation")
         plt.xlabel("X")
         plt.ylabel("Y")
@@ -817,25 +829,95 @@ def loadMCLSamplingMap(name: str) -> list[tuple[int, int, float]]:
 
 # TODO: Ensure Map is always a list[list[int]]. Assert?
 def apply_sample_map(gl: GlomLayer, mcl: MitralLayer, map_: list[list[int]]) -> tuple[MitralLayer, GlomLayer]:
-    """Fills the connection details and weights for GL and MCL for the given Map.
+    """Fills the connection details and weights for GL and MCL for the given Map:
+    each mitral cell in the map gets the glom dict of its row of `sample_matrix` and the loc
+    of its first glom, and each glom's conn is incremented by its number of connections.
     Returns updated MCL and GL as [MCL, GL]
     precondition: Map holds valid connections for GL and MCL"""
     assert map_[len(map_)-1][0] == len(mcl)-1, "dimensionality of Mitral cells is wrong"
-    test = 0
-    mcl[map_[0][0]].loc = gl[map_[0][1]].loc
+    weights = sample_matrix(map_, len(mcl), len(gl))
+    mitral_ids, first = np.unique(np.asarray(map_, dtype=float)[:, 0].astype(np.intp), return_index=True)
 
-    for mitral_id, glom_id, weight in map_:
-        if mitral_id != test:
-            test += 1
-            mcl[mitral_id].loc = gl[glom_id].loc
-            mcl[mitral_id].glom = {}
-        mcl[mitral_id].glom[glom_id]=weight
+    for mitral_id, glom_id in zip(mitral_ids.tolist(), (int(map_[i][1]) for i in first)):
+        start, end = weights.indptr[mitral_id], weights.indptr[mitral_id+1]
+        mcl[mitral_id].loc = gl[glom_id].loc
+        mcl[mitral_id].glom = dict(zip(weights.indices[start:end].tolist(), weights.data[start:end].tolist()))
 
-        gl[glom_id].conn += 1
+    conn = np.bincount(np.asarray(map_, dtype=float)[:, 1].astype(np.intp), minlength=len(gl))
+    for glom_id in np.flatnonzero(conn).tolist():
+        gl[glom_id].conn += int(conn[glom_id])
 
     return (mcl, gl)
 
 
+def sample_matrix(map_: ConnMap, n_mitral: int, n_glom: int) -> sparse.csr_matrix:
+    """
+    Returns the (n_mitral X n_glom) CSR matrix of the connection weights in map_.
+    Like the glom dicts of `apply_sample_map`, a glom connected to a mitral cell more than once
+    keeps its last weight, and each row is in the order the gloms first appear in map_,
+    so products with the matrix add the weighted activations up in the same order as `addActivationMCL`.
+
+    PARAMETERS
+    ----------
+    map_ - ConnMap
+        (m_id, g_id, weight) connections
+    n_mitral - int
+        Number of mitral cells
+    n_glom - int
+        Number of gloms
+    """
+    entries = np.asarray(map_, dtype=float).reshape(-1, 3)
+    mitral_ids = entries[:, 0].astype(np.intp)
+    glom_ids = entries[:, 1].astype(np.intp)
+    pairs = mitral_ids*n_glom + glom_ids
+    _, first = np.unique(pairs, return_index=True)
+    _, last = np.unique(pairs[::-1], return_index=True)
+    last = len(pairs) - 1 - last
+    order = np.lexsort((first, mitral_ids[first]))
+    first, last = first[order], last[order]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(mitral_ids[first], minlength=n_mitral))))
+    return sparse.csr_matrix((entries[last, 2], glom_ids[first], indptr), shape=(n_mitral, n_glom))
+
+
+def mitral_activations(weights: sparse.csr_matrix, glom_activ, sel: str = 'add') -> np.ndarray:
+    """
+    Returns the mitral activations given the glom activations in glom_activ, for every
+    row of glom_activ at once (or for one vector of glom activations).
+
+    PARAMETERS
+    ----------
+    weights - sparse.csr_matrix
+        (mitral X glom) connection weights, see `sample_matrix`
+    glom_activ - array_like
+        (glom,) or (n, glom) glom activations
+    sel - str
+        'add' = sum of the connected gloms' activ*weight,
+        'avg' = 'add' divided by the number of connected gloms,
+        'sat' = 'add' passed through add/(1+add), which saturates at 1
+    """
+    assert sel in ['add', 'avg', 'sat'], "select value isn't valid"
+    activ = (weights @ np.asarray(glom_activ, dtype=float).T).T
+    if sel == 'avg':
+        activ = activ/np.maximum(np.diff(weights.indptr), 1)
+    elif sel == 'sat':
+        activ = activ/(1.0 + activ)
+    return activ
+
+
+def normalize_activations(activ) -> np.ndarray:
+    """
+    Returns activ with each row (or the vector) scaled so its highest value is 1,
+    as `normalize` does for a layer. Rows that are all 0 are left as they are.
+    Precondition: No activation values should be negative
+    """
+    activ = np.asarray(activ, dtype=float)
+    assert (activ >= 0).all(), "Activation value was negative!"
+    if activ.size == 0:
+        return activ
+    max_i = activ.max(axis=-1, keepdims=True)
+    return activ*np.where(max_i != 0, 1.0/np.where(max_i != 0, max_i, 1.0), 1.0)
+
+
 # FIXME: What is GL if not a list of glom cells?
 def addActivationMCL(m: cells.Mitral, gl: GlomLayer):
     """Returns updated MCL where each mitral cell's activation level is calculated
@@ -855,16 +937,9 @@ def normalize(mcl: MitralLayer):
     and the other values accordingly and return updated MCL.
     If uncomment, then firt values will scale to 0 than up to 1.
     Precondition: No activation values should be negative"""
-    max_i = 0
-    #mini = 100
-    for m in mcl:
-        assert m.activ >= 0, "Activation value was negative!"
-        if max_i < m.activ:
-            max_i = m.activ
-    if max_i != 0:
-        scale = (1.0/max_i)  #If put mini back in then this line is 1/(maxi-mini)
-        for m in mcl:
-            m.activ = m.activ*scale  #Assertion now in place - all #'s should be btwn 0 and 1
+    #If put mini back in then the scale is 1/(maxi-mini), see normalize_activations
+    for m, activ in zip(mcl, normalize_activations([m.activ for m in mcl]).tolist()):
+        m.activ = activ  #Assertion now in place - all #'s should be btwn 0 and 1
     return mcl
 
 ###### Analysis and Visualization
@@ -949,7 +1024,7 @@ def colorMapWeights(map_, gl: GlomLayer, mcl: MitralLayer):
         col = map_[index][1]
         graph[row][col] = map_[index][2]
         index += 1
-    matplotlib.pylab.matshow(graph, fignum="Research", cmap=matplotlib.pylab.cm.Greys) #Black = fully active
+    pylab.matshow(graph, fignum="Research", cmap=pylab.cm.Greys) #Black = fully active
     plt.title("Weights in GL-MCL connection")
     plt.xlabel("GL")
     plt.ylabel("MCL")
@@ -0,0 +1,325 @@
+"""
+    Columnar storage of saturation runs (see RnO.dPsiBarSaturation).
+    This includes:
+        - Typed (repetition, ligand count, receptor) arrays of activation, occupancy and odoAmt
+        - Glom activations and dPsiBar values of the run
+        - Saving to and memory-mapped loading from a directory of .npy files
+        - Vectorized averages used by the graph functions
+        - Exporting the same CSVs dPsiBarSaturation writes
+        - A size-bounded, least recently used cache of stores keyed by a content hash
+
+    A store is a directory holding one .npy file per array and a meta.json with the run's
+    settings. Arrays are loaded with `mmap_mode='r'`, so only the parts that are used are read.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from odorsampling import utils
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Optional, Any, Iterator
+    from numpy.typing import ArrayLike
+
+
+logger = logging.getLogger(__name__)
+utils.default_log_setup(logger)
+
+STORE_EXT = ".sat"
+"""Extension of saturation store directories."""
+
+CACHE_VERSION = 2
+"""Version of the saturation computation. Bump it when results change, so old cache entries are not used."""
+
+_ARRAYS = ('xaxis', 'dpsi', 'activ', 'occ', 'odo_amt', 'glom')
+_META = "meta.json"
+
+
+class SaturationResults:
+    """
+    Results of one saturation run.
+
+    Attributes
+    ----------
+    xaxis : np.ndarray
+        (L,) number of ligands of each odorscene.
+    dpsi : np.ndarray
+        (L,) dPsiBar of each number of ligands, averaged over the repetitions.
+    activ, occ, odo_amt : np.ndarray
+        (rep, L, R) activation, occupancy and number of nearby ligands of every receptor.
+    glom : np.ndarray | None
+        (rep, L, G) glom activations, only if c != 1.
+    meta : dict[str, Any]
+        Settings of the run (eg. qspace, c, fixed).
+    path : str | None
+        Directory the arrays are stored in, if any.
+    """
+
+    def __init__(self, xaxis: ArrayLike, dpsi: ArrayLike, activ: np.ndarray, occ: np.ndarray, odo_amt: np.ndarray,
+                 glom: Optional[np.ndarray] = None, meta: Optional[dict[str, Any]] = None, path: Optional[str] = None):
+        self.xaxis = xaxis if isinstance(xaxis, np.ndarray) else np.asarray(xaxis)
+        self.dpsi = dpsi if isinstance(dpsi, np.ndarray) else np.asarray(dpsi, dtype=np.float64)
+        self.activ = activ
+        self.occ = occ
+        self.odo_amt = odo_amt
+        self.glom = glom
+        self.meta = {} if meta is None else dict(meta)
+        self.path = path
+        assert activ.shape == occ.shape == odo_amt.shape, "activ, occ and odo_amt must have the same shape"
+        assert activ.shape[1] == len(self.xaxis) == len(self.dpsi), "Need one row per number of ligands"
+
+    @classmethod
+    def create(cls, xaxis: ArrayLike, repetitions: int, num_recs: int, num_gloms: int = 0,
+               path: Optional[str] = None, meta: Optional[dict[str, Any]] = None) -> SaturationResults:
+        """
+        Returns empty results to be filled with `record`.
+
+        If `path` is given, the arrays are memory-mapped .npy files in that directory, so they are
+        written to disk as they are filled instead of being held in memory.
+        No glom array is made if `num_gloms` is 0.
+        """
+        xaxis = np.asarray(xaxis)
+        shape = (repetitions, len(xaxis), num_recs)
+        glom_shape = (repetitions, len(xaxis), num_gloms) if num_gloms else None
+        if path is None:
+            arrays = [np.zeros(shape) for _ in range(3)]
+            glom = None if glom_shape is None else np.zeros(glom_shape)
+            dpsi = np.zeros(len(xaxis))
+        else:
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, 'xaxis.npy'), xaxis)
+            open_mm = np.lib.format.open_memmap
+            arrays = [open_mm(os.path.join(path, name + '.npy'), 'w+', np.float64, shape)
+                      for name in ('activ', 'occ', 'odo_amt')]
+            glom = None if glom_shape is None else open_mm(os.path.join(path, 'glom.npy'), 'w+', np.float64, glom_shape)
+            dpsi = open_mm(os.path.join(path, 'dpsi.npy'), 'w+', np.float64, (len(xaxis),))
+        results = cls(xaxis, dpsi, *arrays, glom=glom, meta=meta, path=path)
+        if path is not None:
+            results._save_meta()
+        return results
+
+    @classmethod
+    def load(cls, path: str, mmap=True, writable=False) -> SaturationResults:
+        """
+        Loads results saved in the directory `path`. If `mmap`, the arrays are memory-mapped
+        instead of being read into memory, read only unless `writable` (eg. to continue filling them).
+        """
+        mode = ('r+' if writable else 'r') if mmap else None
+        arrays = {}
+        for name in _ARRAYS:
+            file_name = os.path.join(path, name + '.npy')
+            arrays[name] = np.load(file_name, mmap_mode=mode) if os.path.exists(file_name) else None
+        with open(os.path.join(path, _META)) as f:
+            meta = json.load(f)
+        return cls(meta=meta, path=path, **arrays)
+
+    @staticmethod
+    def is_store(path: str) -> bool:
+        """Returns True if `path` is a directory created by `save` or `create`."""
+        return os.path.isfile(os.path.join(path, _META))
+
+    @property
+    def repetitions(self) -> int:
+        return self.activ.shape[0]
+
+    @property
+    def num_recs(self) -> int:
+        return self.activ.shape[2]
+
+    def record(self, rep: int, activ: ArrayLike, occ: ArrayLike, odo_amt: ArrayLike, glom: Optional[ArrayLike] = None):
+        """Stores the (L, R) cell values of repetition `rep` (and its (L, G) glom activations)."""
+        self.activ[rep] = activ
+        self.occ[rep] = occ
+        self.odo_amt[rep] = odo_amt
+        if self.glom is not None:
+            self.glom[rep] = glom
+
+    def flush(self):
+        """Writes memory-mapped arrays and the meta data to disk."""
+        if self.path is None:
+            return
+        for name in _ARRAYS:
+            array = getattr(self, name)
+            if isinstance(array, np.memmap):
+                array.flush()
+        self._save_meta()
+
+    def save(self, path: str) -> SaturationResults:
+        """Saves all arrays in the directory `path` and returns the results loaded from there."""
+        self._write(path, self.meta)
+        self.path = path
+        return SaturationResults.load(path)
+
+    def _write(self, path: str, meta: dict[str, Any]):
+        """Writes all arrays and `meta` in the directory `path`."""
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(path, name + '.npy'), array)
+        utils.save_json(os.path.join(path, _META), meta)
+
+    def _save_meta(self):
+        utils.save_json(os.path.join(self.path, _META), self.meta)
+
+    def average(self, toggle: str, num_cells: Optional[int] = None, rep: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the (L,) average of a cell value over the first `rep` repetitions and the first
+        `num_cells` cells, for each number of ligands.
+
+        Parameters
+        ----------
+        toggle
+            "Act", "Occ", "OdoAmt" or "Glom".
+        num_cells
+            Number of receptors (or gloms) averaged, all by default.
+        rep
+            Number of repetitions averaged, all by default.
+        """
+        arrays = {"Act": self.activ, "Occ": self.occ, "OdoAmt": self.odo_amt, "Glom": self.glom}
+        assert toggle in arrays, f"toggle must be one of {list(arrays)}"
+        array = arrays[toggle]
+        assert array is not None, "These results have no glom activations"
+        num_cells = array.shape[2] if num_cells is None else num_cells
+        rep = array.shape[0] if rep is None else int(rep)
+        return array[:rep, :, :num_cells].sum(axis=(0, 2)) / (float(num_cells) * rep)
+
+    def rows(self, rep: int) -> tuple[str, Optional[str]]:
+        """
+        Returns the CSV rows dPsiBarSaturation writes for repetition `rep`: its rec rows, and its
+        glom rows (None if there are no glom activations).
+        """
+        cells = np.concatenate((self.activ[rep], self.occ[rep], self.odo_amt[rep]), axis=1).tolist()
+        rows = "".join(f"Odorscene{k+1}," + ",".join(map(str, row)) + '\n' for k, row in enumerate(cells))
+        if self.glom is None:
+            return rows, None
+        glom_rows = "".join(f"glom_numOdo={k+1}," + ",".join(map(str, row)) + '\n'
+                            for k, row in enumerate(self.glom[rep].tolist()))
+        return rows, glom_rows
+
+    def to_csv(self, excel_name: str, glom_name: Optional[str] = None, dpsi_name: Optional[str] = None):
+        """
+        Writes the CSVs dPsiBarSaturation writes: rec rows to `excel_name`, glom rows to
+        `glom_name` and dPsiBar values to `dpsi_name` (.csv is not added).
+        """
+        num_recs = self.num_recs
+        with open(excel_name, 'w') as f:
+            f.write("Odorscenes," + ",".join([f"activ {p}" for p in range(num_recs)] + [f"occ {p}" for p in range(num_recs)]
+                                            + [f"odoAmt {p}" for p in range(num_recs)]) + '\n')
+            for i in range(self.repetitions):
+                f.write(self.rows(i)[0])
+        if glom_name is not None:
+            assert self.glom is not None, "These results have no glom activations"
+            with open(glom_name, 'w') as f:
+                f.write("Glom," + "".join(f"activ {p}," for p in range(self.glom.shape[2])) + '\n')
+                for i in range(self.repetitions):
+                    f.write(self.rows(i)[1])
+        if dpsi_name is not None:
+            with open(dpsi_name, 'w') as f:
+                f.write("Odorscenes, dPsiBar" + '\n')
+                f.writelines(f"{x},{y}\n" for x, y in zip(self.xaxis.tolist(), self.dpsi.tolist()))
+
+
+class SaturationCache:
+    """
+    On-disk cache of saturation results, keyed by a hash of everything that determines them
+    (see RnO.saturationKey).
+
+    Each entry is a store directory named `<key>` + STORE_EXT. Reading an entry marks it as
+    used, and once the entries take more than `max_bytes` the least recently used ones are removed.
+
+    Attributes
+    ----------
+    path : str
+        Directory holding the entries.
+    max_bytes : int
+        Size the entries are kept under.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + STORE_EXT)
+
+    def get(self, key: str) -> Optional[SaturationResults]:
+        """Returns the (memory-mapped) results stored under `key`, or None if there are none."""
+        path = self.entry_path(key)
+        if not SaturationResults.is_store(path):
+            return None
+        os.utime(os.path.join(path, _META))
+        logger.debug("Saturation cache hit %s", key)
+        return SaturationResults.load(path)
+
+    def put(self, key: str, results: SaturationResults, meta: Optional[dict[str, Any]] = None):
+        """
+        Stores a copy of `results` under `key`, with `meta` added to its meta data, then evicts
+        the least recently used entries until the cache fits in `max_bytes`.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        path = self.entry_path(key)
+        # Written next to the entry and renamed, so other processes never see half an entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        results._write(tmp_path, {**results.meta, **(meta or {}), "key": key})
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self) -> Iterator[tuple[str, int, float]]:
+        """Yields (key, size in bytes, last use time) of every entry."""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not name.endswith(STORE_EXT) or not SaturationResults.is_store(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                used = os.stat(os.path.join(path, _META)).st_mtime
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            yield name[:-len(STORE_EXT)], size, used
+
+    def size(self) -> int:
+        """Returns the bytes taken by all entries."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Removes the least recently used entries, other than `keep`, until the cache fits in `max_bytes`.
+        Returns the number of entries removed."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                self.invalidate(key)
+                total -= size
+                removed += 1
+        return removed
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        """Removes the entry of `key`, or every entry if `key` is None. Returns the number of entries removed."""
+        keys = [entry[0] for entry in self.entries()] if key is None else [key]
+        removed = 0
+        for key in keys:
+            path = self.entry_path(key)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        logger.debug("Removed %s entries from the saturation cache", removed)
+        return removed
@@ -3,16 +3,15 @@
 
 
 import time
-import multiprocessing
 
 from odorsampling.RnO import (
-    QSpace, Epithelium, Odorscene, Ligand, dPsiBarSaturation, colorMapSumOfSquares,
+    QSpace, Epithelium, Odorscene, Ligand, dPsiBarSaturation, dPsiBarSaturations, colorMapSumOfSquares, colorMapDPsiBars,
     graphFromExcel, dPsiGraphFromExcel, dPsiOccActGraphFromExcel
 )
 from odorsampling import config, utils
 
 
-def testdPsiBarSat(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard"):
+def testdPsiBarSat(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard", workers=None):
     """Runs multiple graphs of given qspaces at one time
     Optional - run makeSimilar (line 25), to create 3 epitheliums with equal eff and aff SD's (only rec means differ)
     Otherwise - make sure there are three saved epithelium files with correct names
@@ -21,7 +20,8 @@ def testdPsiBarSat(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1,
     
     fixed = True if want eff = 1
     c = convergence ratio of recs to glom
-    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim", or 'standard'"""
+    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim", or 'standard'
+    workers = number of processes to run the qspaces in, default is one per qspace"""
     
     #Run this function if don't already have saved epithelium files to use
     makeSimilar(numRecs, aff_sd, eff_sd, purpose, qspaces, dim)
@@ -33,49 +33,32 @@ def testdPsiBarSat(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1,
     pdfName = "LigandSat with varying qspaces" + purp
     plotTitle = "Saturation of dPsiBar" + purp
     
-    #i = 0
     labelNames = []
     excelNames = []
-    end = False
-    
-    
-    if __name__ == '__main__':
-        jobs = []
-    
+    qspaceList = []
+    epiths = []
+    for i, qspacesItem in enumerate(qspaces):    
+        space = []
+        for j in range(dim):    
+            space.append((0,qspacesItem))
+        qspace = QSpace(space)
+        epith = Epithelium.load("1. SavedEpi_" + str(qspace.size[0]) + purp + ".csv")
+
+        labelNames.append(str(qspace.size[0]) + " qspace")
+        excelNames.append("LigandSat with " + str(qspace.size[0]) + " qspace" + purp)
+        qspaceList.append(qspace)
+        epiths.append(epith)
     
-        #while i < len(qspaces):
-        for i, qspacesItem in enumerate(qspaces):    
-            space = []
-            #j = 0
-            #while j < dim:
-            for j in range(dim):    
-                space.append((0,qspacesItem))
-                #j+=1
-            qspace = QSpace(space)
-            epith = Epithelium.load("1. SavedEpi_" + str(qspace.size[0]) + purp + ".csv")
+    #epis, dn, qspaces, pdfName, labelNames, excelNames, fixed eff
+    dPsiBarSaturations(epiths, .01, qspaceList, pdfName, labelNames, excelNames, fixed, c, plotTitle,
+                       [purp]*len(qspaces), False, len(qspaces) if workers is None else workers)
 
-            labelNames.append(str(qspace.size[0]) + " qspace")
-            excelNames.append("LigandSat with " + str(qspace.size[0]) + " qspace" + purp)
-        
-            if i == (len(qspaces) - 1):
-                end = True
-          
-            p = multiprocessing.Process(target=dPsiBarSaturation, args=(epith, .01, qspace, pdfName, labelNames[i], excelNames[i], fixed ,c, plotTitle, end, purp, False))
-            jobs.append(p)
-            p.start()
-        
-        
-            #epi, dn, qspace, pdfName, labelName, excelName, fixed eff
-            #dPsiBarSaturation(epith, .01, qspace, pdfName, labelNames[i], excelNames[i], fixed ,c, plotTitle, end, purp, graphIt=False)
-        
-            #i += 1
-        
-        
-        for j, job in enumerate(jobs):
-            job.join()
-        
+def _colorMapJob(epith, odorscenes, r, qspace, seed):
+    """Calculates the colorMap graph of one qspace in a worker process, with its own random stream."""
+    with utils.seeded(seed):
+        return colorMapDPsiBars(epith, odorscenes, r, qspace)
             
-def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard", qunits = 3):
+def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=30, c=1, dim=2, qspaces=[4,10,30], purpose="standard", qunits = 3, workers=None):
     """Runs multiple graphs of given qspaces at one time
     Optional - run makeSimilar (line 25), to create 3 epitheliums with equal eff and aff SD's (only rec means differ)
     Otherwise - make sure there are three saved epithelium files with correct names
@@ -84,7 +67,8 @@ def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=3
     
     fixed = True if want eff = 1
     c = convergence ratio of recs to glom
-    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim", or 'standard'"""
+    purpose = reason for running simulation = either "eff", "aff", "c", "recs", "redAff", "dim", or 'standard'
+    workers = number of processes to run the qspaces in, default is one per qspace"""
     
     #Run this function if don't already have saved epithelium files to use
     makeSimilar(numRecs, aff_sd, eff_sd, purpose, qspaces, dim)
@@ -96,23 +80,13 @@ def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=3
     pdfName = "LigandSat with varying qspaces" + purp
     plotTitle = "Saturation of dPsiBar" + purp
     
-    #i = 0
     labelNames = []
     excelNames = []
-    end = False
-    
-    
-    # if __name__ == '__main__':
-    #     jobs = []
-    
-    #while i < len(qspaces):
+    jobs = []
     for i, qspacesItem in enumerate(qspaces):    
         space = []
-        #j = 0
-        #while j < dim:
         for j in range(dim):    
             space.append((0,qspacesItem))
-            #j+=1
         qspace = QSpace(space)
 
 
@@ -120,9 +94,6 @@ def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=3
 
         labelNames.append(str(qspace.size[0]) + " qspace")
         excelNames.append("LigandSat with " + str(qspace.size[0]) + " qspace" + purp)
-    
-        # if i == (len(qspaces) - 1):
-        #     end = True
 
         x = 0
         y = 0
@@ -137,21 +108,14 @@ def testdPsiBarSatColorMap(fixed, aff_sd=[0.5,1.5], eff_sd=[0.05,1.0], numRecs=3
                 y += 1
                 ID += 1
             x += 1
-        colorMapSumOfSquares(epith, odorscenes, .3, qspace)
-      
-        # p = multiprocessing.Process(target=dPsiBarSaturation, args=(epith, .01, qspace, pdfName, labelNames[i], excelNames[i], fixed ,c, plotTitle, end, purp, False))
-        # jobs.append(p)
-        # p.start()
-    
-    
-        #epi, dn, qspace, pdfName, labelName, excelName, fixed eff
-        #dPsiBarSaturation(epith, .01, qspace, pdfName, labelNames[i], excelNames[i], fixed ,c, plotTitle, end, purp, graphIt=False)
-    
-        #i += 1
-        
-        
-        # for j, job in enumerate(jobs):
-        #     job.join()
+        jobs.append((epith, odorscenes, .3, qspace))
+    
+    #Each qspace is calculated in its own process; the colorMaps are drawn here, one at a time
+    seeds = utils.spawn_seeds(len(jobs))
+    with utils.process_pool(len(jobs) if workers is None else workers) as pool:
+        graphs = list(pool.map(_colorMapJob, *zip(*jobs), seeds))
+    for (epith, odorscenes, r, qspace), graph in zip(jobs, graphs):
+        colorMapSumOfSquares(epith, odorscenes, r, qspace, graph)
 
 
 
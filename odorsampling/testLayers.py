@@ -8,10 +8,12 @@
 from __future__ import annotations
 
 import matplotlib.pyplot as plt
+import numpy as np
 
 from odorsampling.layers import (
-    euclideanDistance, apply_sample_map,
+    euclideanDistance, apply_sample_map, addActivationMCL,
     normalize, graphLayer, colorMapWeights,
+    sample_matrix, mitral_activations, normalize_activations,
     MitralLayer, GlomLayer
 )
 from odorsampling import utils, cells
@@ -296,6 +298,30 @@ def testNormalization():
         print(m)
 
 
+def testSampleMatrix():
+    """Tests activating MCL with the sparse sampling matrix against addActivationMCL, for a batch of GLs"""
+    gl = GlomLayer.create(40)
+    gl.activate_random(utils.uniform_activation)
+    mcl = MitralLayer.create(30)
+    map_ = mcl.createSamplingMap(gl, 4, True, "simple")
+    apply_sample_map(gl, mcl, map_)
+    weights = sample_matrix(map_, len(mcl), len(gl))
+    legacy = [addActivationMCL(m, gl) for m in mcl]
+    print("matrix same as mitral glom dicts: " + str((weights != mcl.glom_matrix(len(gl))).nnz == 0))
+
+    batch = np.array([[glom.activ for glom in gl] for i in range(3)])
+    print("add same as addActivationMCL: " + str(np.array_equal(mitral_activations(weights, batch)[2], legacy)))
+    mcl2 = MitralLayer.create(30)
+    gl.activate_mcl(mcl2, "avg", map_)
+    print("avg same: " + str([m._activation for m in mcl2] == [a/len(m.glom) for a, m in zip(legacy, mcl)]))
+    print("sat: " + str(mitral_activations(weights, batch[0], 'sat')[:5]))
+    print("normalized max of each row: " + str(normalize_activations(mitral_activations(weights, batch)).max(axis=1)))
+
+    #Repeated connections keep their last weight
+    map_ = [(0, 2, .5), (0, 1, .25), (0, 2, .75), (1, 3, 1.0), (1, 0, .5)]
+    print(sample_matrix(map_, 2, 4).toarray())
+
+
 def testgraphLayer():
     """Testing graphLayer for GL then MCL"""
     gl = GlomLayer.create(20)
@@ -333,6 +359,7 @@ def test():
     testGraphMitralActivation()
     testActivateMCLfromGL()
     testNormalization()
+    testSampleMatrix()
     testgraphLayer()
     testColorMap()
 
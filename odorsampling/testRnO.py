@@ -8,15 +8,23 @@
 from __future__ import annotations
 
 import math
+import time
 from odorsampling.RnO import (
-    Ligand, QSpace, Odorscene, Receptor, Epithelium,
+    Ligand, QSpace, Odorscene, Receptor, Epithelium, dPsiBarCalcAnglesBatch, dPsiBarCalcDns,
     activateGL_QSpace, sumOfSquares, sumOfSquares2, modifyLoc, colorMapSumOfSquares,
-    sequentialOdorscenes, graphFromExcel, recDensityDpsiGraph, recInQspace,
+    sequentialOdorscenes, graphFromExcel, recDensityDpsiGraph, recInQspace, createLoc,
     recDensityDpsiGraphRandomized, getLocations, glomRecConnNew, dPsiGraphFromExcel,
-    dPsiOccActGraphFromExcel, dPsiBarCalcAngles, dPsiBarCalcDiag, dPsiBarSaturation
+    dPsiOccActGraphFromExcel, dPsiBarCalcAngles, dPsiBarCalcDiag, dPsiBarSaturation, dPsiBarSaturations,
+    OdorsceneBatch, dPsiOdorsceneBatch, CompiledEpithelium, Text, TextStream, recToText, _parseAndSum,
+    saturationKey, saturationCache
 ) 
 import odorsampling.layers as layers
+import odorsampling.RnO as RnO
+from odorsampling import config, engine, utils, results
+from odorsampling.results import SaturationResults
 import copy
+import numpy as np
+from scipy.stats import multivariate_normal as mvn
 
 
 def testModifyLoc():
@@ -74,7 +82,139 @@ def testActivateGL_QSpace():
     for glom in gl:
         print(str(glom) + "\n")
 
-    
+
+def testAffinityEngine():
+    """Compares the vectorized affinity/efficacy matrices against per-pair scipy calls"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(5, 2, qspace, scaleEff=[.05,1.0])
+    odorscene = Odorscene.create(2, [1e-5], [8], qspace)
+    locs = [odor.loc for odor in odorscene.odors]
+    mean = [rec.mean for rec in epith.recs]
+    sdA = [rec.sdA for rec in epith.recs]
+    sdE = [rec.sdE for rec in epith.recs]
+    aff, eff = engine.affinity_efficacy(mean, sdA, sdE, locs)
+    
+    maxDiff = 0.0
+    for i, rec in enumerate(epith.recs):
+        for j, odor in enumerate(odorscene.odors):
+            expAff = 10**((mvn.pdf(odor.loc, rec.mean, rec.covA)/rec.scale)*(config.PEAK_AFFINITY - config.MIN_AFFINITY) + config.MIN_AFFINITY)
+            expEff = mvn.pdf(odor.loc, rec.mean, rec.covE)/rec.effScale
+            maxDiff = max(maxDiff, abs(aff[i][j] - expAff)/expAff, abs(eff[i][j] - expEff))
+    print("max relative difference is " + str(maxDiff))
+
+def testOccupancySolver():
+    """Compares the batched occupancy solver against the per-receptor loop, with a padded ligand"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(5, 2, qspace)
+    odorscene = Odorscene.create(2, [1e-5], [6], qspace)
+    locs = [odor.loc for odor in odorscene.odors] + [[0.0, 0.0]]
+    conc = [odor.conc for odor in odorscene.odors] + [1.0]
+    mask = [True]*len(odorscene.odors) + [False]
+    aff, eff = engine.affinity_efficacy([rec.mean for rec in epith.recs], [rec.sdA for rec in epith.recs],
+                                        [rec.sdE for rec in epith.recs], locs)
+    occ, activ, totOcc = engine.occupancy(aff, eff, conc, mask)
+
+    maxDiff = 0.0
+    for i, rec in enumerate(epith.recs):
+        df = sum(conc[j]/aff[i][j] for j in range(len(odorscene.odors)))
+        expActiv = 0.0
+        for j in range(len(odorscene.odors)):
+            expOcc = 1/(1+((aff[i][j]/conc[j])*(1+df-conc[j]/aff[i][j]))**config.HILL_COEFF)
+            expActiv += eff[i][j]*expOcc
+        maxDiff = max(maxDiff, abs(activ[i] - expActiv))
+    print("max activation difference is " + str(maxDiff))
+    print("padded ligand occupancy is " + str(occ[:, -1].max()))
+
+def testOdorsceneBatch():
+    """Converts odorscenes to an OdorsceneBatch and back, and compares batched dPsi against sumOfSquares"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(5, 2, qspace)
+    odorscenes = [Odorscene.create(2, [1e-5], [n], qspace, n) for n in [1, 3, 7]]
+    dns = [[[.1, 0], [0, .2]]]*3
+    batch = OdorsceneBatch.fromOdorscenes(odorscenes, dns)
+    print("counts are " + str(batch.counts) + " and mask is \n" + str(batch.mask))
+    
+    odorscenes2 = batch.toOdorscenes()
+    same = all(odor.loc == odor2.loc and odor.conc == odor2.conc
+               for od, od2 in zip(odorscenes, odorscenes2) for odor, odor2 in zip(od.odors, od2.odors))
+    print("round trip keeps locs and concs: " + str(same))
+    
+    dPsi = dPsiOdorsceneBatch(epith, batch)
+    maxDiff = 0.0
+    for i, odorscene in enumerate(odorscenes):
+        for d, dn in enumerate(dns[i]):
+            maxDiff = max(maxDiff, abs(dPsi[i][d] - sumOfSquares(epith, odorscene, dn)))
+    print("max dPsi difference is " + str(maxDiff))
+    
+    state = utils.RNG.bit_generator.state
+    batch = OdorsceneBatch.create([3, 1], 1e-5, qspace, r=.1)
+    utils.RNG.bit_generator.state = state
+    same = True
+    for locs, dns, n in zip(batch.locs, batch.dns, batch.counts):
+        odorscene = Odorscene(0, [Ligand(j, createLoc(qspace), 1e-5) for j in range(n)])
+        same &= np.array_equal(locs[:n], [odor.loc for odor in odorscene.odors])
+        same &= np.array_equal(dns, dPsiBarCalcDns(odorscene, .1, config.ANGLES_REP))
+    print("create draws like createLoc and dPsiBarCalcDns: " + str(same))
+
+def testCompiledEpithelium():
+    """Compares a CompiledEpithelium against its receptors, before and after a receptor changes"""
+    qspace = QSpace([(0,4), (0, 4), (0, 4)])
+    epith = Epithelium.create(5, 3, qspace, scaleEff=[.05,1.0])
+    compiled = epith.compiled
+    print("scale difference is " + str(max(abs(compiled.scale - [rec.scale for rec in epith.recs]))))
+    print("effScale difference is " + str(max(abs(compiled.effScale - [rec.effScale for rec in epith.recs]))))
+    print("cached: " + str(epith.compiled is compiled))
+    other = Epithelium.create(5, 3, qspace, scaleEff=[.05,1.0])
+    other.recs[2].mean = [1, 1, 1]
+    print("valid after changing another epithelium's receptor: " + str(compiled.valid))
+    
+    epith.recs[2].mean = [1, 1, 1]
+    print("valid after changing a mean: " + str(compiled.valid))
+    print("rebuilt mean: " + str(epith.compiled.mean[2]))
+    
+    epith.save("testCompiledEpi")
+    loaded = CompiledEpithelium.load("testCompiledEpi.csv")
+    print("loaded sdA difference is " + str(abs(loaded.sdA - epith.compiled.sdA).max()))
+
+def testSparseCutoff():
+    """Compares activations in sparse cutoff mode against the dense calculation in a large qspace"""
+    qspace = QSpace([(0,30), (0, 30)])
+    epith = Epithelium.create(30, 2, qspace)
+    odorscene = Odorscene.create(2, [1e-5, 1e-8], [200, 200], qspace)
+    locs = [odor.loc for odor in odorscene.odors]
+    conc = [odor.conc for odor in odorscene.odors]
+    
+    config.SPARSE_CUTOFF_SD = None
+    activ, totOcc = epith.compiled.activation(locs, conc)
+    config.SPARSE_CUTOFF_SD = 6
+    activ2, totOcc2 = epith.compiled.activation(locs, conc)
+    out = np.zeros((len(epith.recs), 2)).T #Not contiguous
+    epith.compiled.activation([locs, locs], conc, out=out)
+    config.SPARSE_CUTOFF_SD = None
+    print("max activation difference is " + str(abs(activ - activ2).max()))
+    print("max occupancy difference is " + str(abs(totOcc - totOcc2).max()))
+    print("non-contiguous out gets the activations: " + str(np.array_equal(out, [activ2, activ2])))
+
+def testTextStream():
+    """Writes the same rec and glom rows with a Text and with a TextStream that flushes every 100 characters.
+    Both files should be identical"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace)
+    odorscene = Odorscene.create(2, [1e-5], [3], qspace)
+    gl = layers.GlomLayer.create(30)
+    config.TEXT_CHUNK_SIZE, chunkSize = 100, config.TEXT_CHUNK_SIZE
+    text = Text("Odorscenes\n", "exp1")
+    with TextStream("Odorscenes\n", "exp1", "testTextStream.csv", "testTextStream glom.csv") as stream:
+        for i in range(20):
+            activateGL_QSpace(epith, odorscene, gl, False, 9)
+            for t in (text, stream):
+                t.write("Odorscene" + str(i+1))
+                recToText(epith, gl, 9, t)
+    config.TEXT_CHUNK_SIZE = chunkSize
+    with open("testTextStream.csv") as f, open("testTextStream glom.csv") as f2:
+        print("rec rows identical: " + str(f.read() == text._st))
+        print("glom rows identical: " + str(f2.read() == text._st2))
+
 def testSaving():
     """Tests loading and saving objects as CSV files
     Uncomment whichever saving you want to test"""
@@ -250,6 +390,21 @@ def testdPsiBarCalc():
     print("Diagnols: dPsibar is " + str(dPsibar))
     print("Angles: dPsibar is " + str(dPsibar2))
 
+def testdPsiBarCalcAnglesBatch():
+    """Compares the dPsi of each direction from dPsiBarCalcAnglesBatch against sumOfSquares"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(5, 2, qspace)
+    odorscene = Odorscene.create(2, [1e-5], [4], qspace)
+    dns = dPsiBarCalcDns(odorscene, .01, config.ANGLES_REP)
+    for odor in odorscene.odors:
+        for dn in dns:
+            odor.appendToOdors2(Ligand(odor.id, [loc + d for loc, d in zip(odor.loc, dn)], odor.conc))
+    
+    dPsiBar, dPsi = dPsiBarCalcAnglesBatch(epith, odorscene)
+    maxDiff = max(abs(dPsi[d] - sumOfSquares(epith, odorscene, dn)) for d, dn in enumerate(dns))
+    print("max dPsi difference is " + str(maxDiff))
+    print("dPsiBar is the mean of the directions: " + str(dPsiBar == dPsi.mean()))
+
 def testMultipleLigands():
     """Testing dPsiCalc for multiple ligands"""
     r = .01
@@ -348,6 +503,33 @@ def testColorMapSumOfSquares():
     
     colorMapSumOfSquares(epith, odorscenes, .3, qspace)
     
+def testColorMapRaster():
+    """Checks dPsiBarRaster against sumOfSquares in the same directions, at the exact ligand locations,
+    and times colorMapDPsiBars with and without config.COLOR_MAP_RASTER"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    odorscenes = [Odorscene(x, [Ligand(x*80 + y, [x/20.0, y/20.0], .004)]) for x in range(80) for y in range(80)]
+    dns = RnO.dPsiBarCalcDns(odorscenes[0], .3, 10)
+    raster = RnO.dPsiBarRaster(epith, qspace, .004, dns)
+    print("raster shape: " + str(raster.shape))
+    
+    errors = []
+    for odorscene in odorscenes[::97]:
+        exact = np.mean([sumOfSquares(epith, odorscene, dn, True) for dn in dns])
+        x, y = (int(20*loc) for loc in odorscene.odors[0].loc)
+        errors.append(abs(raster[y, x] - exact))
+    print(f"max difference from exact over {len(errors)} pixels: {max(errors)} (largest dPsiBar {raster.max()})")
+    whole = RnO.dPsiBarRaster(epith, qspace, .004, [[.05, -.1]])
+    exact = sumOfSquares(epith, odorscenes[1234], [.05, -.1], True)
+    print(f"whole pixel shift difference: {abs(whole[1234 % 80, 1234 // 80] - exact)}")
+    
+    raster = config.COLOR_MAP_RASTER
+    for config.COLOR_MAP_RASTER in (False, True):
+        start = time.time()
+        RnO.colorMapDPsiBars(epith, odorscenes, .3, qspace)
+        print(f"COLOR_MAP_RASTER={config.COLOR_MAP_RASTER}: {time.time() - start:.2f}s")
+    config.COLOR_MAP_RASTER = raster
+
 def testSequentialOdorscene():
     qspace = QSpace([[0.0,10.0],[0.0,10.0]]) 
     odorscenes = sequentialOdorscenes(50, 10, 2, .17, qspace)
@@ -373,6 +555,183 @@ def testdPsiBarSaturation():
      #epi, dn, qspace, pdfName, labelName, excelName, fixed eff, plotTitle, Close
     dPsiBarSaturation(epith, .01, qspace, pdfName, labelName, excelName, fixedEff, c, plotTitle, True)
 
+def testSaturationSumOfSquares():
+    """Compares each dPsiBar of dPsiBarSaturation against sumOfSquares of the same odorscene and
+    displacements, evaluated from scratch"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(5, 2, qspace, scaleEff=[.05,1.0])
+    utils.set_seed(3)
+    dPsiBarSaturation(epith, .01, qspace, "LigandSat scratch", "scratch", "LigandSat scratch", False, 1, "", True,
+                      "scratch", False)
+    with open("dPsi, qspace=(0, 4)scratch.csv") as f:
+        rows = [line.split(",") for line in f.readlines()[1:]]
+    
+    #Draws the same odorscenes and displacements again, one repetition after the other
+    utils.set_seed(3)
+    expected = [0.0]*len(rows)
+    for i in range(config.ODOR_REPETITIONS):
+        for k, row in enumerate(rows):
+            odorscene = Odorscene(k, [Ligand(n, createLoc(qspace), config.ODOR_CONCENTRATION) for n in range(int(row[0]))])
+            dns = dPsiBarCalcDns(odorscene, .01, config.ANGLES_REP)
+            expected[k] += sum(sumOfSquares(epith, odorscene, dn) for dn in dns)/len(dns)/config.ODOR_REPETITIONS
+    print("max dPsiBar difference is " + str(max(abs(float(row[1]) - dPsiBar) for row, dPsiBar in zip(rows, expected))))
+
+def testdPsiBarSaturationWorkers():
+    """Runs dPsiBarSaturation with 1 and 4 workers from the same seed, checking that both dPsi and
+    LigandSat csv's are identical"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    docs = {}
+    for workers in (1, 4):
+        name = "LigandSat workers=" + str(workers)
+        utils.set_seed(config.RANDOM_SEED)
+        dPsiBarSaturation(epith, .01, qspace, name, "workers", name, False, 1,
+                          "dPsiBarSaturation", True, purp=" workers=" + str(workers), workers=workers)
+        docs[workers] = []
+        for docName in (name + ".csv", "dPsi, qspace=(0, 4) workers=" + str(workers) + ".csv"):
+            with open(docName) as f:
+                docs[workers].append(f.read())
+    print("identical: " + str(docs[1] == docs[4]))
+
+def testdPsiBarSaturations():
+    """Runs dPsiBarSaturation for 3 qspaces at the same time, graphing them together in one pdf"""
+    qspaces = [QSpace([(0,q), (0, q)]) for q in (4, 10, 30)]
+    epiths = [Epithelium.create(30, 2, qspace) for qspace in qspaces]
+    labelNames = [str(qspace.size[0]) + " qspace" for qspace in qspaces]
+    excelNames = ["LigandSat with " + label for label in labelNames]
+    dPsiBarSaturations(epiths, .01, qspaces, "LigandSat with varying qspaces", labelNames, excelNames, False, 1,
+                       "dPsiBarSaturation", workers=len(qspaces))
+
+def testSaturationStore():
+    """Runs dPsiBarSaturation with both excel docs and a store, then checks that the store exports the same
+    excel docs and gives the same averages as parsing them"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    xaxis = [1,2,3,4,5,7,10,15,20,25,30,35,40,45,50,60,70,80,90,100,120,140,160,200,250,300,350,400]
+    dPsiBarSaturation(epith, .01, qspace, "LigandSat store", "store", "LigandSat store", False, 9, graphIt=False,
+                      storeName="LigandSat store")
+    store = SaturationResults.load("LigandSat store" + results.STORE_EXT)
+    store.to_csv("LigandSat store export.csv", "Glom_act store export.csv", "dPsi store export.csv")
+    for name, name2 in [("LigandSat store", "LigandSat store export"),
+                        ("Glom_act with c=9 with (0, 4) qspace", "Glom_act store export"),
+                        ("dPsi, qspace=(0, 4)", "dPsi store export")]:
+        with open(name + ".csv") as f, open(name2 + ".csv") as f2:
+            print(name + " identical: " + str(f.read() == f2.read()))
+    for toggle in ("Act", "Occ"):
+        parsed = [0.0]*len(xaxis)
+        with open("LigandSat store.csv") as f:
+            for i, line in enumerate(f):
+                if i > 0:
+                    parsed[(i-1)%len(xaxis)] += _parseAndSum(line, 30, toggle)
+        parsed = np.array(parsed) / (30.0*config.ODOR_REPETITIONS)
+        print("max " + toggle + " difference is " + str(abs(store.average(toggle) - parsed).max()))
+
+def testGraphFromResults():
+    """Runs dPsiBarSaturation and graphs its returned results, checking that the averages are the
+    same as the ones parsed from its excel doc"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    xaxis = [1,2,3,4,5,7,10,15,20,25,30,35,40,45,50,60,70,80,90,100,120,140,160,200,250,300,350,400]
+    run = dPsiBarSaturation(epith, .01, qspace, "LigandSat results", "results", "LigandSat results", False, 1,
+                            graphIt=False)
+    for toggle in ("Act", "Occ"):
+        graphFromExcel(run, xaxis, 30, "results", "Rec " + toggle + " from results", "Rec" + toggle + " from results",
+                       toggle, config.ODOR_REPETITIONS, True)
+        parsed = [0.0]*len(xaxis)
+        with open("LigandSat results.csv") as f:
+            for i, line in enumerate(f):
+                if i > 0:
+                    parsed[(i-1)%len(xaxis)] += _parseAndSum(line, 30, toggle)
+        parsed = np.array(parsed) / (30.0*config.ODOR_REPETITIONS)
+        print("max " + toggle + " difference is " + str(abs(run.average(toggle) - parsed).max()))
+    dPsiGraphFromExcel(run, qspace, "dPsiBar from results", "dPsiBar from results", True)
+
+def testNestedSaturation():
+    """Checks the incremental dPsiBars of nested odorscenes against dPsiBarCalcAngles on each odorscene,
+    with c=1 and c=4, and times one repetition with and without config.NESTED_ODORSCENES"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    xaxis = [1,2,3,4,5,7,10,15,20,25,30,35,40,45,50,60,70,80,90,100,120,140,160,200,250,300,350,400]
+    nested = config.NESTED_ODORSCENES
+    config.NESTED_ODORSCENES = True
+    batch = RnO._saturationScenes(.01, qspace, xaxis, config.ODOR_CONCENTRATION)
+    print("nested: " + str(all(np.array_equal(locs[:n], batch.locs[-1, :n]) for locs, n in zip(batch.locs, batch.counts))))
+    odorscenes = batch.toOdorscenes()
+    for c in (1, 4):
+        state = utils.RNG.bit_generator.state
+        gl = layers.GlomLayer.create(len(epith.recs))
+        dPsiBars, cells = RnO._saturationDPsiBars(epith, batch, False, c, gl, None)
+        utils.RNG.bit_generator.state = state
+        expected = [dPsiBarCalcAngles(epith, odorscene, .01, False, None, c, gl) for odorscene in odorscenes]
+        print(f"c={c} max difference: {max(abs(a - b) for a, b in zip(dPsiBars, expected))}")
+    
+    gl = layers.GlomLayer.create(len(epith.recs))
+    for config.NESTED_ODORSCENES in (False, True):
+        batch = RnO._saturationScenes(.01, qspace, xaxis, config.ODOR_CONCENTRATION)
+        start = time.time()
+        RnO._saturationDPsiBars(epith, batch, False, 1, gl, None)
+        print(f"nested={config.NESTED_ODORSCENES}: {time.time() - start:.4f}s for {batch.counts[-1] if config.NESTED_ODORSCENES else batch.counts.sum()} ligands")
+    config.NESTED_ODORSCENES = nested
+
+def testSaturationCache():
+    """Runs dPsiBarSaturation twice from the same random state with config.SATURATION_CACHE_DIR set,
+    checking that the second run is a cache hit with the same excel docs and leaves utils.RNG in the same state"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    cacheDir, config.SATURATION_CACHE_DIR = config.SATURATION_CACHE_DIR, "saturation cache"
+    state = utils.RNG.bit_generator.state
+    docs = {}
+    for name in ("LigandSat cache 1", "LigandSat cache 2"):
+        utils.RNG.bit_generator.state = state
+        if name.endswith("1"):
+            saturationCache().invalidate(saturationKey(epith, .01, qspace, False, 4))
+        dPsiBarSaturation(epith, .01, qspace, name, "cache", name, False, 4, graphIt=False)
+        docs[name] = []
+        for docName in (name + ".csv", "Glom_act with c=4 with (0, 4) qspace.csv", "dPsi, qspace=(0, 4).csv"):
+            with open(docName) as f:
+                docs[name].append(f.read())
+        docs[name].append(utils.RNG.integers(1 << 30))
+    print("identical: " + str(docs["LigandSat cache 1"] == docs["LigandSat cache 2"]))
+    print("entries: " + str(len(list(saturationCache().entries()))))
+    config.SATURATION_CACHE_DIR = cacheDir
+
+def testSaturationResume():
+    """Stops dPsiBarSaturation during its second repetition, resumes it from the checkpoint and checks that
+    the excel docs and utils.RNG state are the same as those of a run that wasn't stopped"""
+    qspace = QSpace([(0,4), (0, 4)])
+    epith = Epithelium.create(30, 2, qspace, scale=[.5,1.5], scaleEff=[.05,1.0])
+    settings = config.CHECKPOINT_DIR, config.CHECKPOINT_INTERVAL, config.RESUME
+    config.CHECKPOINT_DIR, config.CHECKPOINT_INTERVAL = "checkpoints", 0
+    state = utils.RNG.bit_generator.state
+    saturationDPsiBars = RnO._saturationDPsiBars
+    calls = []
+    def stopInSecond(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            RnO._saturationDPsiBars = saturationDPsiBars
+            raise KeyboardInterrupt("Stopped")
+        return saturationDPsiBars(*args)
+    docs = {}
+    for name in ("LigandSat resume 1", "LigandSat resume 2"):
+        utils.RNG.bit_generator.state = state
+        config.RESUME = False
+        if name.endswith("2"):
+            RnO._saturationDPsiBars = stopInSecond
+            try:
+                dPsiBarSaturation(epith, .01, qspace, name, "resume", name, False, 4, graphIt=False)
+            except KeyboardInterrupt:
+                print("stopped in the second repetition")
+            utils.RNG.bit_generator.state = state
+            config.RESUME = True
+        dPsiBarSaturation(epith, .01, qspace, name, "resume", name, False, 4, graphIt=False)
+        docs[name] = []
+        for docName in (name + ".csv", "Glom_act with c=4 with (0, 4) qspace.csv", "dPsi, qspace=(0, 4).csv"):
+            with open(docName) as f:
+                docs[name].append(f.read())
+        docs[name].append(utils.RNG.integers(1 << 30))
+    print("identical: " + str(docs["LigandSat resume 1"] == docs["LigandSat resume 2"]))
+    config.CHECKPOINT_DIR, config.CHECKPOINT_INTERVAL, config.RESUME = settings
+
 def testGraphFromExcel(toggle):
     """Returns "act" or "occ" graph vs # of ligands depending on toggle.
     Before running:
@@ -425,8 +784,15 @@ def testRecDensityDpsiGraph():
 
 def testRecInQspace():
     qspace = QSpace([(0, 4), (0, 4)])
-    #uncomment print statements in recInQspace
-    recInQspace(35**2, 2, qspace)
+    epi, dist = recInQspace(35**2, 2, qspace)
+    print(f"{len(epi.recs)} receptors, avg distance {dist}")
+    epi, dist = recInQspace(10, 2, qspace)
+    print("mixed: " + str([rec.mean for rec in epi.recs]))
+    epi, dist = recInQspace(10, 2, qspace, placement="grid")
+    print("grid: " + str([rec.mean for rec in epi.recs]))
+    start = time.time()
+    epi, dist = recInQspace(10**5, 4, QSpace([(0, 4)]*4))
+    print(f"{len(epi.recs)} receptors in 4D, avg distance {dist}, {time.time() - start:.2f}s")
     
 def testRecDensityDpsiGraphRandomized():
     r = .01
@@ -435,11 +801,47 @@ def testRecDensityDpsiGraphRandomized():
     odorscene = Odorscene.create(dim, [1e-5], [100], qspace)
     recDensityDpsiGraphRandomized(r, qspace, odorscene, dim, "TESTING", fixed=False)
 
+def testNestedRecDensity():
+    """Checks the prefix sum dPsiBars and csv rows of one nested recDensityDpsiGraphRandomized repeat against
+    dPsiBarCalcAngles on epitheliums made of the first n receptors"""
+    qspace = QSpace([(0, 4), (0, 4)])
+    odorscene = Odorscene.create(2, [1e-5], [20], qspace)
+    dns = RnO.dPsiBarCalcDns(odorscene, .01, config.ANGLES_REP)
+    for odor in odorscene.odors:
+        for dn in dns:
+            odor.appendToOdors2(Ligand(odor.id, [x + d for x, d in zip(odor.loc, dn)], odor.conc))
+    receptorNum = [2, 10, 100, 1000]
+    seed = utils.spawn_seeds(1)[0]
+    dPsiBars, rows = RnO._densityRepeat(odorscene, 2, qspace, False, receptorNum, seed)
+    
+    with utils.seeded(seed):
+        epi = Epithelium.create(max(receptorNum), 2, qspace, scale=(.5,1.5))
+    text = Text("", "exp2")
+    expected = []
+    for n in receptorNum:
+        text.write("Rec # " + str(n) + "\n")
+        expected.append(dPsiBarCalcAngles(Epithelium(epi.recs[:n]), odorscene, .01, False, text))
+    text.write("Repeat again" + "\n")
+    print(f"max difference: {max(abs(a - b) for a, b in zip(dPsiBars, expected))}")
+    print("same rows: " + str(rows == text._st))
+
 def testGetLocations():
     """Tests getLocations which is a helper function for the new glomRecConn function"""
     print(getLocations([2,2],6,5)) #Answer should be the 8 points surrounding 2,2
     print(getLocations([0,0],6,5)) #Because of tourus answer should be the three other corners and other points
     
+def testTorusNeighbors():
+    """Checks torusNeighbors against getLocations for a few grid shapes"""
+    shape = (config.NUM_ROW, config.NUM_COL)
+    for numRow, numCol in [(6, 5), (3, 3), (2, 5), (40, 25)]:
+        config.NUM_ROW, config.NUM_COL = numRow, numCol
+        table = RnO.torusNeighbors(numRow, numCol)
+        same = all([row*numCol + col for row, col in getLocations(divmod(g, numCol))] == table[g].tolist()
+                    for g in range(numRow*numCol))
+        print(str((numRow, numCol)) + " same as getLocations: " + str(same))
+    config.NUM_ROW, config.NUM_COL = shape
+    print(RnO.torusNeighbors(6, 5)[0]) #Gloms around glom 0, wrapping around to the last row and column
+
 def testGlomRecConnNew():
     """tests new glomRecConn function. Ensures that running the same function
     on two different unactivated GLs with two similar odorscenes will produce 
@@ -532,6 +934,99 @@ def testGlomRecConnNew3():
         i+=1
     print("dpsi is: " + str(math.sqrt(dpsi)))
 
+def testGlomConnWeights():
+    """Checks the CSR glom:rec weights against each glom's rec_conn_map, and that a batch of
+    odorscenes is activated the same as glomRecConnNew activates gl one odorscene at a time, and that
+    random attachments drawn without a conn don't share one."""
+    qspace = QSpace([(0, 4), (0, 4)])
+    c = 9
+    epi = Epithelium.create(30, 2, qspace, [.5,1.5], [.05,1.0])
+    activ = utils.RNG.random((5, len(epi.recs)))
+
+    weights, _ = RnO.glomConnWeights(len(epi.recs), c)
+    print("connections per glom: " + str(np.diff(weights.indptr)))
+    print("weights of glom 0: " + str(weights.data[:weights.indptr[1]]))
+
+    gl = layers.GlomLayer.create(30)
+    batch = RnO.glomActivations(weights, activ)
+    err = 0.0
+    for odorscene in activ:
+        for rec, recActiv in zip(epi.recs, odorscene):
+            rec.activ = float(recActiv)
+        glomRecConnNew(epi.recs, gl, c)
+        expected = [min(sum(rec.activ*weight for rec, weight in glom.rec_conn_map.items()), 1.0) for glom in gl]
+        err = max(err, np.abs(np.array([glom.activ for glom in gl]) - expected).max())
+    print("dict view vs glom activ (rounded to 6 digits): " + str(err))
+    print("batch vs glomRecConnNew: " + str(np.abs(batch[-1].round(6) - [glom.activ for glom in gl]).max()))
+
+    constant = config.CONSTANT_ATTACHMENTS
+    config.CONSTANT_ATTACHMENTS = False
+    first, second = RnO.glomConnWeights(len(epi.recs), c)[1], RnO.glomConnWeights(len(epi.recs), c)[1]
+    print("random calls without conn share it: " + str(first is second or first == second))
+    config.CONSTANT_ATTACHMENTS = constant
+
+def testScalableGloms():
+    """Connects 2000 gloms to 2000 recs with config.SCALABLE_GLOMS, prints the grid and the connections
+    of glom 0, checks glomRecConnNew against the bulk activation, times both attachment types and
+    checks that constant attachments reject a prime number of gloms."""
+    scalable, constant = config.SCALABLE_GLOMS, config.CONSTANT_ATTACHMENTS
+    config.SCALABLE_GLOMS = True
+    numRecs = 2000
+    c = 25
+    qspace = QSpace([(0, 4), (0, 4)])
+    epi = Epithelium.create(numRecs, 2, qspace, [.5,1.5], [.05,1.0])
+    activ = utils.RNG.random((10, numRecs))
+    for rec, recActiv in zip(epi.recs, activ[0]):
+        rec.activ = float(recActiv)
+    print("grid: " + str(RnO.glomGridShape(numRecs)))
+
+    for config.CONSTANT_ATTACHMENTS in (True, False):
+        start = time.perf_counter()
+        weights, conn = RnO.glomConnWeights(numRecs, c, [])
+        batch = RnO.glomActivations(weights, activ)
+        print("constant=" + str(config.CONSTANT_ATTACHMENTS) + " took " + str(time.perf_counter() - start) + "s")
+        print("recs of glom 0: " + str(weights.indices[:c]))
+
+        gl = layers.GlomLayer.create(numRecs)
+        glomRecConnNew(epi.recs, gl, c, conn)
+        print("glomRecConnNew vs bulk: " + str(np.abs(batch[0].round(6) - [glom.activ for glom in gl]).max()))
+
+    config.CONSTANT_ATTACHMENTS = True
+    try: #A prime number of gloms only fits a 1 X n grid
+        RnO.glomConnWeights(1999, c)
+    except AssertionError as e:
+        print("1999 gloms: " + str(e))
+    config.SCALABLE_GLOMS, config.CONSTANT_ATTACHMENTS = scalable, constant
+
+def testConnectome():
+    """Checks that a Connectome activates gl like glomRecConnNew, and that with random attachments
+    config.CONNECTOME_POLICY = "epithelium" keeps one set of connections for every sumOfSquares call
+    (and another one once config.CONSTANT_ATTACHMENTS is changed)."""
+    constant, policy = config.CONSTANT_ATTACHMENTS, config.CONNECTOME_POLICY
+    config.CONSTANT_ATTACHMENTS = False
+    qspace = QSpace([(0, 4), (0, 4)])
+    c = 9
+    epi = Epithelium.create(30, 2, qspace, [.5,1.5], [.05,1.0])
+    activ = utils.RNG.random((4, len(epi.recs)))
+    for rec, recActiv in zip(epi.recs, activ[0]):
+        rec.activ = float(recActiv)
+
+    connectome = RnO.Connectome(len(epi.recs), c)
+    gl = layers.GlomLayer.create(30)
+    glomRecConnNew(epi.recs, gl, c, connectome.conn)
+    print("glomRecConnNew vs Connectome: " + str(np.abs(connectome.activate(activ)[0].round(6) - [glom.activ for glom in gl]).max()))
+
+    odorscene = Odorscene.create(2, [1e-5]*20, [1]*20, qspace)
+    for config.CONNECTOME_POLICY in ("call", "epithelium"):
+        dPsis = [RnO.sumOfSquares(epi, odorscene, [.01, 0], c=c, gl=gl) for i in range(3)]
+        print(config.CONNECTOME_POLICY + " dPsis (the same with epithelium): " + str(dPsis))
+    print("explicit connectome: " + str(RnO.sumOfSquares(epi, odorscene, [.01, 0], c=c, gl=gl, connectome=epi.connectome(c))))
+    random = epi.connectome(c)
+    config.CONSTANT_ATTACHMENTS = True
+    print("constant attachments get their own connectome: " + str(epi.connectome(c) is not random and epi.connectome(c).conn == []))
+
+    config.CONSTANT_ATTACHMENTS, config.CONNECTOME_POLICY = constant, policy
+
 def testDPsiGraphFromExcel():
     name1 = "dPsi, qspace=(0, 4), glom_pen=0.68.csv"
     name2 = "dPsi, qspace=(0, 10), glom_pen=0.68.csv"
@@ -574,6 +1069,12 @@ def test():
     #testCreateRec()
     #testCreateEpithelium()
     #testActivateGL_QSpace()
+    #testAffinityEngine()
+    #testOccupancySolver()
+    #testOdorsceneBatch()
+    #testCompiledEpithelium()
+    #testSparseCutoff()
+    #testTextStream()
     #testSaving()
     #testLoading()
     
@@ -584,14 +1085,24 @@ def test():
     #testSumofSquaresDetails()
     #increasingRecDistTest()
     #testdPsiBarCalc()
+    #testdPsiBarCalcAnglesBatch()
     #testMultipleLigands()
     #testIdentical()
     
     #####Testing simulations
     
     testColorMapSumOfSquares()
+    #testColorMapRaster()
     #testSequentialOdorscene()
     #testdPsiBarSaturation()
+    #testSaturationSumOfSquares()
+    #testdPsiBarSaturationWorkers()
+    #testdPsiBarSaturations()
+    #testSaturationStore()
+    #testGraphFromResults()
+    #testNestedSaturation()
+    #testSaturationCache()
+    #testSaturationResume()
     #testGraphFromExcel("Act")
     #testDPsiGraphFromExcel()
     #testDPsiOccActGraphFromExcel()
@@ -600,11 +1111,16 @@ def test():
 
     #testRecInQspace()
     #testRecDensityDpsiGraphRandomized()
+    #testNestedRecDensity()
 
     #testGetLocations()
+    #testTorusNeighbors()
     #testGlomRecConnNew()
     # testGlomRecConnNew2()
     #testGlomRecConnNew3()
+    #testGlomConnWeights()
+    #testScalableGloms()
+    #testConnectome()
 
 if __name__ == '__main__':
     test()
\ No newline at end of file
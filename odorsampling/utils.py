@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import os
 import sys
+import json
 import threading
+import importlib
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import functools
 
@@ -25,6 +29,89 @@ def set_seed(seed: Iterable[int]|np.random.SeedSequence|np.random.BitGenerator|G
     print(f"Setting seed to {seed}")
     RNG = np.random.default_rng(seed)
 
+def spawn_seeds(n: int) -> list[np.random.SeedSequence]:
+    """
+    Returns `n` independent child seeds, so that parallel jobs get reproducible streams.
+    The root entropy is drawn from `RNG`, so the children are determined by the current seed.
+    """
+    return np.random.SeedSequence(int(RNG.integers(2**63))).spawn(n)
+
+@contextmanager
+def seeded(seed: np.random.SeedSequence) -> Generator[np.random.Generator, Any, None]:
+    """
+    Temporarily replaces `RNG` with a generator seeded with `seed`, restoring it afterwards.
+    """
+    global RNG
+    previous = RNG
+    RNG = np.random.default_rng(seed)
+    try:
+        yield RNG
+    finally:
+        RNG = previous
+
+def save_json(file_name: str, obj: Any) -> None:
+    """
+    Writes `obj` as JSON to `file_name`, replacing the old file in a single step so that
+    readers (eg. a resumed run after a crash) never see half of it.
+    """
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(file_name + '.tmp', file_name)
+
+def config_snapshot() -> dict[str, Any]:
+    """
+    Returns the current values of all the settings in `config`.
+    """
+    return {key: value for key, value in vars(config).items() if key.isupper()}
+
+def _init_worker(snapshot: dict[str, Any]) -> None:
+    """
+    Applies the parent's config to a worker process.
+    """
+    for key, value in snapshot.items():
+        setattr(config, key, value)
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns a process pool whose workers start with the same `config` values as this process,
+    including any that were changed after import (eg. from the command line).
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config_snapshot(),))
+
+class LazyImport:
+    """
+    Stands in for a module, or one of its attributes, until it is first used.
+
+    Used for matplotlib and scipy, which are slow to import and not needed by every run.
+    """
+    def __init__(self, module: str, attr: Optional[str] = None):
+        self._module = module
+        self._attr = attr
+        self._obj = None
+
+    def _load(self) -> Any:
+        if self._obj is None:
+            obj = importlib.import_module(self._module)
+            self._obj = obj if self._attr is None else getattr(obj, self._attr)
+        return self._obj
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        name = self._module if self._attr is None else f"{self._module}.{self._attr}"
+        return f"<LazyImport of {name}{'' if self._obj is None else ' (loaded)'}>"
+
+def lazy_import(module: str, attr: Optional[str] = None) -> Any:
+    """
+    Returns a stand-in for `module` (or `module.attr`) that imports it on first use.
+    Eg) `plt = lazy_import("matplotlib.pyplot")`
+    """
+    return LazyImport(module, attr)
+
 # Want selections to fail fast
 class DistributionFunc(Protocol):
     """Protocol for distribution types."""
@@ -74,7 +161,8 @@ def default_log_setup(logger: logging.Logger, log_level: int = None, stream_hand
         The logger to setup with the default configuration.
     """
     logger.setLevel(config.LOG_LEVEL if log_level is None else min(log_level, config.LOG_LEVEL))
-    file_handler = logging.FileHandler(config.LOG_FILE_NAME)
+    # delay so the log file is only opened once something is logged
+    file_handler = logging.FileHandler(config.LOG_FILE_NAME, delay=True)
     stream_handler = logging.StreamHandler(sys.stdout)
     file_handler.setFormatter(LOG_FORMATTER)
     stream_handler.setFormatter(LOG_FORMATTER)